@@ -1,19 +1,50 @@
 import sqlite3
+import ast
 import datetime
 import os
 import time
 import json
+import math
 import random
+import re
+import secrets
+import sys
+import atexit
+import bisect
+import collections
+import csv
+import gzip
+import hashlib
+import io
+import multiprocessing
+import queue
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
 import requests
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory
 from flask_cors import CORS
+from werkzeug.exceptions import NotFound
 from werkzeug.utils import secure_filename
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # 配置 Flask
 app = Flask(__name__, static_folder='static', template_folder='templates')
 CORS(app)
 
 DB_FILE = 'gamedata.db'
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+DB_BUSY_TIMEOUT_MS = 5000
 UPLOAD_FOLDER = 'static/uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
@@ -24,10 +55,102 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB limit
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 
+class ConnectionPool:
+    """有界 SQLite 连接池：连接只打开一次，借出/归还复用，并统一设置 WAL 等 pragma"""
+
+    def __init__(self, db_file, size=8):
+        self.db_file = db_file
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._pid = os.getpid()
+
+    def _connect(self):
+        # check_same_thread=False: 连接会在不同的请求线程间流转，但同一时刻只借给一个线程
+        conn = sqlite3.connect(self.db_file, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                               check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+        conn.execute('PRAGMA cache_size=-16000')  # 约 16MB 页缓存
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+
+    def _reset_after_fork(self):
+        # 多进程部署 (fork) 时不能沿用父进程的连接，直接丢弃重建
+        with self._lock:
+            if self._pid != os.getpid():
+                self._idle = queue.LifoQueue()
+                self._created = 0
+                self._pid = os.getpid()
+
+    def _acquire(self):
+        if self._pid != os.getpid():
+            self._reset_after_fork()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        try:
+            return self._idle.get(timeout=DB_BUSY_TIMEOUT_MS / 1000)
+        except queue.Empty:
+            raise sqlite3.OperationalError('database connection pool exhausted')
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._created -= 1
+
+    def _release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            # 未提交的事务（异常、提前 return 等）在归还前回滚，释放写锁
+            self._release(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+
+db_pool = ConnectionPool(DB_FILE, DB_POOL_SIZE)
+atexit.register(db_pool.close_all)
+
+
 def get_db_connection():
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """从连接池借出连接，用法: with get_db_connection() as conn: ..."""
+    return db_pool.connection()
 
 
 def allowed_file(filename):
@@ -63,13 +186,237 @@ DEFAULT_MAPS = [
 ]
 
 
-def init_db():
-    """初始化数据库"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+# --- 地图数据编码 ---
+# 自定义地图以规范化的紧凑格式存储：坐标量化、省略默认字段、钉子/墙按位置排序，
+# 再 zlib 压缩存入 map_blobs (按内容哈希去重并引用计数，内容相同的地图共用一份)，maps.data_hash 引用它。
+# 每个钉子/墙带一个稳定的 id，供增量修改引用；id 不参与哈希，单独存在 maps.item_ids 中。
+# 读取时还原成编辑器使用的 JSON 结构。
+
+MAP_FORMAT_VERSION = 1
+MAP_COORD_KEYS = ('x', 'y', 'r', 'w', 'h')
+MAP_COORD_DIGITS = 1            # 坐标/尺寸保留 1 位小数
+MAP_VALUE_DIGITS = 3            # 其他数值属性保留 3 位小数
+PEG_DEFAULTS = {'r': 10, 'mat': 'metal', 'restitution': 1.0, 'spinSpeed': 0, 'gravity': 0, 'isMover': False,
+                'moveType': 'horizontal', 'moveRange': 0, 'moveSpeed': 0}
+WALL_DEFAULTS = {}
+
+
+def quantize_map_value(key, value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return value
+    value = round(float(value), MAP_COORD_DIGITS if key in MAP_COORD_KEYS else MAP_VALUE_DIGITS)
+    return int(value) if value.is_integer() else value
+
+
+def compact_map_item(item, position_keys, defaults):
+    """[位置字段..., {非默认属性}]，没有非默认属性时省略最后的字典"""
+    if not isinstance(item, dict):
+        raise ValueError('地图元素格式错误')
+    values = {k: quantize_map_value(k, v) for k, v in item.items() if k != 'id'}
+    row = [values.pop(k, 0) for k in position_keys]
+    extras = {k: v for k, v in values.items() if k not in defaults or defaults[k] != v}
+    return row + [extras] if extras else row
+
+
+def compact_map_items(items, position_keys, defaults):
+    """压缩并排序一组元素，返回 (rows, ids)；没有 id 或 id 重复的元素分配新 id"""
+    entries = [(compact_map_item(item, position_keys, defaults), item.get('id')) for item in items]
+    valid = [i for _, i in entries if isinstance(i, int) and not isinstance(i, bool) and i > 0]
+    next_id = max(valid, default=0) + 1
+    seen = set()
+    for index, (row, item_id) in enumerate(entries):
+        if item_id not in valid or item_id in seen:
+            item_id = next_id
+            next_id += 1
+            entries[index] = (row, item_id)
+        seen.add(item_id)
+    entries.sort(key=lambda e: (json.dumps(e[0], sort_keys=True), e[1]))
+    return [row for row, _ in entries], [item_id for _, item_id in entries]
+
+
+def expand_map_item(row, item_id, position_keys, defaults):
+    item = {'id': item_id}
+    item.update(zip(position_keys, row))
+    item.update(defaults)
+    if len(row) > len(position_keys):
+        item.update(row[len(position_keys)])
+    return item
+
+
+def encode_map_data(data):
+    """规范化并压缩地图数据，返回 (data_blob, data_hash, item_ids)；格式不对时抛出 ValueError。
+    data_blob 不含 id，内容相同即字节相同；item_ids 为该地图自己的钉子/墙 id (JSON 文本)"""
+    if not isinstance(data, dict) or not isinstance(data.get('pegs', []), list) \
+            or not isinstance(data.get('walls', []), list):
+        raise ValueError('地图数据格式错误')
+    pegs, peg_ids = compact_map_items(data.get('pegs') or [], ('x', 'y'), PEG_DEFAULTS)
+    walls, wall_ids = compact_map_items(data.get('walls') or [], ('x', 'y', 'w', 'h'), WALL_DEFAULTS)
+    compact = {'v': MAP_FORMAT_VERSION, 'p': pegs, 'w': walls,
+               'o': {k: v for k, v in data.items() if k not in ('pegs', 'walls')}}
+    content = json.dumps(compact, ensure_ascii=False, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    item_ids = json.dumps({'pi': peg_ids, 'wi': wall_ids}, separators=(',', ':'))
+    return zlib.compress(content, 9), hashlib.sha256(content).hexdigest()[:32], item_ids
+
+
+def decode_map_data(blob, item_ids=None):
+    """还原地图数据；item_ids 为空时使用 blob 内的 id (旧格式) 或按顺序编号"""
+    compact = json.loads(zlib.decompress(blob))
+    if item_ids:
+        compact.update(json.loads(item_ids))
+    data = dict(compact.get('o') or {})
+    peg_ids = compact.get('pi') or range(1, len(compact['p']) + 1)
+    wall_ids = compact.get('wi') or range(1, len(compact['w']) + 1)
+    data['pegs'] = [expand_map_item(r, i, ('x', 'y'), PEG_DEFAULTS) for r, i in zip(compact['p'], peg_ids)]
+    data['walls'] = [expand_map_item(r, i, ('x', 'y', 'w', 'h'), WALL_DEFAULTS)
+                     for r, i in zip(compact['w'], wall_ids)]
+    return data
+
+
+MAP_PATCH_MAX_OPS = 5000
+MAP_PATCH_KINDS = {'peg': 'pegs', 'wall': 'walls'}
+
+
+def apply_map_patch(data, ops):
+    """在地图数据上依次执行增量操作，返回 (新数据, 新增元素的 id 列表)；操作无效时抛出 ValueError。
+    操作格式：{op: add|move|set|delete, kind: peg|wall, id, item / x,y / props}"""
+    data = dict(data)
+    items = {kind: [dict(item) for item in data.get(field) or []] for kind, field in MAP_PATCH_KINDS.items()}
+    added = []
+    for op in ops:
+        if not isinstance(op, dict) or op.get('kind') not in MAP_PATCH_KINDS:
+            raise ValueError('增量操作格式错误')
+        kind, action = op['kind'], op.get('op')
+        group = items[kind]
+        if action == 'add':
+            if not isinstance(op.get('item'), dict):
+                raise ValueError('add 操作缺少 item')
+            item_id = max((i.get('id') or 0 for i in group), default=0) + 1
+            group.append(dict(op['item'], id=item_id))
+            added.append({'kind': kind, 'ref': op.get('ref'), 'id': item_id})
+            continue
+        target = next((i for i in group if i.get('id') == op.get('id')), None)
+        if target is None:
+            raise ValueError(f"{kind} {op.get('id')} 不存在")
+        if action == 'move':
+            if not all(isinstance(op.get(k), (int, float)) and not isinstance(op.get(k), bool) for k in ('x', 'y')):
+                raise ValueError('move 操作缺少坐标')
+            target.update(x=op['x'], y=op['y'])
+        elif action == 'set':
+            if not isinstance(op.get('props'), dict) or 'id' in op['props']:
+                raise ValueError('set 操作缺少 props')
+            target.update(op['props'])
+        elif action == 'delete':
+            group.remove(target)
+        else:
+            raise ValueError(f'未知的操作: {action}')
+    for kind, field in MAP_PATCH_KINDS.items():
+        data[field] = items[kind]
+    return data, added
+
+
+MAP_ROW_SELECT = 'SELECT m.*, b.data AS content_blob FROM maps m LEFT JOIN map_blobs b ON b.hash = m.data_hash'
+MAP_BY_KEY_SQL = f'{MAP_ROW_SELECT} WHERE m.key = ?'
+MAP_LIST_SQL = f'{MAP_ROW_SELECT} /* full-scan */'
+MAP_ACTIVE_SQL = f'{MAP_ROW_SELECT} /* full-scan */ WHERE m.is_active = 1'
 
+
+def map_row_data(row):
+    """从 MAP_ROW_SELECT 查出的行取出地图数据 (dict)；优先使用紧凑格式，兼容无法转换而保留的 JSON 文本，
+    没有数据时返回 None"""
+    if row['content_blob'] is not None:
+        return decode_map_data(row['content_blob'], row['item_ids'])
+    try:
+        return json.loads(row['data']) if row['data'] else None
+    except (json.JSONDecodeError, TypeError):
+        return None
+
+
+def map_row_dict(row):
+    """接口返回的地图行：data 仍为 JSON 文本，与编辑器读取的格式一致"""
+    item = {k: row[k] for k in row.keys() if k not in ('data', 'data_blob', 'content_blob', 'item_ids')}
+    data = map_row_data(row)
+    item['data'] = json.dumps(data, ensure_ascii=False) if data is not None else None
+    return item
+
+
+def store_map_blob(conn, data_blob, data_hash):
+    """引用一份地图内容：已存在相同哈希时只增加引用计数"""
+    conn.execute('INSERT INTO map_blobs (hash, data, refs) VALUES (?, ?, 1) '
+                 'ON CONFLICT(hash) DO UPDATE SET refs = refs + 1', (data_hash, data_blob))
+
+
+def release_map_blob(conn, data_hash):
+    """释放一次引用，没有地图再引用时删除内容"""
+    if data_hash is None:
+        return
+    conn.execute('UPDATE map_blobs SET refs = refs - 1 WHERE hash = ?', (data_hash,))
+    conn.execute('DELETE FROM map_blobs WHERE hash = ? AND refs <= 0', (data_hash,))
+
+
+def replace_map_blob(conn, old_hash, data_blob, data_hash):
+    """地图内容改变时先引用新内容再释放旧内容 (新旧相同时引用计数不变)"""
+    store_map_blob(conn, data_blob, data_hash)
+    release_map_blob(conn, old_hash)
+
+
+# --- 数据库结构迁移 ---
+# 每个迁移按编号只执行一次，已执行到的编号记录在 PRAGMA user_version 中。
+# 新增表/字段/索引时在 SCHEMA_MIGRATIONS 末尾追加新的迁移函数，不要修改已发布的迁移。
+
+DEFAULT_CONFIGS = {
+    'slot_count': '14',
+    'light_rules': json.dumps({"1": 5, "2": 10, "3": 20, "4": 30, "5": 35}),
+    'multiplier_rules': json.dumps({"1": 10, "2": 5, "3": 4, "4": 3, "5": 2}),
+    'lucky_wheel': json.dumps({"enabled": True, "min": -50, "max": 200, "prob": 0.4}),
+    'bomb_config': json.dumps({"prob": 0.3, "count_min": 1, "count_max": 3}),
+    'coin_config': json.dumps({
+        "temp_prob": 0.5, "temp_min": 2, "temp_max": 5, "temp_val": 10,
+        "fixed_prob": 0.3, "fixed_min": 1, "fixed_max": 3, "fixed_val": 5
+    }),
+    'egg_config': json.dumps({
+        "appear_prob": 0.2,
+        "count_min": 1,
+        "count_max": 1,
+        "probs": {"coin": 0.4, "ticket": 0.4, "mouse": 0.2},
+        "rewards": {"coin": 100, "ticket": 50},
+        "penalties": {"coin": 50, "ticket": 20}
+    }),
+    'exchange_rate': '0.1',
+    # AI & TTS Defaults
+    'ai_voice_enabled': 'true',
+    'openai_api_endpoint': 'https://api.openai.com/v1/chat/completions',
+    'openai_api_key': 'YOUR_API_KEY_HERE',
+    'ai_max_tokens': '60',
+    'tts_mode': 'client',  # 'server' or 'client'
+    'tts_api_endpoint': 'http://101.200.77.239:7530/api/v1/tts/generate',
+    'tts_voice_name': 'zh-CN-YunxiNeural',
+    'tts_audio_local_path': '/vol3/1000/ssd2/appdata/easyvoice/audio',
+    'tts_cache_max_mb': '200',
+    'tts_cache_max_age_hours': '72',
+    'ai_line_pool_size': '5',  # 每个事件签名缓存的评论条数，0 表示关闭缓存
+    'ai_line_cache_ttl': '600',
+    'ai_prompt_token_budget': '400',
+    'ai_llm_deadline_ms': '1500',  # 超过该时间 LLM 未返回则先用本地评论，0 表示一直等待
+    'ai_rate_user_per_min': '6',  # AI 接口每用户令牌桶，0 表示不限
+    'ai_rate_user_burst': '3',
+    'ai_rate_global_per_sec': '5',  # AI 接口全局令牌桶，0 表示不限
+    'ai_rate_global_burst': '20',
+    'flash_sale_gift_ids': '[]'  # 开启秒杀模式的礼物 id 列表，库存先在内存中预留
+}
+
+
+def add_missing_columns(conn, table, columns):
+    """为旧数据库补齐缺失的字段，columns 为 [(字段名, 类型及默认值)]"""
+    existing = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}
+    for name, ddl in columns:
+        if name not in existing:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {name} {ddl}')
+
+
+def migrate_001_base_schema(conn):
+    """基础表结构；对引入版本号之前创建的数据库同样适用（建表均为 IF NOT EXISTS）"""
     # 1. 用户表
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS users (
             username TEXT PRIMARY KEY,
             password TEXT NOT NULL,
@@ -79,13 +426,10 @@ def init_db():
             current_skin TEXT DEFAULT "default"
         )
     ''')
-    try:
-        cursor.execute('ALTER TABLE users ADD COLUMN current_skin TEXT DEFAULT "default"')
-    except:
-        pass
+    add_missing_columns(conn, 'users', [('current_skin', 'TEXT DEFAULT "default"')])
 
     # 2. 兑换码表
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS redeem_codes (
             code TEXT PRIMARY KEY,
             max_uses INTEGER DEFAULT 1,
@@ -97,64 +441,50 @@ def init_db():
     ''')
 
     # 3. 礼物表
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS gifts (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
             image_url TEXT,
-            price INTEGER DEFAULT 100, 
-            stock INTEGER DEFAULT 0,   
+            price INTEGER DEFAULT 100,
+            stock INTEGER DEFAULT 0,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
 
     # 4. 兑换记录表
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS gift_redemptions (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id TEXT,
             gift_id INTEGER,
-            gift_name TEXT, 
+            gift_name TEXT,
             cost INTEGER,
             redeem_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            status TEXT DEFAULT 'success' 
+            status TEXT DEFAULT 'success'
         )
     ''')
 
     # 5. 地图配置表 - 增加 weight, data (JSON), author 字段
     # key 对于自定义地图将是 UUID 或时间戳
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS maps (
             key TEXT PRIMARY KEY,
             name TEXT NOT NULL,
             is_active INTEGER DEFAULT 1,
             weight INTEGER DEFAULT 10,
-            data TEXT, 
+            data TEXT,
             author TEXT DEFAULT 'System',
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
 
-    # 尝试添加新字段（如果不存在）
-    try:
-        cursor.execute('ALTER TABLE maps ADD COLUMN weight INTEGER DEFAULT 10')
-    except:
-        pass
-    try:
-        cursor.execute('ALTER TABLE maps ADD COLUMN data TEXT')
-    except:
-        pass
-    try:
-        cursor.execute('ALTER TABLE maps ADD COLUMN author TEXT DEFAULT "System"')
-    except:
-        pass
-    try:
-        cursor.execute('ALTER TABLE maps ADD COLUMN created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP')
-    except:
-        pass
+    # 早期版本的 maps 表缺少以下字段 (ALTER TABLE 不支持非常量默认值，created_at 不带默认值)
+    add_missing_columns(conn, 'maps', [('weight', 'INTEGER DEFAULT 10'), ('data', 'TEXT'),
+                                       ('author', "TEXT DEFAULT 'System'"), ('created_at', 'TIMESTAMP')])
 
     # 6. 皮肤配置表
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS skins (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
@@ -164,7 +494,7 @@ def init_db():
     ''')
 
     # 7. 游戏参数配置表
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS game_config (
             key TEXT PRIMARY KEY,
             value TEXT NOT NULL
@@ -172,7 +502,7 @@ def init_db():
     ''')
 
     # 8. 转账记录表
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS transfer_logs (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             sender TEXT,
@@ -182,60 +512,1027 @@ def init_db():
         )
     ''')
 
-    # 初始化默认配置
-    default_configs = {
-        'slot_count': '14',
-        'light_rules': json.dumps({"1": 5, "2": 10, "3": 20, "4": 30, "5": 35}),
-        'multiplier_rules': json.dumps({"1": 10, "2": 5, "3": 4, "4": 3, "5": 2}),
-        'lucky_wheel': json.dumps({"enabled": True, "min": -50, "max": 200, "prob": 0.4}),
-        'bomb_config': json.dumps({"prob": 0.3, "count_min": 1, "count_max": 3}),
-        'coin_config': json.dumps({
-            "temp_prob": 0.5, "temp_min": 2, "temp_max": 5, "temp_val": 10,
-            "fixed_prob": 0.3, "fixed_min": 1, "fixed_max": 3, "fixed_val": 5
-        }),
-        'egg_config': json.dumps({
-            "appear_prob": 0.2,
-            "count_min": 1,
-            "count_max": 1,
-            "probs": {"coin": 0.4, "ticket": 0.4, "mouse": 0.2},
-            "rewards": {"coin": 100, "ticket": 50},
-            "penalties": {"coin": 50, "ticket": 20}
-        }),
-        'exchange_rate': '0.1',
-        # AI & TTS Defaults
-        'ai_voice_enabled': 'true',
-        'openai_api_endpoint': 'https://api.openai.com/v1/chat/completions',
-        'openai_api_key': 'YOUR_API_KEY_HERE',
-        'ai_max_tokens': '60',
-        'tts_mode': 'client',  # 'server' or 'client'
-        'tts_api_endpoint': 'http://101.200.77.239:7530/api/v1/tts/generate',
-        'tts_voice_name': 'zh-CN-YunxiNeural',
-        'tts_audio_local_path': '/vol3/1000/ssd2/appdata/easyvoice/audio'
-    }
+    # 9. 数据版本表，game_config / maps 每次修改时对应版本号 +1，供各进程判断缓存是否过期
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.executemany('INSERT OR IGNORE INTO data_versions (name, version) VALUES (?, 0)',
+                     [('game_config',), ('maps',)])
+
+    # 10. 余额增量同步进度表：记录每个客户端(标签页)已应用的最大序号，用于忽略重放
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS balance_sync (
+            username TEXT NOT NULL,
+            client_id TEXT NOT NULL,
+            last_seq INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (username, client_id)
+        )
+    ''')
+
+    # 11. 玩家回合历史 (每人只保留最近若干局)，供 AI 评论构建历史摘要
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS player_rounds (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            round_key TEXT NOT NULL,
+            map TEXT,
+            win INTEGER DEFAULT 0,
+            coins INTEGER,
+            tickets INTEGER,
+            events TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (username, round_key)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_player_rounds_user ON player_rounds (username, id)')
+
+    # 排行榜索引：按积分降序、同分按用户名，取前 N 名与建立内存排行均走索引
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_tickets ON users (tickets DESC, username)')
+
+    # 预置地图与管理员账号
+    conn.executemany("INSERT OR IGNORE INTO maps (key, name, is_active, weight, author) "
+                     "VALUES (?, ?, 1, 10, 'System')", DEFAULT_MAPS)
+    conn.execute('INSERT OR IGNORE INTO users (username, password, email, coins, tickets) VALUES (?, ?, ?, ?, ?)',
+                 ('admin', '123456', 'admin@test.com', 9999, 100))
+
+
+def migrate_002_history_indexes(conn):
+    """按用户查询的历史记录索引：最近联系人、我的兑换记录、后台兑换记录、注册时的邮箱查重"""
+    # (sender, receiver, timestamp) 覆盖 recent_contacts 的 GROUP BY receiver / MAX(timestamp)，无需回表
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_transfer_logs_sender '
+                 'ON transfer_logs (sender, receiver, timestamp)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_gift_redemptions_user ON gift_redemptions (user_id, redeem_time)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_gift_redemptions_time ON gift_redemptions (redeem_time)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_email ON users (email)')
+
+
+def migrate_003_users_fts(conn):
+    """后台用户搜索的 FTS5 三元组索引 (外部内容表指向 users，触发器保持同步)。
+    SQLite 未编译 FTS5/trigram 时跳过，搜索退回用户名/邮箱前缀匹配。
+    注意 users 没有 INTEGER PRIMARY KEY，VACUUM 后需执行 INSERT INTO users_fts(users_fts) VALUES('rebuild')"""
+    try:
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5("
+                     "username, email, content='users', content_rowid='rowid', tokenize='trigram')")
+    except sqlite3.OperationalError as e:
+        print(f"[DB] FTS5 trigram unavailable, admin user search will match prefixes only: {e}")
+        return
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN
+            INSERT INTO users_fts (rowid, username, email) VALUES (new.rowid, new.username, new.email);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, username, email)
+            VALUES ('delete', old.rowid, old.username, old.email);
+        END
+    ''')
+    # 只在用户名/邮箱变化时触发，余额更新不会写 FTS
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF username, email ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, username, email)
+            VALUES ('delete', old.rowid, old.username, old.email);
+            INSERT INTO users_fts (rowid, username, email) VALUES (new.rowid, new.username, new.email);
+        END
+    ''')
+    conn.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+
+
+def migrate_004_code_batches(conn):
+    """兑换码批量生成：批次号与过期时间，按批次导出、后台按最近使用排序均走索引"""
+    add_missing_columns(conn, 'redeem_codes', [('batch_id', 'TEXT'), ('expires_at', 'TIMESTAMP')])
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_redeem_codes_batch ON redeem_codes (batch_id, code)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_redeem_codes_used ON redeem_codes (last_used_time)')
 
-    for k, v in default_configs.items():
+
+def migrate_005_compact_map_data(conn):
+    """地图数据改为紧凑压缩格式 + 内容哈希 (已有自定义地图的转换见 009)"""
+    add_missing_columns(conn, 'maps', [('data_blob', 'BLOB'), ('data_hash', 'TEXT')])
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_maps_data_hash ON maps (data_hash)')
+
+
+def migrate_006_map_revision(conn):
+    """地图修订号，增量修改时用于乐观并发控制"""
+    add_missing_columns(conn, 'maps', [('revision', 'INTEGER DEFAULT 0')])
+
+
+def migrate_007_balance_sync_prune(conn):
+    """余额同步进度按更新时间定期清理"""
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_balance_sync_updated ON balance_sync (updated_at)')
+
+
+def migrate_008_drop_codes_used_index(conn):
+    """后台兑换码列表改为按创建顺序 (rowid) 排列，最近使用时间的索引不再有查询使用，去掉以减少核销时的写入"""
+    conn.execute('DROP INDEX IF EXISTS idx_redeem_codes_used')
+
+
+def migrate_009_map_blobs(conn):
+    """地图内容按哈希去重存入 map_blobs，maps 只保留引用和自己的 id 列表；
+    转换 JSON 文本和 005 格式 (id 写在 blob 里) 的自定义地图，maps.data_blob 不再使用"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS map_blobs (
+            hash TEXT PRIMARY KEY,
+            data BLOB NOT NULL,
+            refs INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    add_missing_columns(conn, 'maps', [('item_ids', 'TEXT')])
+    rows = conn.execute('SELECT key, data, data_blob FROM maps /* full-scan */ '
+                        'WHERE data IS NOT NULL OR data_blob IS NOT NULL').fetchall()
+    for row in rows:
         try:
-            cursor.execute('INSERT INTO game_config (key, value) VALUES (?, ?)', (k, v))
-        except sqlite3.IntegrityError:
-            pass
+            legacy = decode_map_data(row['data_blob']) if row['data_blob'] is not None else json.loads(row['data'])
+            data_blob, data_hash, item_ids = encode_map_data(legacy)
+        except (ValueError, TypeError, zlib.error) as e:
+            print(f"[DB] Keeping map {row['key']} as JSON text, could not encode: {e}")
+            continue
+        store_map_blob(conn, data_blob, data_hash)
+        conn.execute('UPDATE maps SET data = NULL, data_blob = NULL, data_hash = ?, item_ids = ? WHERE key = ?',
+                     (data_hash, item_ids, row['key']))
+
+
+def migrate_010_tickets_version(conn):
+    """积分的数据版本号，各进程的内存排行榜据此发现其他进程的写入"""
+    conn.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES ('tickets', 0)")
+
+
+SCHEMA_MIGRATIONS = [
+    (1, migrate_001_base_schema),
+    (2, migrate_002_history_indexes),
+    (3, migrate_003_users_fts),
+    (4, migrate_004_code_batches),
+    (5, migrate_005_compact_map_data),
+    (6, migrate_006_map_revision),
+    (7, migrate_007_balance_sync_prune),
+    (8, migrate_008_drop_codes_used_index),
+    (9, migrate_009_map_blobs),
+    (10, migrate_010_tickets_version),
+]
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
 
-    # 初始化默认地图数据 (如果不存在则插入)
-    for key, name in DEFAULT_MAPS:
+
+def schema_is_current(conn):
+    """只读检查：结构版本已是最新且所有默认配置项都已存在"""
+    if conn.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+        return False
+    present = {row['key'] for row in conn.execute('SELECT key FROM game_config /* full-scan */')}
+    return present.issuperset(DEFAULT_CONFIGS)
+
+
+def init_db():
+    """初始化数据库：在一个写事务里执行未应用的迁移并补齐默认配置，已是最新时只做只读检查"""
+    with get_db_connection() as conn:
+        if schema_is_current(conn):
+            return
+        # BEGIN IMMEDIATE 先拿写锁：多个进程同时启动时只有一个执行迁移，其余等待后看到的是新版本
+        conn.execute('BEGIN IMMEDIATE')
+        current = conn.execute('PRAGMA user_version').fetchone()[0]
+        pending = [(version, migrate) for version, migrate in SCHEMA_MIGRATIONS if version > current]
+        for version, migrate in pending:
+            migrate(conn)
+        before = conn.total_changes
+        conn.executemany('INSERT OR IGNORE INTO game_config (key, value) VALUES (?, ?)', DEFAULT_CONFIGS.items())
+        if conn.total_changes != before:
+            bump_data_version(conn, 'game_config')
+        if pending:
+            conn.execute(f'PRAGMA user_version = {pending[-1][0]}')
+        conn.commit()
+    print(f"数据库初始化完成 (schema v{max(current, SCHEMA_VERSION)}, 本次执行 {len(pending)} 个迁移)")
+
+
+# --- 查询计划检查 ---
+# 从本文件源码中提取每一条 execute/executemany 的 SQL (字面量或模块级常量)，逐条执行 EXPLAIN QUERY PLAN，
+# 计划中出现 SCAN (包括按索引顺序遍历整表的 SCAN ... USING INDEX) 即视为问题。动态拼接的 SQL 无法静态检查，须改成模块级常量。
+# 运行 `python server.py check-plans` 或 `python -m pytest tests/test_query_plans.py`。
+
+SQL_MAINTENANCE_PREFIXES = ('PRAGMA', 'ALTER', 'CREATE', 'DROP', 'BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT',
+                            'RELEASE', 'EXPLAIN')
+# 有意的整表读取 (配置类小表、整体加载后缓存的地图列表/排行榜)，或按 rowid/索引倒序只读末尾 LIMIT 行的查询，
+# 计划同样显示为 SCAN，须在 SQL 中带上此标记
+SQL_FULL_SCAN_MARK = '/* full-scan */'
+
+
+def collect_sql_statements(path=None):
+    """返回 (statements, unresolved)：statements 为 [(行号, SQL)]；unresolved 为无法静态确定 SQL 的调用行号"""
+    with open(path or __file__, encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    statements, unresolved = [], []
+    for node in ast.walk(tree):
+        if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                and node.func.attr in ('execute', 'executemany') and node.args):
+            continue
+        arg = node.args[0]
+        if isinstance(arg, ast.Constant) and isinstance(arg.value, str):
+            sql = arg.value
+        elif isinstance(arg, ast.Name) and isinstance(globals().get(arg.id), str):
+            sql = globals()[arg.id]
+        else:
+            head = arg.values[0] if isinstance(arg, ast.JoinedStr) and arg.values else None
+            prefix = head.value if isinstance(head, ast.Constant) else ''
+            if not prefix.lstrip().upper().startswith(SQL_MAINTENANCE_PREFIXES):
+                unresolved.append(node.lineno)
+            continue
+        if not sql.lstrip().upper().startswith(SQL_MAINTENANCE_PREFIXES):
+            statements.append((node.lineno, sql))
+    return sorted(statements), sorted(unresolved)
+
+
+def find_table_scans(conn, statements):
+    """返回 [(行号, 计划明细)]：除带 SQL_FULL_SCAN_MARK 的语句外，计划中任何 SCAN 行都算全表扫描。
+    按索引顺序遍历整表 (SCAN ... USING INDEX) 同样读全表，只有 SEARCH 才是索引查找"""
+    problems = []
+    for lineno, sql in statements:
+        if SQL_FULL_SCAN_MARK in sql:
+            continue
+        for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', (None,) * sql.count('?')):
+            detail = row['detail']
+            # FTS 的 MATCH 由虚拟表自己的索引完成 (idxNum 非 0)，计划里仍写作 SCAN
+            fts_match = ' VIRTUAL TABLE INDEX ' in detail and 'INDEX 0:' not in detail
+            if detail.startswith('SCAN ') and not fts_match and not detail.startswith('SCAN CONSTANT ROW'):
+                problems.append((lineno, detail))
+    return problems
+
+
+def check_query_plans():
+    """命令行入口：迁移到最新结构后检查本文件中的所有 SQL，打印结果，返回进程退出码"""
+    init_db()
+    statements, unresolved = collect_sql_statements()
+    with get_db_connection() as conn:
+        problems = find_table_scans(conn, statements)
+    for lineno in unresolved:
+        print(f"[QUERY PLAN] server.py:{lineno}: SQL 不是字面量或模块级常量，无法检查")
+    for lineno, detail in problems:
+        print(f"[QUERY PLAN] server.py:{lineno}: {detail}")
+    print(f"[QUERY PLAN] {len(statements)} 条 SQL，{len(problems)} 处全表扫描，{len(unresolved)} 处无法检查")
+    return 1 if problems or unresolved else 0
+
+
+# --- 进程内缓存 ---
+
+CACHE_VERSION_CHECK_INTERVAL = 1.0  # 秒，两次检查版本号之间直接使用内存缓存
+CONFIG_PRIVATE_KEYS = {'openai_api_key'}
+
+
+def bump_data_version(conn, name):
+    """在调用方的写事务中递增数据版本号，需与对应数据的修改一起提交；返回新的版本号"""
+    conn.execute('UPDATE data_versions SET version = version + 1 WHERE name = ?', (name,))
+    row = conn.execute('SELECT version FROM data_versions WHERE name = ?', (name,)).fetchone()
+    return row['version'] if row else None
+
+
+class VersionedCache:
+    """按 data_versions 表中的版本号失效的进程内缓存（多进程部署同样适用），子类实现 _build"""
+
+    name = None
+
+    def __init__(self, check_interval=CACHE_VERSION_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._value = None
+        self._version = None
+        self._checked_at = 0.0
+
+    def _read_version(self, conn):
+        row = conn.execute('SELECT version FROM data_versions WHERE name = ?', (self.name,)).fetchone()
+        return row['version'] if row else 0
+
+    def _build(self, conn, version):
+        raise NotImplementedError
+
+    def get(self):
+        value = self._value
+        if value is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return value
+        with self._lock:
+            if self._value is not None and time.monotonic() - self._checked_at < self.check_interval:
+                return self._value
+            with get_db_connection() as conn:
+                if self._value is None or self._read_version(conn) != self._version:
+                    # 在同一个读事务内读取版本号和数据，保证两者一致
+                    conn.execute('BEGIN')
+                    try:
+                        version = self._read_version(conn)
+                        self._value = self._build(conn, version)
+                        self._version = version
+                    finally:
+                        conn.rollback()
+            self._checked_at = time.monotonic()
+            return self._value
+
+    def invalidate(self):
+        with self._lock:
+            self._value = None
+
+
+class ConfigSnapshot:
+    """某一版本 game_config 的只读快照：raw 为数据库原始字符串，values 为解析后的值"""
+
+    def __init__(self, version, raw):
+        self.version = version
+        self.raw = raw
+        self.values = {}
+        for key, value in raw.items():
+            try:
+                self.values[key] = json.loads(value)
+            except (json.JSONDecodeError, TypeError):
+                self.values[key] = value
+        self.public = {k: v for k, v in self.values.items() if k not in CONFIG_PRIVATE_KEYS}
+        self.public_body = json.dumps(self.public, ensure_ascii=False, sort_keys=True)
+        self.etag = f'cfg-{version}'
+
+    def get(self, key, default=None):
+        return self.raw.get(key, default)
+
+    def get_bool(self, key, default=False):
+        value = self.raw.get(key)
+        if value is None:
+            return default
+        return value.strip().lower() == 'true'
+
+    def get_int(self, key, default=0):
         try:
-            cursor.execute('INSERT INTO maps (key, name, is_active, weight, author) VALUES (?, ?, 1, 10, "System")',
-                           (key, name))
-        except sqlite3.IntegrityError:
-            pass
+            return int(float(self.raw[key]))
+        except (KeyError, TypeError, ValueError):
+            return default
+
+    def get_float(self, key, default=0.0):
+        try:
+            return float(self.raw[key])
+        except (KeyError, TypeError, ValueError):
+            return default
+
+    def get_json(self, key, default=None):
+        value = self.values.get(key, default)
+        return value if isinstance(value, (dict, list)) else default
 
-    try:
-        cursor.execute('INSERT INTO users (username, password, email, coins, tickets) VALUES (?, ?, ?, ?, ?)',
-                       ('admin', '123456', 'admin@test.com', 9999, 100))
-    except sqlite3.IntegrityError:
-        pass
 
+class ConfigCache(VersionedCache):
+    """game_config 的解析后快照"""
+
+    name = 'game_config'
+
+    def _build(self, conn, version):
+        rows = conn.execute('SELECT key, value FROM game_config /* full-scan */').fetchall()
+        return ConfigSnapshot(version, {r['key']: r['value'] for r in rows})
+
+
+def compress_bodies(body):
+    """预先压缩好各编码的响应体，供 send_precompressed 选择"""
+    bodies = {'identity': body, 'gzip': gzip.compress(body, compresslevel=9)}
+    if brotli is not None:
+        bodies['br'] = brotli.compress(body)
+    return bodies
+
+
+def json_body(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class ActiveMapsCache(VersionedCache):
+    """/api/active_maps 的响应体：预先序列化并压缩。
+    bodies 为完整地图池 (data 内嵌)；manifest_bodies 只含元数据和内容哈希，
+    blobs 为 哈希 -> 单张地图 data 的压缩体，供 /api/maps/blob/<hash> 按需下载"""
+
+    name = 'maps'
+
+    def _build(self, conn, version):
+        rows = conn.execute(MAP_ACTIVE_SQL).fetchall()
+        maps, manifest, blobs = [], [], {}
+        for row in rows:
+            item = {k: row[k] for k in ('key', 'name', 'weight', 'author')}
+            item['data'] = map_row_data(row)
+            maps.append(item)
+            entry = {k: item[k] for k in ('key', 'name', 'weight', 'author')}
+            entry['hash'] = entry['size'] = None
+            if item['data'] is not None:
+                blob = json_body(item['data'])
+                entry['hash'] = hashlib.sha256(blob).hexdigest()[:32]
+                entry['size'] = len(blob)
+                if entry['hash'] not in blobs:
+                    blobs[entry['hash']] = compress_bodies(blob)
+            manifest.append(entry)
+        body = json_body(maps)
+        manifest_body = json_body(manifest)
+        return {'etag': f'maps-{hashlib.sha256(body).hexdigest()[:32]}', 'bodies': compress_bodies(body),
+                'manifest_etag': f'manifest-{hashlib.sha256(manifest_body).hexdigest()[:32]}',
+                'manifest_bodies': compress_bodies(manifest_body), 'blobs': blobs}
+
+
+config_cache = ConfigCache()
+active_maps_cache = ActiveMapsCache()
+
+
+def commit_map_change(conn):
+    """提交对 maps 表的修改：同一事务内递增版本号，提交后丢弃本进程的地图池缓存"""
+    bump_data_version(conn, 'maps')
     conn.commit()
-    conn.close()
-    print("数据库初始化完成")
+    active_maps_cache.invalidate()
+
+
+def send_precompressed(bodies, etag, mimetype='application/json', immutable=False):
+    """按 Accept-Encoding 选择预压缩好的响应体，并处理 If-None-Match；
+    immutable=True 用于按内容哈希寻址的资源，允许客户端永久缓存"""
+    accepted = request.accept_encodings
+    encoding = 'identity'
+    for candidate in ('br', 'gzip'):
+        if candidate in bodies and accepted[candidate]:
+            encoding = candidate
+            break
+    response = app.response_class(bodies[encoding], mimetype=mimetype)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+        etag = f'{etag}-{encoding}'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable' if immutable else 'no-cache'
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+# --- 余额增量写入 (group commit) ---
+
+BALANCE_MAX_DELTAS = 500           # 单次请求最多携带的增量条数
+BALANCE_MAX_DELTA_AMOUNT = 10 ** 9  # 单条增量金币/彩票的绝对值上限，累加后也不会超出 SQLite INTEGER
+BALANCE_MAX_SEQ = 2 ** 53          # 客户端序号上限 (JS 安全整数)
+BALANCE_SYNC_RETENTION_DAYS = 7    # 超过此天数未更新的同步进度记录会被清理 (每次页面加载都是新的 client_id)
+BALANCE_SYNC_PRUNE_INTERVAL = 3600  # 秒，清理的最小间隔
+BALANCE_COMMIT_MAX_BATCH = 256     # 一次事务最多合并的请求数
+BALANCE_COMMIT_MAX_WAIT = 0.005    # 秒，收集同批请求的最长等待
+BALANCE_SUBMIT_TIMEOUT = 10
+
+
+class BalanceJob:
+    def __init__(self, username, client_id, deltas):
+        self.username = username
+        self.client_id = client_id
+        self.deltas = deltas  # [(seq, coins, tickets), ...]，按 seq 升序
+        self.done = threading.Event()
+        self.result = None
+        self.tickets_version = None
+        self.claimed = self.cancelled = False
+
+
+class GroupCommitter:
+    """后台单线程写入器：把并发请求合并进同一个事务一次提交，写吞吐随请求批次而非请求数增长。
+    子类实现 _apply(conn, job) 返回结果 dict，可选实现 _after_commit(batch)。"""
+
+    name = 'group-committer'
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._claim_lock = threading.Lock()  # 写入线程取走任务与调用方超时取消互斥
+        self._thread = None
+        self._pid = None
+
+    def _ensure_worker(self):
+        # 线程不会跨 fork 存活，按进程懒启动
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def submit_job(self, job):
+        """job 需带 done (Event)、result、claimed、cancelled 属性；等待所在批次提交后返回 job.result。
+        超时时若任务还在队列中就取消它 (之后不会再提交)；已被写入线程取走的任务等它的批次结束，
+        不能在它仍可能提交时向调用方报告失败"""
+        self._ensure_worker()
+        self._queue.put(job)
+        if job.done.wait(BALANCE_SUBMIT_TIMEOUT):
+            return job.result
+        with self._claim_lock:
+            if not job.claimed:
+                job.cancelled = True
+                return {'success': False, 'message': '服务器繁忙，请稍后重试'}
+        job.done.wait()
+        return job.result
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + BALANCE_COMMIT_MAX_WAIT
+            while len(batch) < BALANCE_COMMIT_MAX_BATCH:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            with self._claim_lock:
+                batch = [job for job in batch if not job.cancelled]
+                for job in batch:
+                    job.claimed = True
+            if not batch:
+                continue
+            try:
+                self._commit_batch(batch)
+            except Exception as e:
+                print(f"[{self.name}] ERROR committing batch of {len(batch)}: {e}")
+                for job in batch:
+                    job.result = {'success': False, 'message': str(e)}
+            for job in batch:
+                job.done.set()
+
+    def _commit_batch(self, batch):
+        with get_db_connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            for job in batch:
+                # 每个请求一个 SAVEPOINT，单个请求出错不影响同批其他玩家
+                conn.execute('SAVEPOINT job')
+                try:
+                    job.result = self._apply(conn, job)
+                    conn.execute('RELEASE job')
+                except Exception as e:
+                    # 不只是 sqlite3.Error：如超出 INTEGER 范围的 OverflowError 也只让这一个请求失败
+                    conn.execute('ROLLBACK TO job')
+                    conn.execute('RELEASE job')
+                    job.result = {'success': False, 'message': str(e)}
+            conn.commit()
+        self._after_commit(batch)
+
+    def _apply(self, conn, job):
+        raise NotImplementedError
+
+    def _after_commit(self, batch):
+        pass
+
+
+class BalanceCommitter(GroupCommitter):
+    """余额增量的 group commit"""
+
+    name = 'balance-committer'
+
+    def __init__(self):
+        super().__init__()
+        self._pruned_at = time.monotonic()
+
+    def submit(self, username, client_id, deltas):
+        return self.submit_job(BalanceJob(username, client_id, deltas))
+
+    def _after_commit(self, batch):
+        for job in batch:
+            if job.result.get('success') and job.tickets_version is not None:
+                rank_index.update(job.username, job.result['tickets'], job.tickets_version)
+        if time.monotonic() - self._pruned_at >= BALANCE_SYNC_PRUNE_INTERVAL:
+            self._pruned_at = time.monotonic()
+            self._prune_sync_progress()
+
+    def _prune_sync_progress(self):
+        # 客户端未确认的增量每隔几秒就会重试，保留期远长于重试窗口，清理不会导致重放
+        try:
+            with get_db_connection() as conn:
+                cur = conn.execute("DELETE FROM balance_sync WHERE updated_at < datetime('now', ?)",
+                                   (f'-{BALANCE_SYNC_RETENTION_DAYS} days',))
+                conn.commit()
+            if cur.rowcount:
+                print(f"[{self.name}] Pruned {cur.rowcount} stale balance_sync rows")
+        except sqlite3.Error as e:
+            print(f"[{self.name}] ERROR pruning balance_sync: {e}")
+
+    def _apply(self, conn, job):
+        row = conn.execute('SELECT last_seq FROM balance_sync WHERE username = ? AND client_id = ?',
+                           (job.username, job.client_id)).fetchone()
+        last_seq = row['last_seq'] if row else 0
+        fresh = [d for d in job.deltas if d[0] > last_seq]
+        if fresh:
+            coins = sum(d[1] for d in fresh)
+            tickets = sum(d[2] for d in fresh)
+            cur = conn.execute('UPDATE users SET coins = coins + ?, tickets = tickets + ? WHERE username = ?',
+                               (coins, tickets, job.username))
+            if cur.rowcount == 0:
+                return {'success': False, 'message': '用户未找到'}
+            if tickets:
+                job.tickets_version = bump_data_version(conn, 'tickets')
+            last_seq = fresh[-1][0]
+            conn.execute('INSERT INTO balance_sync (username, client_id, last_seq, updated_at) '
+                         'VALUES (?, ?, ?, CURRENT_TIMESTAMP) '
+                         'ON CONFLICT(username, client_id) DO UPDATE SET last_seq = excluded.last_seq, '
+                         'updated_at = excluded.updated_at',
+                         (job.username, job.client_id, last_seq))
+        user = conn.execute('SELECT coins, tickets FROM users WHERE username = ?', (job.username,)).fetchone()
+        if not user:
+            return {'success': False, 'message': '用户未找到'}
+        return {'success': True, 'coins': user['coins'], 'tickets': user['tickets'],
+                'last_seq': last_seq, 'applied': len(fresh)}
+
+
+balance_committer = BalanceCommitter()
+
+
+# --- 礼物兑换 ---
+
+FLASH_SALE_RELOAD_INTERVAL = 10  # 秒，预留计数定期按数据库库存重置，吸收其他进程的兑换和后台补货
+
+
+def redeem_gift(conn, username, gift_id):
+    """在调用方的 BEGIN IMMEDIATE 事务中兑换一件礼物；库存用条件 UPDATE 扣减，失败时不产生任何写入。
+    返回结果 dict，失败时 reason 为 invalid / tickets / sold_out"""
+    user = conn.execute('SELECT tickets FROM users WHERE username=?', (username,)).fetchone()
+    gift = conn.execute('SELECT name, price FROM gifts WHERE id=?', (gift_id,)).fetchone()
+    if not user or not gift:
+        return {'success': False, 'message': '错误', 'reason': 'invalid'}
+    if user['tickets'] < gift['price']:
+        return {'success': False, 'message': '库存或积分不足', 'reason': 'tickets'}
+    if conn.execute('UPDATE gifts SET stock = stock - 1 WHERE id = ? AND stock > 0', (gift_id,)).rowcount == 0:
+        return {'success': False, 'message': '已售罄', 'reason': 'sold_out'}
+    conn.execute('UPDATE users SET tickets = tickets - ? WHERE username = ?', (gift['price'], username))
+    conn.execute('INSERT INTO gift_redemptions (user_id, gift_id, gift_name, cost) VALUES (?, ?, ?, ?)',
+                 (username, gift_id, gift['name'], gift['price']))
+    return {'success': True, 'message': '兑换成功', 'new_tickets': user['tickets'] - gift['price']}
+
+
+class GiftJob:
+    def __init__(self, username, gift_id):
+        self.username = username
+        self.gift_id = gift_id
+        self.done = threading.Event()
+        self.result = None
+        self.tickets_version = None
+        self.claimed = self.cancelled = False
+
+
+class GiftFlashSale(GroupCommitter):
+    """热门礼物的秒杀模式 (game_config.flash_sale_gift_ids)：库存先在内存里预留，
+    抢不到的请求直接返回售罄不碰数据库，抢到的排队按批在一个事务内兑换。
+    多进程时各进程的预留计数可能偏多，最终以数据库的条件扣减为准，不会超卖。"""
+
+    name = 'gift-flash-sale'
+
+    def __init__(self):
+        super().__init__()
+        self._stock_lock = threading.Lock()  # 只保护内存计数，持有期间不访问数据库
+        self._load_lock = threading.Lock()  # 过期后只让一个线程去数据库重新加载
+        self._stock = {}  # gift_id -> (剩余可预留数, 加载时间)
+
+    def enabled_for(self, gift_id):
+        ids = config_cache.get().get_json('flash_sale_gift_ids', [])
+        return gift_id in {int(i) for i in ids if str(i).isdigit()}
+
+    def _load(self, gift_id):
+        """从数据库加载库存；持有 _load_lock 期间别的线程已经加载过就直接返回"""
+        with self._load_lock:
+            with self._stock_lock:
+                entry = self._stock.get(gift_id)
+                if entry is not None and time.monotonic() - entry[1] <= FLASH_SALE_RELOAD_INTERVAL:
+                    return
+            with get_db_connection() as conn:
+                row = conn.execute('SELECT stock FROM gifts WHERE id = ?', (gift_id,)).fetchone()
+            with self._stock_lock:
+                self._stock[gift_id] = (row['stock'] if row else 0, time.monotonic())
+
+    def _reserve(self, gift_id):
+        loaded = False
+        while True:
+            with self._stock_lock:
+                entry = self._stock.get(gift_id)
+                if entry is not None and (loaded or time.monotonic() - entry[1] <= FLASH_SALE_RELOAD_INTERVAL):
+                    if entry[0] <= 0:
+                        return False
+                    self._stock[gift_id] = (entry[0] - 1, entry[1])
+                    return True
+            # 计数缺失或过期：在 _stock_lock 之外查库，加载完再回到内存里预留
+            self._load(gift_id)
+            loaded = True
+
+    def _settle(self, gift_id, result):
+        """兑换失败时归还预留；数据库已售罄时把计数清零"""
+        with self._stock_lock:
+            entry = self._stock.get(gift_id)
+            if entry is None:
+                return
+            if result.get('reason') == 'sold_out':
+                self._stock[gift_id] = (0, entry[1])
+            else:
+                self._stock[gift_id] = (entry[0] + 1, entry[1])
+
+    def reset(self, gift_id=None):
+        """后台修改库存后调用，下次请求按数据库重新加载"""
+        with self._stock_lock:
+            if gift_id is None:
+                self._stock.clear()
+            else:
+                self._stock.pop(gift_id, None)
+
+    def redeem(self, username, gift_id):
+        if not self._reserve(gift_id):
+            return {'success': False, 'message': '已售罄', 'reason': 'sold_out'}
+        result = self.submit_job(GiftJob(username, gift_id))
+        if not result.get('success'):
+            self._settle(gift_id, result)
+        return result
+
+    def _apply(self, conn, job):
+        result = redeem_gift(conn, job.username, job.gift_id)
+        if result['success']:
+            job.tickets_version = bump_data_version(conn, 'tickets')
+        return result
+
+    def _after_commit(self, batch):
+        for job in batch:
+            if job.result.get('success') and job.tickets_version is not None:
+                rank_index.update(job.username, job.result['new_tickets'], job.tickets_version)
+
+
+gift_flash_sale = GiftFlashSale()
+
+
+# --- 排行榜 ---
+
+LEADERBOARD_MAX_LIMIT = 100
+SORTED_BUCKET_LOAD = 512  # 分桶有序列表每个桶的目标长度
+
+
+class SortedKeyList:
+    """分桶有序列表：每个桶是一个小的有序 list，Fenwick 树记录各桶长度。
+    插入/删除/求名次/按名次定位只需 O(log n) 次比较，外加桶内至多 2 * load 个元素的移动。"""
+
+    def __init__(self, keys=(), load=SORTED_BUCKET_LOAD):
+        keys = sorted(keys)
+        self._load = load
+        self._buckets = [keys[i:i + load] for i in range(0, len(keys), load)]
+        self._maxes = [bucket[-1] for bucket in self._buckets]
+        self._len = len(keys)
+        self._rebuild_tree()
+
+    def __len__(self):
+        return self._len
+
+    def _rebuild_tree(self):
+        # 桶被拆分或删空时整体重建，O(桶数)，摊到每次插入/删除上可忽略
+        tree = [0] * (len(self._buckets) + 1)
+        for i, bucket in enumerate(self._buckets, 1):
+            tree[i] += len(bucket)
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _tree_add(self, b, delta):
+        i = b + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, b):
+        """前 b 个桶的元素总数"""
+        total = 0
+        while b > 0:
+            total += self._tree[b]
+            b -= b & -b
+        return total
+
+    def _locate(self, index):
+        """第 index 个元素所在的 (桶号, 桶内下标)"""
+        pos, rest = 0, index
+        step = 1 << len(self._tree).bit_length()
+        while step:
+            nxt = pos + step
+            if nxt < len(self._tree) and self._tree[nxt] <= rest:
+                pos = nxt
+                rest -= self._tree[nxt]
+            step >>= 1
+        return pos, rest
+
+    def add(self, key):
+        self._len += 1
+        if not self._buckets:
+            self._buckets.append([key])
+            self._maxes.append(key)
+            self._rebuild_tree()
+            return
+        b = min(bisect.bisect_left(self._maxes, key), len(self._buckets) - 1)
+        bucket = self._buckets[b]
+        bisect.insort(bucket, key)
+        self._maxes[b] = bucket[-1]
+        if len(bucket) > 2 * self._load:
+            self._buckets[b:b + 1] = [bucket[:self._load], bucket[self._load:]]
+            self._maxes[b:b + 1] = [bucket[self._load - 1], bucket[-1]]
+            self._rebuild_tree()
+        else:
+            self._tree_add(b, 1)
+
+    def discard(self, key):
+        b = bisect.bisect_left(self._maxes, key)
+        if b == len(self._buckets):
+            return
+        bucket = self._buckets[b]
+        i = bisect.bisect_left(bucket, key)
+        if i == len(bucket) or bucket[i] != key:
+            return
+        del bucket[i]
+        self._len -= 1
+        if bucket:
+            self._maxes[b] = bucket[-1]
+            self._tree_add(b, -1)
+        else:
+            del self._buckets[b]
+            del self._maxes[b]
+            self._rebuild_tree()
+
+    def bisect_left(self, key):
+        b = bisect.bisect_left(self._maxes, key)
+        if b == len(self._buckets):
+            return self._len
+        return self._prefix(b) + bisect.bisect_left(self._buckets[b], key)
+
+    def bisect_right(self, key):
+        b = bisect.bisect_right(self._maxes, key)
+        if b == len(self._buckets):
+            return self._len
+        return self._prefix(b) + bisect.bisect_right(self._buckets[b], key)
+
+    def slice(self, start, stop):
+        """按位置取 [start, stop) 的元素"""
+        start, stop = max(start, 0), min(stop, self._len)
+        if start >= stop:
+            return []
+        b, i = self._locate(start)
+        out = []
+        while len(out) < stop - start:
+            out.extend(self._buckets[b][i:i + stop - start - len(out)])
+            b, i = b + 1, 0
+        return out
+
+
+class RankIndex:
+    """内存排行榜：按 (-tickets, username) 保存在 SortedKeyList 中，更新/求名次/分页均为 O(log n)。
+    同票数按用户名升序，保证名次稳定。
+    每次积分写入都在同一事务中递增 data_versions 的 tickets 版本号，本进程的写入带着这个版本号调用 update()；
+    内存数据对应的版本号与库中一致时不重载，出现本进程没有应用过的版本 (其他进程的写入) 时全量重建。"""
+
+    name = 'tickets'
+
+    def __init__(self, check_interval=CACHE_VERSION_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._lock = threading.RLock()
+        self._keys = SortedKeyList()
+        self._tickets = {}
+        self._user_versions = {}  # 加载后被 update() 修改过的用户 -> 最近一次修改的版本号
+        self._version = None      # 内存数据已完整包含的版本号
+        self._ahead = set()       # 已应用、但更早的版本号还没到的本进程写入
+        self._checked_at = 0.0
+
+    def _ensure_loaded(self):
+        if self._version is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return
+        # 持锁读库并替换：加载期间的 update() 会等待加载完成后再按版本号决定是否应用
+        with self._lock:
+            if self._version is not None and time.monotonic() - self._checked_at < self.check_interval:
+                return
+            with get_db_connection() as conn:
+                if self._version is None or self._read_version(conn) != self._version:
+                    # 在同一个读事务内读取版本号和数据，保证两者一致
+                    conn.execute('BEGIN')
+                    try:
+                        version = self._read_version(conn)
+                        rows = conn.execute('SELECT username, tickets FROM users /* full-scan */').fetchall()
+                    finally:
+                        conn.rollback()
+                    self._tickets = {r['username']: r['tickets'] or 0 for r in rows}
+                    self._keys = SortedKeyList((-t, username) for username, t in self._tickets.items())
+                    self._user_versions, self._version, self._ahead = {}, version, set()
+            self._checked_at = time.monotonic()
+
+    def _read_version(self, conn):
+        row = conn.execute('SELECT version FROM data_versions WHERE name = ?', (self.name,)).fetchone()
+        return row['version'] if row else 0
+
+    def update(self, username, tickets, version):
+        """积分写入提交后调用，version 为该事务中 bump_data_version(conn, 'tickets') 的返回值。
+        索引尚未加载、或这次写入已包含在加载的快照中时忽略"""
+        if username is None or version is None:
+            return
+        try:
+            tickets = int(tickets)
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            if self._version is None or version <= self._version:
+                return
+            self._ahead.add(version)
+            while self._version + 1 in self._ahead:
+                self._version += 1
+                self._ahead.discard(self._version)
+            # 同一进程内的并发写入可能乱序到达，同一用户只接受更新的版本
+            if self._user_versions.get(username, 0) > version:
+                return
+            self._user_versions[username] = version
+            old = self._tickets.get(username)
+            if old == tickets:
+                return
+            if old is not None:
+                self._keys.discard((-old, username))
+            self._keys.add((-tickets, username))
+            self._tickets[username] = tickets
+
+    @staticmethod
+    def _row(i, key):
+        neg, username = key
+        return {'rank': i + 1, 'username': username, 'tickets': -neg}
+
+    def rank_of(self, username):
+        """返回 (名次, 积分)，用户不存在时返回 None"""
+        self._ensure_loaded()
+        with self._lock:
+            tickets = self._tickets.get(username)
+            if tickets is None:
+                return None
+            return self._keys.bisect_left((-tickets, username)) + 1, tickets
+
+    def page(self, limit, cursor=None):
+        """按名次分页；cursor 为上一页最后一名的 (积分, 用户名)，返回 (rows, next_cursor)"""
+        self._ensure_loaded()
+        with self._lock:
+            start = 0
+            if cursor is not None:
+                start = self._keys.bisect_right((-cursor[0], cursor[1]))
+            rows = [self._row(start + k, key) for k, key in enumerate(self._keys.slice(start, start + limit))]
+            more = start + limit < len(self._keys)
+        next_cursor = encode_rank_cursor(rows[-1]) if rows and more else None
+        return rows, next_cursor
+
+    def around(self, username, radius):
+        """返回用户前后各 radius 名的邻居（包含自己）"""
+        self._ensure_loaded()
+        with self._lock:
+            tickets = self._tickets.get(username)
+            if tickets is None:
+                return []
+            i = self._keys.bisect_left((-tickets, username))
+            lo = max(0, i - radius)
+            return [self._row(lo + k, key) for k, key in enumerate(self._keys.slice(lo, i + radius + 1))]
+
+
+def encode_rank_cursor(row):
+    return f"{row['tickets']}:{row['username']}"
+
+
+def decode_rank_cursor(cursor):
+    tickets, _, username = cursor.partition(':')
+    return int(tickets), username
+
+
+rank_index = RankIndex()
+
+
+# --- 收款人联想 ---
+
+USER_LOOKUP_REFRESH_INTERVAL = 300  # 秒，定期全量重载以同步其他进程注册的新用户
+USER_LOOKUP_MAX_LIMIT = 20
+
+
+class UsernameIndex:
+    """用户名前缀索引：按小写用户名排序的数组，bisect 定位前缀后顺序取前 k 个，不区分大小写。
+    本进程注册的用户通过 add() 即时插入。"""
+
+    def __init__(self, refresh_interval=USER_LOOKUP_REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._keys = []  # (username.lower(), username)
+        self._loaded_at = None
+
+    def _ensure_loaded(self):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.refresh_interval:
+            return
+        with get_db_connection() as conn:
+            rows = conn.execute('SELECT username FROM users /* full-scan */').fetchall()
+        keys = sorted((r['username'].lower(), r['username']) for r in rows if r['username'])
+        with self._lock:
+            self._keys = keys
+            self._loaded_at = time.monotonic()
+
+    def add(self, username):
+        """注册成功后调用；索引尚未加载时忽略，等首次查询时全量加载"""
+        if self._loaded_at is None or not username:
+            return
+        key = (username.lower(), username)
+        with self._lock:
+            i = bisect.bisect_left(self._keys, key)
+            if i == len(self._keys) or self._keys[i] != key:
+                self._keys.insert(i, key)
+
+    def prefix(self, prefix, limit, exclude=()):
+        self._ensure_loaded()
+        prefix = prefix.lower()
+        result = []
+        with self._lock:
+            i = bisect.bisect_left(self._keys, (prefix, ''))
+            while i < len(self._keys) and len(result) < limit and self._keys[i][0].startswith(prefix):
+                username = self._keys[i][1]
+                if username not in exclude:
+                    result.append(username)
+                i += 1
+        return result
+
+
+username_index = UsernameIndex()
 
 
 # --- 路由 ---
@@ -267,45 +1564,48 @@ def serve_any_file(filename):
 
 @app.route('/api/config', methods=['GET'])
 def get_game_config():
-    conn = get_db_connection()
-    rows = conn.execute("SELECT * FROM game_config WHERE key != 'openai_api_key'").fetchall()
-    conn.close()
-    config = {}
-    for row in rows:
-        try:
-            config[row['key']] = json.loads(row['value'])
-        except (json.JSONDecodeError, TypeError):
-            config[row['key']] = row['value']
-    return jsonify(config)
+    snapshot = config_cache.get()
+    response = app.response_class(snapshot.public_body, mimetype='application/json')
+    response.set_etag(snapshot.etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 
 # --- 地图管理 API (核心更新) ---
 
 @app.route('/api/maps', methods=['GET'])
 def get_all_maps():
-    conn = get_db_connection()
-    maps = conn.execute('SELECT * FROM maps').fetchall()
-    conn.close()
-    return jsonify([dict(m) for m in maps])
+    with get_db_connection() as conn:
+        maps = conn.execute(MAP_LIST_SQL).fetchall()
+    return jsonify([map_row_dict(m) for m in maps])
 
 
 @app.route('/api/map/<key>', methods=['GET'])
 def get_map_by_key(key):
-    conn = get_db_connection()
-    game_map = conn.execute('SELECT * FROM maps WHERE key = ?', (key,)).fetchone()
-    conn.close()
+    with get_db_connection() as conn:
+        game_map = conn.execute(MAP_BY_KEY_SQL, (key,)).fetchone()
     if game_map:
-        return jsonify(dict(game_map))
+        return jsonify(map_row_dict(game_map))
     return jsonify({'success': False, 'message': 'Map not found'}), 404
 
 
 @app.route('/api/active_maps', methods=['GET'])
 def get_active_maps():
-    conn = get_db_connection()
-    # 返回 active 的地图，必须包含 data (用于自定义地图渲染)
-    maps = conn.execute('SELECT key, name, weight, data, author FROM maps WHERE is_active = 1').fetchall()
-    conn.close()
-    return jsonify([dict(m) for m in maps])
+    """返回 active 的地图 (含 data)；manifest=1 时只返回 key/name/weight/author/hash/size，
+    data 由客户端抽中地图后再按 hash 从 /api/maps/blob/<hash> 下载"""
+    payload = active_maps_cache.get()
+    if request.args.get('manifest') == '1':
+        return send_precompressed(payload['manifest_bodies'], payload['manifest_etag'])
+    return send_precompressed(payload['bodies'], payload['etag'])
+
+
+@app.route('/api/maps/blob/<content_hash>', methods=['GET'])
+def get_map_blob(content_hash):
+    """按内容哈希返回单张地图的 data；同一哈希的内容永远不变，可永久缓存"""
+    bodies = active_maps_cache.get()['blobs'].get(content_hash)
+    if bodies is None:
+        return jsonify({'success': False, 'message': '地图不存在或已下线'}), 404
+    return send_precompressed(bodies, content_hash, immutable=True)
 
 
 @app.route('/api/maps/save', methods=['POST'])
@@ -313,68 +1613,133 @@ def save_custom_map():
     data = request.json
     name = data.get('name', '未命名地图')
     author = data.get('author', '匿名工匠')
-    map_json = json.dumps(data.get('data', {}))  # 核心地图数据
+    try:
+        data_blob, data_hash, item_ids = encode_map_data(data.get('data', {}))  # 核心地图数据
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
 
     # 生成唯一 Key
     map_key = f"CUSTOM_{int(time.time())}_{random.randint(100, 999)}"
 
-    conn = get_db_connection()
-    try:
-        conn.execute(
-            'INSERT INTO maps (key, name, is_active, weight, data, author) VALUES (?, ?, 1, 10, ?, ?)',
-            (map_key, name, map_json, author)
-        )
-        conn.commit()
-        return jsonify({'success': True, 'message': '地图保存成功！已自动上架。', 'key': map_key})
-    except Exception as e:
-        return jsonify({'success': False, 'message': str(e)})
-    finally:
-        conn.close()
+    with get_db_connection() as conn:
+        try:
+            # 同一作者、同名、同内容的保存视为重复提交 (如连点保存)，返回已有的 key；
+            # 其他情况总是建调用方自己的记录，内容相同时只共用 map_blobs 中的一份数据
+            conn.execute('BEGIN IMMEDIATE')
+            existing = conn.execute('SELECT key FROM maps WHERE data_hash = ? AND author = ? AND name = ? LIMIT 1',
+                                    (data_hash, author, name)).fetchone()
+            if existing:
+                return jsonify({'success': True, 'message': '已存在相同的地图，无需重复保存。',
+                                'key': existing['key']})
+            store_map_blob(conn, data_blob, data_hash)
+            conn.execute(
+                'INSERT INTO maps (key, name, is_active, weight, data_hash, item_ids, author) '
+                'VALUES (?, ?, 1, 10, ?, ?, ?)',
+                (map_key, name, data_hash, item_ids, author)
+            )
+            commit_map_change(conn)
+            return jsonify({'success': True, 'message': '地图保存成功！已自动上架。', 'key': map_key})
+        except Exception as e:
+            return jsonify({'success': False, 'message': str(e)})
 
 
 @app.route('/api/maps/update', methods=['POST'])
 def update_custom_map():
+    """覆盖保存地图。带 ops 时按增量操作修改，需要 base_revision 与当前修订号一致；
+    否则用 data 整体替换。两种方式都会递增修订号并返回新的内容哈希。"""
     data = request.json
     key = data.get('key')
     name = data.get('name')
     author = data.get('author')
-    map_data = json.dumps(data.get('data', {}))
 
     if not key:
         return jsonify({'success': False, 'message': 'Map key is required'}), 400
+    if data.get('ops') is not None:
+        return patch_custom_map(key, name, author, data.get('ops'), data.get('base_revision'))
+    try:
+        data_blob, data_hash, item_ids = encode_map_data(data.get('data', {}))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
 
-    conn = get_db_connection()
+    with get_db_connection() as conn:
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            old = conn.execute('SELECT data_hash FROM maps WHERE key = ?', (key,)).fetchone()
+            if old is None:
+                conn.rollback()
+                return jsonify({'success': False, 'message': '地图不存在'}), 404
+            conn.execute(
+                'UPDATE maps SET name = ?, author = ?, data = NULL, data_hash = ?, item_ids = ?, '
+                'revision = revision + 1 WHERE key = ?',
+                (name, author, data_hash, item_ids, key)
+            )
+            replace_map_blob(conn, old['data_hash'], data_blob, data_hash)
+            row = conn.execute('SELECT revision FROM maps WHERE key = ?', (key,)).fetchone()
+            commit_map_change(conn)
+            return jsonify({'success': True, 'message': '地图更新成功！', 'data_hash': data_hash,
+                            'revision': row['revision']})
+        except Exception as e:
+            return jsonify({'success': False, 'message': str(e)})
+
+
+def patch_custom_map(key, name, author, ops, base_revision):
+    if not isinstance(ops, list) or len(ops) > MAP_PATCH_MAX_OPS:
+        return jsonify({'success': False, 'message': '增量操作格式错误'}), 400
     try:
+        base_revision = int(base_revision)
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': '缺少 base_revision'}), 400
+
+    with get_db_connection() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute(MAP_BY_KEY_SQL, (key,)).fetchone()
+        if row is None:
+            conn.rollback()
+            return jsonify({'success': False, 'message': '地图不存在'}), 404
+        current = map_row_data(row)
+        if current is None:
+            # 内置地图没有存储的钉子 (由生成规则决定)，不能在空数据上打补丁
+            conn.rollback()
+            return jsonify({'success': False, 'message': '系统预置地图不支持增量修改'}), 400
+        if row['revision'] != base_revision:
+            conn.rollback()
+            return jsonify({'success': False, 'message': '地图已被修改，请重新加载后再保存。',
+                            'revision': row['revision']}), 409
+        try:
+            map_data, added = apply_map_patch(current, ops)
+            data_blob, data_hash, item_ids = encode_map_data(map_data)
+        except ValueError as e:
+            conn.rollback()
+            return jsonify({'success': False, 'message': str(e)}), 400
         conn.execute(
-            'UPDATE maps SET name = ?, author = ?, data = ? WHERE key = ?',
-            (name, author, map_data, key)
+            'UPDATE maps SET name = COALESCE(?, name), author = COALESCE(?, author), data = NULL, '
+            'data_hash = ?, item_ids = ?, revision = revision + 1 WHERE key = ?',
+            (name, author, data_hash, item_ids, key)
         )
-        conn.commit()
-        return jsonify({'success': True, 'message': '地图更新成功！'})
-    except Exception as e:
-        return jsonify({'success': False, 'message': str(e)})
-    finally:
-        conn.close()
+        replace_map_blob(conn, row['data_hash'], data_blob, data_hash)
+        commit_map_change(conn)
+    return jsonify({'success': True, 'message': '地图更新成功！', 'data_hash': data_hash,
+                    'revision': base_revision + 1, 'added': added})
 
 
 # --- 皮肤系统 API ---
 @app.route('/api/skins', methods=['GET'])
 def get_skins():
-    conn = get_db_connection()
     is_admin = request.args.get('all') == '1'
-    sql = 'SELECT * FROM skins ORDER BY id DESC' if is_admin else 'SELECT * FROM skins WHERE is_active = 1 ORDER BY id DESC'
-    skins = conn.execute(sql).fetchall()
-    conn.close()
+    with get_db_connection() as conn:
+        if is_admin:
+            skins = conn.execute('SELECT * FROM skins /* full-scan */ ORDER BY id DESC').fetchall()
+        else:
+            skins = conn.execute('SELECT * FROM skins /* full-scan */ WHERE is_active = 1 ORDER BY id DESC').fetchall()
     return jsonify([dict(s) for s in skins])
 
 
 @app.route('/api/set_skin', methods=['POST'])
 def set_skin():
     data = request.json
-    conn = get_db_connection()
-    conn.execute('UPDATE users SET current_skin = ? WHERE username = ?', (data.get('skin_url'), data.get('username')))
-    conn.commit()
-    conn.close()
+    with get_db_connection() as conn:
+        conn.execute('UPDATE users SET current_skin = ? WHERE username = ?', (data.get('skin_url'), data.get('username')))
+        conn.commit()
     return jsonify({'success': True})
 
 
@@ -382,10 +1747,9 @@ def set_skin():
 @app.route('/api/login', methods=['POST'])
 def login():
     data = request.json
-    conn = get_db_connection()
-    user = conn.execute('SELECT * FROM users WHERE username=? AND password=?',
-                        (data.get('username'), data.get('password'))).fetchone()
-    conn.close()
+    with get_db_connection() as conn:
+        user = conn.execute('SELECT * FROM users WHERE username=? AND password=?',
+                            (data.get('username'), data.get('password'))).fetchone()
     if user: return jsonify({'success': True, 'data': dict(user)})
     return jsonify({'success': False, 'message': '用户名或密码错误'})
 
@@ -393,10 +1757,9 @@ def login():
 @app.route('/api/my_info', methods=['GET'])
 def get_my_info():
     username = request.args.get('username')
-    conn = get_db_connection()
-    user = conn.execute('SELECT username, coins, tickets, current_skin FROM users WHERE username=?',
-                        (username,)).fetchone()
-    conn.close()
+    with get_db_connection() as conn:
+        user = conn.execute('SELECT username, coins, tickets, current_skin FROM users WHERE username=?',
+                            (username,)).fetchone()
     if user: return jsonify({'success': True, 'data': dict(user)})
     return jsonify({'success': False, 'message': '用户未找到'})
 
@@ -407,48 +1770,92 @@ def register():
     username = data.get('username')
     password = data.get('password')
     email = data.get('email')
-    conn = get_db_connection()
-    try:
-        exist = conn.execute('SELECT 1 FROM users WHERE username=? OR email=?', (username, email)).fetchone()
-        if exist: return jsonify({'success': False, 'message': '用户或邮箱已存在'})
-        conn.execute('INSERT INTO users (username, password, email, coins, tickets) VALUES (?, ?, ?, ?, ?)',
-                     (username, password, email, 100, 0))
-        conn.commit()
-        return jsonify({'success': True, 'message': '注册成功'})
-    except Exception as e:
-        return jsonify({'success': False, 'message': str(e)})
-    finally:
-        conn.close()
+    with get_db_connection() as conn:
+        try:
+            exist = conn.execute('SELECT 1 FROM users WHERE username=? OR email=?', (username, email)).fetchone()
+            if exist: return jsonify({'success': False, 'message': '用户或邮箱已存在'})
+            conn.execute('INSERT INTO users (username, password, email, coins, tickets) VALUES (?, ?, ?, ?, ?)',
+                         (username, password, email, 100, 0))
+            version = bump_data_version(conn, 'tickets')
+            conn.commit()
+            rank_index.update(username, 0, version)
+            username_index.add(username)
+            return jsonify({'success': True, 'message': '注册成功'})
+        except Exception as e:
+            return jsonify({'success': False, 'message': str(e)})
 
 
+@app.route('/api/balance/sync', methods=['POST'])
+def sync_balance():
+    """批量提交余额增量 {username, client_id, deltas: [{seq, coins, tickets}]}，返回服务器端权威余额"""
+    data = request.json or {}
+    username = data.get('username')
+    client_id = str(data.get('client_id') or '')[:64]
+    deltas = data.get('deltas') or []
+    if not username or not client_id or not isinstance(deltas, list) or len(deltas) > BALANCE_MAX_DELTAS:
+        return jsonify({'success': False, 'message': '参数错误'}), 400
+    by_seq = {}
+    try:
+        for d in deltas:
+            seq, coins, tickets = int(d['seq']), int(d.get('coins', 0)), int(d.get('tickets', 0))
+            if not 0 < seq <= BALANCE_MAX_SEQ:
+                raise ValueError(seq)
+            if abs(coins) > BALANCE_MAX_DELTA_AMOUNT or abs(tickets) > BALANCE_MAX_DELTA_AMOUNT:
+                raise ValueError(d)
+            by_seq.setdefault(seq, (seq, coins, tickets))
+    except (KeyError, TypeError, ValueError, OverflowError, AttributeError):
+        return jsonify({'success': False, 'message': '增量格式错误'}), 400
+    parsed = sorted(by_seq.values())
+    return jsonify(balance_committer.submit(username, client_id, parsed))
+
+
+# 旧版客户端兼容：整体覆盖余额，新客户端请使用 /api/balance/sync
 @app.route('/api/update', methods=['POST'])
 def update_data():
     data = request.json
-    conn = get_db_connection()
-    conn.execute('UPDATE users SET coins=?, tickets=? WHERE username=?',
-                 (data.get('coins'), data.get('tickets'), data.get('username')))
-    conn.commit()
-    conn.close()
+    with get_db_connection() as conn:
+        conn.execute('UPDATE users SET coins=?, tickets=? WHERE username=?',
+                     (data.get('coins'), data.get('tickets'), data.get('username')))
+        version = bump_data_version(conn, 'tickets')
+        conn.commit()
+    rank_index.update(data.get('username'), data.get('tickets'), version)
     return jsonify({'success': True})
 
 
-@app.route('/api/simple_users', methods=['GET'])
-def get_simple_users():
-    conn = get_db_connection()
-    users = conn.execute('SELECT username FROM users').fetchall()
-    conn.close()
-    return jsonify([u['username'] for u in users])
+def recent_contacts(conn, sender, limit=5):
+    rows = conn.execute(
+        'SELECT receiver, MAX(timestamp) as last_time FROM transfer_logs WHERE sender = ? '
+        'GROUP BY receiver ORDER BY last_time DESC LIMIT ?', (sender, limit)).fetchall()
+    return [r['receiver'] for r in rows]
 
 
 @app.route('/api/recent_contacts', methods=['GET'])
 def get_recent_contacts():
-    sender = request.args.get('username')
-    conn = get_db_connection()
-    rows = conn.execute(
-        'SELECT receiver, MAX(timestamp) as last_time FROM transfer_logs WHERE sender = ? GROUP BY receiver ORDER BY last_time DESC LIMIT 5',
-        (sender,)).fetchall()
-    conn.close()
-    return jsonify([r['receiver'] for r in rows])
+    with get_db_connection() as conn:
+        return jsonify(recent_contacts(conn, request.args.get('username')))
+
+
+@app.route('/api/user_lookup', methods=['GET'])
+def user_lookup():
+    """收款人联想：prefix 为空时只返回最近联系人；否则最近联系人中匹配的排在前面，再补前缀匹配的用户"""
+    username = request.args.get('username')
+    prefix = request.args.get('prefix', '').strip()
+    try:
+        limit = min(max(int(request.args.get('limit', 8)), 1), USER_LOOKUP_MAX_LIMIT)
+    except ValueError:
+        return jsonify({'success': False, 'message': '参数错误'}), 400
+    recent = []
+    if username:
+        with get_db_connection() as conn:
+            recent = [u for u in recent_contacts(conn, username)
+                      if u != username and u.lower().startswith(prefix.lower())][:limit]
+    users = [{'username': u, 'recent': True} for u in recent]
+    if prefix:
+        exclude = set(recent)
+        exclude.add(username)
+        users += [{'username': u, 'recent': False}
+                  for u in username_index.prefix(prefix, limit - len(users), exclude)]
+    return jsonify({'users': users})
 
 
 @app.route('/api/transfer_tickets', methods=['POST'])
@@ -458,24 +1865,27 @@ def transfer_tickets():
     to_user = data.get('to_user')
     amount = int(data.get('amount', 0))
     if amount <= 0: return jsonify({'success': False, 'message': '数额必须大于0'})
-    conn = get_db_connection()
-    try:
-        sender = conn.execute('SELECT tickets FROM users WHERE username=?', (from_user,)).fetchone()
-        if not sender or sender['tickets'] < amount: return jsonify({'success': False, 'message': '积分不足'})
-        if not conn.execute('SELECT 1 FROM users WHERE username=?', (to_user,)).fetchone(): return jsonify(
-            {'success': False, 'message': '接收用户不存在'})
-        conn.execute('UPDATE users SET tickets = tickets - ? WHERE username = ?', (amount, from_user))
-        conn.execute('UPDATE users SET tickets = tickets + ? WHERE username = ?', (amount, to_user))
-        conn.execute('INSERT INTO transfer_logs (sender, receiver, amount) VALUES (?, ?, ?)',
-                     (from_user, to_user, amount))
-        conn.commit()
-        new_tickets = conn.execute('SELECT tickets FROM users WHERE username=?', (from_user,)).fetchone()['tickets']
-        return jsonify({'success': True, 'message': '赠送成功', 'new_tickets': new_tickets})
-    except Exception as e:
-        conn.rollback()
-        return jsonify({'success': False, 'message': str(e)})
-    finally:
-        conn.close()
+    with get_db_connection() as conn:
+        try:
+            sender = conn.execute('SELECT tickets FROM users WHERE username=?', (from_user,)).fetchone()
+            if not sender or sender['tickets'] < amount: return jsonify({'success': False, 'message': '积分不足'})
+            if not conn.execute('SELECT 1 FROM users WHERE username=?', (to_user,)).fetchone(): return jsonify(
+                {'success': False, 'message': '接收用户不存在'})
+            conn.execute('UPDATE users SET tickets = tickets - ? WHERE username = ?', (amount, from_user))
+            conn.execute('UPDATE users SET tickets = tickets + ? WHERE username = ?', (amount, to_user))
+            conn.execute('INSERT INTO transfer_logs (sender, receiver, amount) VALUES (?, ?, ?)',
+                         (from_user, to_user, amount))
+            version = bump_data_version(conn, 'tickets')
+            # 在提交前读取两人的新积分，与版本号属于同一个事务
+            new_tickets = conn.execute('SELECT tickets FROM users WHERE username=?', (from_user,)).fetchone()['tickets']
+            to_tickets = conn.execute('SELECT tickets FROM users WHERE username=?', (to_user,)).fetchone()['tickets']
+            conn.commit()
+            rank_index.update(from_user, new_tickets, version)
+            rank_index.update(to_user, to_tickets, version)
+            return jsonify({'success': True, 'message': '赠送成功', 'new_tickets': new_tickets})
+        except Exception as e:
+            conn.rollback()
+            return jsonify({'success': False, 'message': str(e)})
 
 
 @app.route('/api/exchange_points', methods=['POST'])
@@ -483,157 +1893,327 @@ def exchange_points():
     data = request.json
     username = data.get('username')
     points = int(data.get('points', 0))
-    conn = get_db_connection()
-    try:
-        config_row = conn.execute('SELECT value FROM game_config WHERE key = "exchange_rate"').fetchone()
-        rate = float(config_row['value']) if config_row else 0.1
-        coins = int(points * rate)
-        if coins <= 0: return jsonify({'success': False, 'message': '积分太少'})
-        user = conn.execute('SELECT tickets, coins FROM users WHERE username=?', (username,)).fetchone()
-        if not user or user['tickets'] < points: return jsonify({'success': False, 'message': '积分不足'})
-        conn.execute('UPDATE users SET tickets = tickets - ?, coins = coins + ? WHERE username = ?',
-                     (points, coins, username))
-        conn.commit()
-        new_user = conn.execute('SELECT tickets, coins FROM users WHERE username=?', (username,)).fetchone()
-        return jsonify({'success': True, 'message': '兑换成功', 'new_tickets': new_user['tickets'],
-                        'new_coins': new_user['coins']})
-    except Exception as e:
-        return jsonify({'success': False, 'message': str(e)})
-    finally:
-        conn.close()
+    with get_db_connection() as conn:
+        try:
+            rate = config_cache.get().get_float('exchange_rate', 0.1)
+            coins = int(points * rate)
+            if coins <= 0: return jsonify({'success': False, 'message': '积分太少'})
+            user = conn.execute('SELECT tickets, coins FROM users WHERE username=?', (username,)).fetchone()
+            if not user or user['tickets'] < points: return jsonify({'success': False, 'message': '积分不足'})
+            conn.execute('UPDATE users SET tickets = tickets - ?, coins = coins + ? WHERE username = ?',
+                         (points, coins, username))
+            version = bump_data_version(conn, 'tickets')
+            new_user = conn.execute('SELECT tickets, coins FROM users WHERE username=?', (username,)).fetchone()
+            conn.commit()
+            rank_index.update(username, new_user['tickets'], version)
+            return jsonify({'success': True, 'message': '兑换成功', 'new_tickets': new_user['tickets'],
+                            'new_coins': new_user['coins']})
+        except Exception as e:
+            return jsonify({'success': False, 'message': str(e)})
 
 
 @app.route('/api/gifts', methods=['GET'])
 def get_gifts():
-    conn = get_db_connection()
-    gifts = conn.execute('SELECT * FROM gifts WHERE stock > 0 ORDER BY price ASC').fetchall()
-    conn.close()
+    with get_db_connection() as conn:
+        gifts = conn.execute('SELECT * FROM gifts /* full-scan */ WHERE stock > 0 ORDER BY price ASC').fetchall()
     return jsonify([dict(g) for g in gifts])
 
 
 @app.route('/api/exchange_gift', methods=['POST'])
 def exchange_gift():
     data = request.json
-    username, gift_id = data.get('username'), data.get('gift_id')
-    conn = get_db_connection()
+    username = data.get('username')
     try:
-        user = conn.execute('SELECT tickets FROM users WHERE username=?', (username,)).fetchone()
-        gift = conn.execute('SELECT * FROM gifts WHERE id=?', (gift_id,)).fetchone()
-        if not user or not gift: return jsonify({'success': False, 'message': '错误'})
-        if gift['stock'] <= 0 or user['tickets'] < gift['price']: return jsonify(
-            {'success': False, 'message': '库存或积分不足'})
-        conn.execute('UPDATE gifts SET stock = stock - 1 WHERE id = ?', (gift_id,))
-        conn.execute('UPDATE users SET tickets = tickets - ? WHERE username = ?', (gift['price'], username))
-        conn.execute('INSERT INTO gift_redemptions (user_id, gift_id, gift_name, cost) VALUES (?, ?, ?, ?)',
-                     (username, gift_id, gift['name'], gift['price']))
-        conn.commit()
-        return jsonify({'success': True, 'message': '兑换成功', 'new_tickets': user['tickets'] - gift['price']})
-    except Exception as e:
-        return jsonify({'success': False, 'message': str(e)})
-    finally:
-        conn.close()
+        gift_id = int(data.get('gift_id'))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': '错误'})
+    if gift_flash_sale.enabled_for(gift_id):
+        result = gift_flash_sale.redeem(username, gift_id)
+    else:
+        with get_db_connection() as conn:
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                result = redeem_gift(conn, username, gift_id)
+                version = bump_data_version(conn, 'tickets') if result['success'] else None
+                conn.commit()
+            except Exception as e:
+                return jsonify({'success': False, 'message': str(e)})
+        if result['success']:
+            rank_index.update(username, result['new_tickets'], version)
+    result.pop('reason', None)
+    return jsonify(result)
 
 
 @app.route('/api/my_redemptions', methods=['GET'])
 def my_redemptions():
-    conn = get_db_connection()
-    logs = conn.execute('SELECT * FROM gift_redemptions WHERE user_id=? ORDER BY redeem_time DESC',
-                        (request.args.get('username'),)).fetchall()
-    conn.close()
+    with get_db_connection() as conn:
+        logs = conn.execute('SELECT * FROM gift_redemptions WHERE user_id=? ORDER BY redeem_time DESC',
+                            (request.args.get('username'),)).fetchall()
     return jsonify([dict(l) for l in logs])
 
 
+# --- 兑换码 ---
+
+CODE_ALPHABET = 'ABCDEFGHJKLMNPQRSTUVWXYZ23456789'  # 去掉易混淆的 0/O/1/I
+CODE_RANDOM_LENGTH = 10
+CODE_MAX_BULK = 100000
+CODE_INSERT_CHUNK = 1000
+CODE_EXPORT_CHUNK = 1000
+CODE_LIST_LIMIT = 200
+CODE_EXPORT_COLUMNS = ['code', 'reward_amount', 'current_uses', 'max_uses', 'target_user', 'expires_at',
+                       'last_used_time', 'batch_id']
+CODE_EXPORT_BATCH_SQL = (f"SELECT {', '.join(CODE_EXPORT_COLUMNS)} FROM redeem_codes "
+                         'WHERE batch_id = ? AND code > ? ORDER BY code LIMIT ?')
+CODE_EXPORT_ALL_SQL = f"SELECT {', '.join(CODE_EXPORT_COLUMNS)} FROM redeem_codes WHERE code > ? ORDER BY code LIMIT ?"
+
+
+def generate_codes(prefix, count):
+    return {prefix + ''.join(secrets.choice(CODE_ALPHABET) for _ in range(CODE_RANDOM_LENGTH)) for _ in range(count)}
+
+
+def insert_code_batch(conn, prefix, count, reward_amount, max_uses, target_user, expires_at, batch_id):
+    """在调用方的事务中批量插入 count 个随机码，撞码的部分重新生成补齐"""
+    inserted = 0
+    while inserted < count:
+        codes = sorted(generate_codes(prefix, count - inserted))
+        for i in range(0, len(codes), CODE_INSERT_CHUNK):
+            before = conn.total_changes
+            conn.executemany('INSERT OR IGNORE INTO redeem_codes '
+                             '(code, max_uses, target_user, reward_amount, batch_id, expires_at) '
+                             'VALUES (?, ?, ?, ?, ?, ?)',
+                             [(code, max_uses, target_user, reward_amount, batch_id, expires_at)
+                              for code in codes[i:i + CODE_INSERT_CHUNK]])
+            inserted += conn.total_changes - before
+    return inserted
+
+
+def claim_code(conn, code, username, now):
+    """在调用方的 BEGIN IMMEDIATE 事务中原子领取：次数/专属用户/有效期都在同一条条件 UPDATE 里判断。
+    成功返回奖励金币数，否则返回 None"""
+    cur = conn.execute('UPDATE redeem_codes SET current_uses = current_uses + 1, last_used_time = ? '
+                       'WHERE code = ? AND current_uses < max_uses '
+                       "AND (target_user IS NULL OR target_user = '' OR target_user = ?) "
+                       'AND (expires_at IS NULL OR expires_at > ?)', (now, code, username, now))
+    if cur.rowcount == 0:
+        return None
+    return conn.execute('SELECT reward_amount FROM redeem_codes WHERE code = ?', (code,)).fetchone()['reward_amount']
+
+
 @app.route('/api/redeem', methods=['POST'])
 def redeem_code():
     data = request.json
     username, code = data.get('username'), data.get('code')
-    conn = get_db_connection()
-    try:
-        c = conn.execute('SELECT * FROM redeem_codes WHERE code=?', (code,)).fetchone()
-        if not c or c['current_uses'] >= c['max_uses'] or (c['target_user'] and c['target_user'] != username):
-            return jsonify({'success': False, 'message': '无效或已过期的兑换码'})
-        amt = c['reward_amount'] or 100
-        conn.execute('UPDATE redeem_codes SET current_uses=current_uses+1, last_used_time=? WHERE code=?',
-                     (datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), code))
-        conn.execute('UPDATE users SET coins=coins+? WHERE username=?', (amt, username))
-        conn.commit()
-        new_coins = conn.execute('SELECT coins FROM users WHERE username=?', (username,)).fetchone()['coins']
-        return jsonify({'success': True, 'message': f'成功! +{amt}金币', 'new_coins': new_coins})
-    except Exception as e:
-        return jsonify({'success': False, 'message': str(e)})
-    finally:
-        conn.close()
+    with get_db_connection() as conn:
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            amt = claim_code(conn, code, username, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            if amt is None:
+                return jsonify({'success': False, 'message': '无效或已过期的兑换码'})
+            amt = amt or 100
+            if conn.execute('UPDATE users SET coins=coins+? WHERE username=?', (amt, username)).rowcount == 0:
+                conn.rollback()
+                return jsonify({'success': False, 'message': '用户未找到'})
+            new_coins = conn.execute('SELECT coins FROM users WHERE username=?', (username,)).fetchone()['coins']
+            conn.commit()
+            return jsonify({'success': True, 'message': f'成功! +{amt}金币', 'new_coins': new_coins})
+        except Exception as e:
+            return jsonify({'success': False, 'message': str(e)})
 
 
 @app.route('/api/leaderboard', methods=['GET'])
 def leaderboard():
-    conn = get_db_connection()
-    top = conn.execute('SELECT username, tickets FROM users ORDER BY tickets DESC LIMIT 10').fetchall()
+    """排行榜：limit/cursor 分页，username 返回本人名次，around=N 额外返回本人前后 N 名"""
     my_u = request.args.get('username')
-    my_rank, my_tickets = 0, 0
+    try:
+        limit = min(max(int(request.args.get('limit', 10)), 1), LEADERBOARD_MAX_LIMIT)
+        radius = min(max(int(request.args.get('around', 0)), 0), LEADERBOARD_MAX_LIMIT)
+        cursor = decode_rank_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    except ValueError:
+        return jsonify({'success': False, 'message': '参数错误'}), 400
+    top, next_cursor = rank_index.page(limit, cursor)
+    result = {'leaderboard': top, 'next_cursor': next_cursor, 'my_rank': 0, 'my_tickets': 0}
     if my_u:
-        u = conn.execute('SELECT tickets FROM users WHERE username=?', (my_u,)).fetchone()
-        if u:
-            my_tickets = u['tickets']
-            my_rank = conn.execute('SELECT COUNT(*) as c FROM users WHERE tickets > ?', (my_tickets,)).fetchone()[
-                          'c'] + 1
-    conn.close()
-    return jsonify({'leaderboard': [dict(u) for u in top], 'my_rank': my_rank, 'my_tickets': my_tickets})
+        mine = rank_index.rank_of(my_u)
+        if mine:
+            result['my_rank'], result['my_tickets'] = mine
+        if radius:
+            result['neighbors'] = rank_index.around(my_u, radius)
+    return jsonify(result)
 
 
 # --- AI Voice & Audio Proxy API ---
 
+AUDIO_IMMUTABLE_MAX_AGE = 365 * 24 * 3600  # tts_<hash> 文件内容不会变化，可长期缓存
+AUDIO_DEFAULT_MAX_AGE = 300
+
+
+class AudioStats:
+    """音频接口的命中/未命中计数，供 /api/admin/audio_stats 查看"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = collections.Counter()
+
+    def incr(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+audio_stats = AudioStats()
+
+
 @app.route('/api/audio/<path:filename>')
 def serve_tts_audio(filename):
-    conn = get_db_connection()
-    config_row = conn.execute('SELECT value FROM game_config WHERE key = "tts_audio_local_path"').fetchone()
-    conn.close()
-    if not config_row or not config_row['value']:
+    """目录取自配置缓存；send_file 负责 Range(206)/条件请求(304)，并在 WSGI 服务器支持时走 sendfile"""
+    directory = config_cache.get().get('tts_audio_local_path')
+    if not directory:
         print("[AUDIO PROXY] ERROR: TTS audio local path not configured in database.")
         return "TTS audio path not configured", 404
 
-    directory = config_row['value']
-
     # Basic security check to prevent directory traversal.
     if '..' in filename or filename.startswith('/'):
         print(f"[AUDIO PROXY] ERROR: Invalid filename requested (directory traversal attempt): {filename}")
         return "Invalid filename", 400
 
-    print(f"[AUDIO PROXY] Attempting to serve file. Directory: '{directory}', Filename: '{filename}'")
-    full_path = os.path.join(directory, filename)
-    print(f"[AUDIO PROXY] Full path: '{full_path}'")
-
-    if not os.path.exists(full_path):
-        print(f"[AUDIO PROXY] ERROR: File not found at path: {full_path}")
-        return "Audio file not found.", 404
-
+    immutable = os.path.basename(filename).startswith(TTS_CACHE_PREFIX)
     try:
-        return send_from_directory(directory, filename, as_attachment=False)
+        response = send_from_directory(directory, filename, as_attachment=False, conditional=True,
+                                       max_age=AUDIO_IMMUTABLE_MAX_AGE if immutable else AUDIO_DEFAULT_MAX_AGE)
+    except NotFound:
+        audio_stats.incr('miss')
+        return "Audio file not found.", 404
     except Exception as e:
+        audio_stats.incr('error')
         print(f"[AUDIO PROXY] ERROR: Failed to send file. Error: {e}")
         return "Error sending file.", 500
 
-
-@app.route('/api/ai_text_line', methods=['POST'])
-def get_ai_text_line():
-    print("\n--- [AI TEXT] Request Initiated ---")
-    conn = get_db_connection()
-    configs = {row['key']: row['value'] for row in conn.execute('SELECT key, value FROM game_config').fetchall()}
-    conn.close()
-
-    ai_enabled_str = configs.get('ai_voice_enabled', 'false')
-    if ai_enabled_str.lower() != 'true':
-        return jsonify({'success': False, 'message': 'AI feature is disabled.'})
-
-    data = request.json
-    OPENAI_API_ENDPOINT = configs.get('openai_api_endpoint')
-    OPENAI_API_KEY = configs.get('openai_api_key')
-    AI_MAX_TOKENS = int(configs.get('ai_max_tokens', 60))
-
-    if not all([OPENAI_API_ENDPOINT, OPENAI_API_KEY]):
-        return jsonify({'success': False, 'message': 'AI service is not configured.'}), 500
-
-    system_prompt = f"""
+    audio_stats.incr('hit')
+    audio_stats.incr({206: 'partial', 304: 'not_modified'}.get(response.status_code, 'full'))
+    response.cache_control.public = True
+    if immutable:
+        response.cache_control.immutable = True
+    return response
+
+
+# --- 上游 HTTP 客户端 (LLM / TTS) ---
+
+UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', 16))  # 每个上游的 keep-alive 连接数
+UPSTREAM_RETRIES = int(os.environ.get('UPSTREAM_RETRIES', 1))
+UPSTREAM_RETRY_BASE_DELAY = 0.2      # 秒，指数退避基数，实际等待为 [0, base * 2^n] 的随机值
+UPSTREAM_RETRY_STATUS = {502, 503, 504}
+BREAKER_WINDOW = 30                  # 秒，统计错误率的时间窗口
+BREAKER_MIN_CALLS = 5                # 窗口内至少这么多次调用才会触发熔断
+BREAKER_FAILURE_RATIO = 0.5
+BREAKER_COOLDOWN = 15                # 秒，熔断后多久放一个探测请求
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """按时间窗口错误率熔断：打开期间直接快速失败，冷却后放行一个探测请求(半开)"""
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._results = collections.deque()
+        self._opened_at = None
+        self._probing = False
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if not self._probing and time.monotonic() - self._opened_at >= BREAKER_COOLDOWN:
+                self._probing = True
+                return True
+            return False
+
+    def record(self, ok):
+        now = time.monotonic()
+        with self._lock:
+            if self._probing:
+                self._probing = False
+                if ok:
+                    self._opened_at = None
+                    self._results.clear()
+                else:
+                    self._opened_at = now
+                return
+            self._results.append((now, ok))
+            while self._results and now - self._results[0][0] > BREAKER_WINDOW:
+                self._results.popleft()
+            failures = sum(1 for _, result in self._results if not result)
+            if (self._opened_at is None and len(self._results) >= BREAKER_MIN_CALLS
+                    and failures / len(self._results) >= BREAKER_FAILURE_RATIO):
+                self._opened_at = now
+                print(f"[UPSTREAM] Circuit for {self.name} opened ({failures}/{len(self._results)} failed)")
+
+
+class UpstreamClient:
+    """单个上游的 keep-alive 连接池 + 抖动重试 + 熔断"""
+
+    def __init__(self, name, pool_size=UPSTREAM_POOL_SIZE, retries=UPSTREAM_RETRIES):
+        self.name = name
+        self.pool_size = pool_size
+        self.retries = retries
+        self.breaker = CircuitBreaker(name)
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_session(self):
+        # Session 的连接不能跨 fork 共享，按进程懒创建
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size,
+                                                            max_retries=0)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session = session
+                    self._pid = os.getpid()
+        return self._session
+
+    def post(self, url, **kwargs):
+        if not self.breaker.allow():
+            raise CircuitOpenError(f'{self.name} upstream is unavailable (circuit open)')
+        session = self._get_session()
+        ok = False
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    response = session.post(url, **kwargs)
+                    if response.status_code in UPSTREAM_RETRY_STATUS and attempt < self.retries:
+                        raise requests.exceptions.HTTPError(f'{response.status_code} from {self.name}')
+                    response.raise_for_status()
+                except requests.exceptions.RequestException as e:
+                    if isinstance(e, requests.exceptions.HTTPError):
+                        retryable = e.response is None or e.response.status_code in UPSTREAM_RETRY_STATUS
+                    else:
+                        retryable = isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+                    if attempt < self.retries and retryable:
+                        time.sleep(random.uniform(0, UPSTREAM_RETRY_BASE_DELAY * 2 ** attempt))
+                        continue
+                    raise
+                ok = True
+                return response
+        finally:
+            # 任何出口 (包括非网络类异常) 都要记录结果，否则半开探测一直占着，熔断永远不会关闭
+            self.breaker.record(ok)
+
+
+llm_client = UpstreamClient('llm')
+tts_client = UpstreamClient('tts')
+
+
+AI_SYSTEM_PROMPT = """
 你是一个轻松幽默的游戏搭子，你的名字叫“弹珠精灵”。你正在和一个玩家互动，他刚刚玩完一局“七彩弹珠”游戏。
 你的任务是根据玩家当前的游戏状态、本局游戏事件，并结合最近的整体游戏历史，给出一句简短的、口语化的互动评论。
 请优先分析“本局事件”，如果本局事件足够精彩（汇总这一局的信息，比如中大奖、踩炸弹、中转盘、损失大量金币、赢大量金币、遇到特殊事件），就优先评论本局。
@@ -645,191 +2225,1715 @@ def get_ai_text_line():
 - **禁止**：不要说教，不要提出具体游戏建议，不要暴露你是AI，不要包含任何表情符号或特殊符号。
 - **输出**：直接输出评论文本。
 """
-    user_prompt = f"""
-    - 我的状态：{data.get('coins')}个金币，{data.get('tickets')}张奖票。
-    - 本局地图：{data.get('map')}。
-    - 本局结果：{'赢了' if data.get('win') else '输了'}。
-    - 本局事件: {', '.join([f"{h.get('timestamp', '')}:{h.get('message', '')}" for h in json.loads(data.get('history', '[]'))])}
-    - 历史事件: {', '.join([f"{h.get('timestamp', '')}:{h.get('message', '')}" for h in json.loads(data.get('full_history', '[]'))])}
-    快，说点什么！
-    """
+AI_MODEL = "gemini-2.5-flash-nothinking"
+AI_TIMEOUT = 20
+TTS_TIMEOUT = 10
+TTS_VOICE_PARAMS = {"rate": "0%", "pitch": "0Hz", "volume": "0%"}
+
+
+def parse_history(history_str):
+    try:
+        history = json.loads(history_str or '[]')
+    except (json.JSONDecodeError, TypeError):
+        return []
+    return [h for h in history if isinstance(h, dict)] if isinstance(history, list) else []
+
+
+# --- 玩家回合历史与提示词构建 ---
+
+AI_HISTORY_ROUNDS = 30          # 每个玩家在服务器端保留的最近回合数 (环形缓冲)
+AI_ROUND_MAX_EVENTS = 30        # 单局最多保存/发送的事件条数
+AI_BIG_WIN_COINS = 50           # 单局中奖金币达到该值视为大奖
+AI_EVENT_KEYWORDS = (('bomb', '踩炸弹', '炸弹'), ('wheel', '中转盘', '转盘'), ('egg', '砸金蛋', '金蛋'))
+
+
+def history_messages(history):
+    return [str(h.get('message', '')) for h in history][:AI_ROUND_MAX_EVENTS]
+
+
+def round_win_coins(messages):
+    total = 0
+    for message in messages:
+        if message.startswith('中奖!'):
+            match = re.search(r'\+(\d+)金币', message)
+            if match:
+                total += int(match.group(1))
+    return total
+
+
+def round_flags(messages):
+    return {name: any(keyword in m for m in messages) for name, _, keyword in AI_EVENT_KEYWORDS}
+
+
+def estimate_tokens(text):
+    """粗略估算 token 数：中日韩字符按 1 个计，其余按每 4 字符 1 个计"""
+    cjk = sum(1 for ch in text if '\u2e80' <= ch <= '\u9fff' or '\uff00' <= ch <= '\uffef')
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def compress_events(messages):
+    """合并重复事件并保持首次出现顺序，如两条“碰到临时金币”合并为“碰到临时金币x2”"""
+    counts = collections.Counter(messages)
+    return [f'{m}x{counts[m]}' if counts[m] > 1 else m for m in dict.fromkeys(messages) if m]
+
+
+def record_player_round(username, data, messages):
+    """把本局写入玩家的回合环形缓冲，返回最近的回合（旧→新）；同一局重复上报只记一次"""
+    round_key = hashlib.sha1(json.dumps([data.get('history'), data.get('map'), bool(data.get('win')),
+                                         data.get('coins'), data.get('tickets')],
+                                        ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+    with get_db_connection() as conn:
+        conn.execute('INSERT OR IGNORE INTO player_rounds (username, round_key, map, win, coins, tickets, events) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (username, round_key, str(data.get('map') or ''), 1 if data.get('win') else 0,
+                      data.get('coins'), data.get('tickets'), json.dumps(messages, ensure_ascii=False)))
+        conn.execute('DELETE FROM player_rounds WHERE username = ? AND id <= '
+                     '(SELECT id FROM player_rounds WHERE username = ? ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                     (username, username, AI_HISTORY_ROUNDS))
+        conn.commit()
+        rows = conn.execute('SELECT map, win, coins, tickets, events FROM player_rounds '
+                            'WHERE username = ? ORDER BY id DESC LIMIT ?',
+                            (username, AI_HISTORY_ROUNDS)).fetchall()
+    rounds = []
+    for row in reversed(rows):
+        item = dict(row)
+        try:
+            item['events'] = json.loads(row['events'] or '[]')
+        except json.JSONDecodeError:
+            item['events'] = []
+        rounds.append(item)
+    return rounds
+
+
+def current_streak(rounds):
+    """返回 (最近一局是否赢, 连续相同结果的局数)"""
+    if not rounds:
+        return False, 0
+    last_win = bool(rounds[-1]['win'])
+    streak = 0
+    for r in reversed(rounds):
+        if bool(r['win']) != last_win:
+            break
+        streak += 1
+    return last_win, streak
+
+
+def summarize_rounds(rounds):
+    """把最近回合压缩成计数/连胜连败等短句，按重要程度排序"""
+    if not rounds:
+        return []
+    lines = []
+    last_win, streak = current_streak(rounds)
+    if streak >= 2:
+        lines.append(f"已经{'连赢' if last_win else '连输'}{streak}局")
+    recent = rounds[-5:]
+    for name, label, _ in AI_EVENT_KEYWORDS:
+        count = sum(1 for r in recent if round_flags(r['events'])[name])
+        if count:
+            lines.append(f"最近{len(recent)}局{label}{count}次")
+    big_wins = sum(1 for r in recent if round_win_coins(r['events']) >= AI_BIG_WIN_COINS)
+    if big_wins:
+        lines.append(f"最近{len(recent)}局中大奖{big_wins}次")
+    wins = sum(1 for r in rounds if r['win'])
+    lines.append(f"最近{len(rounds)}局赢{wins}局输{len(rounds) - wins}局")
+    first_coins, last_coins = rounds[0].get('coins'), rounds[-1].get('coins')
+    if len(rounds) > 1 and isinstance(first_coins, int) and isinstance(last_coins, int):
+        lines.append(f"这{len(rounds)}局金币{last_coins - first_coins:+d}")
+    return lines
+
+
+def build_ai_user_prompt(data, rounds=None, budget=400):
+    """在 token 预算内拼装用户提示词：状态和结果必带，其次本局事件，最后是历史摘要。
+    rounds 为服务器端记录的回合；旧客户端未带 username 时退回使用其上报的 full_history。"""
+    messages = history_messages(parse_history(data.get('history')))
+    if rounds is not None:
+        history_lines = summarize_rounds(rounds)
+    else:
+        history_lines = compress_events(history_messages(parse_history(data.get('full_history'))))
+    lines = [
+        f"- 我的状态：{data.get('coins')}个金币，{data.get('tickets')}张奖票。",
+        f"- 本局地图：{data.get('map')}。",
+        f"- 本局结果：{'赢了' if data.get('win') else '输了'}。",
+    ]
+    tail = "快，说点什么！"
+    used = estimate_tokens(''.join(lines) + tail)
+
+    events = compress_events(messages)
+    while events and used + estimate_tokens(f"- 本局事件: {', '.join(events)}") > budget:
+        events.pop()
+    if events:
+        lines.append(f"- 本局事件: {', '.join(events)}")
+        used += estimate_tokens(lines[-1])
+
+    kept = []
+    for line in history_lines:
+        cost = estimate_tokens(line) + 1
+        if used + cost + 4 > budget:
+            break
+        kept.append(line)
+        used += cost
+    if kept:
+        lines.append(f"- 历史事件: {'，'.join(kept)}")
+    lines.append(tail)
+    return '\n'.join(lines)
+
+
+def prepare_ai_prompt(data):
+    """记录本局到玩家历史并构建受预算约束的提示词，供各 AI 接口共用；返回 (提示词, 最近回合)"""
+    budget = config_cache.get().get_int('ai_prompt_token_budget', 400)
+    username = data.get('username')
+    rounds = None
+    if username:
+        try:
+            rounds = record_player_round(username, data, history_messages(parse_history(data.get('history'))))
+        except sqlite3.Error as e:
+            print(f"[AI] ERROR recording round for {username}: {e}")
+    return build_ai_user_prompt(data, rounds, budget), rounds
+
+
+def build_ai_request(configs, user_prompt, stream=False):
+    """构造 OpenAI 兼容接口的请求体和请求头"""
+    ai_payload = {
+        "model": AI_MODEL,
+        "messages": [
+            {"role": "system", "content": AI_SYSTEM_PROMPT},
+            {"role": "user", "content": user_prompt}
+        ],
+        "max_tokens": int(configs.get('ai_max_tokens', 60)),
+        "temperature": 0.8,
+    }
+    if stream:
+        ai_payload["stream"] = True
+    headers = {
+        "Authorization": f"Bearer {configs.get('openai_api_key')}",
+        "Content-Type": "application/json"
+    }
+    return ai_payload, headers
 
+
+def request_ai_text(configs, user_prompt, log_tag='[AI]'):
+    """调用 OpenAI 兼容接口生成一句评论，失败时抛出异常"""
+    ai_payload, headers = build_ai_request(configs, user_prompt)
+    print(f"{log_tag} Calling AI API at {configs.get('openai_api_endpoint')}")
+    ai_response = llm_client.post(configs.get('openai_api_endpoint'), json=ai_payload, headers=headers,
+                                  timeout=AI_TIMEOUT)
+    ai_result = ai_response.json()
+    return ai_result['choices'][0]['message']['content'].strip()
+
+
+def stream_ai_text(configs, user_prompt, log_tag='[AI STREAM]'):
+    """以 stream=True 调用 OpenAI 兼容接口，逐段产出文本；生成器被关闭时同时关闭上游连接"""
+    ai_payload, headers = build_ai_request(configs, user_prompt, stream=True)
+    print(f"{log_tag} Calling AI API at {configs.get('openai_api_endpoint')}")
+    ai_response = llm_client.post(configs.get('openai_api_endpoint'), json=ai_payload, headers=headers,
+                                  timeout=AI_TIMEOUT, stream=True)
     try:
-        ai_payload = {
-            "model": "gemini-2.5-flash-nothinking",
-            "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}],
-            "max_tokens": AI_MAX_TOKENS, "temperature": 0.8,
-        }
-        print(f"[AI TEXT] request: {ai_payload}")
-        headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"}
-        ai_response = requests.post(OPENAI_API_ENDPOINT, json=ai_payload, headers=headers, timeout=20)
-        ai_response.raise_for_status()
-        ai_result = ai_response.json()
-        ai_text = ai_result['choices'][0]['message']['content'].strip()
+        for line in ai_response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith('data:'):
+                continue
+            chunk = line[len('data:'):].strip()
+            if chunk == '[DONE]':
+                break
+            try:
+                choices = json.loads(chunk).get('choices') or [{}]
+            except json.JSONDecodeError:
+                continue
+            piece = (choices[0].get('delta') or {}).get('content')
+            if piece:
+                yield piece
+    finally:
+        ai_response.close()
+
+
+def request_tts_audio(configs, text, log_tag='[AI VOICE]'):
+    """调用 TTS 服务合成语音，返回音频文件名（不含目录），失败时抛出异常或返回 None"""
+    tts_payload = {
+        "text": text,
+        "voice": configs.get('tts_voice_name'),
+        **TTS_VOICE_PARAMS
+    }
+    print(f"{log_tag} Calling TTS API at {configs.get('tts_api_endpoint')} with payload: {tts_payload}")
+    tts_response = tts_client.post(configs.get('tts_api_endpoint'), json=tts_payload, timeout=TTS_TIMEOUT)
+    tts_result = tts_response.json()
+    print(f"{log_tag} TTS API Response: {tts_result}")
+    if tts_result.get("success"):
+        relative_audio_path = tts_result.get("data", {}).get("file")
+        if relative_audio_path:
+            # Ensure we only have the filename, not a full path
+            return os.path.basename(relative_audio_path)
+    return None
+
+
+# --- TTS 音频缓存 ---
+
+TTS_CACHE_PREFIX = 'tts_'
+TTS_CACHE_SWEEP_INTERVAL = 60   # 秒，后台清理线程的运行间隔
+
+
+def tts_cache_key(text, voice, params):
+    raw = json.dumps([text, voice, params.get('rate'), params.get('pitch'), params.get('volume')],
+                     ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()[:40]
+
+
+class TtsAudioCache:
+    """按 (text, voice, rate, pitch, volume) 哈希命名的磁盘音频缓存。
+    命中时刷新 mtime 作为 LRU 依据；超龄/超容量的清理由后台线程完成，不在请求路径上。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = {}  # key -> 文件名
+        self._sweeper = None
+        self._pid = None
+
+    def _ensure_sweeper(self):
+        if self._sweeper is not None and self._pid == os.getpid() and self._sweeper.is_alive():
+            return
+        with self._lock:
+            if self._sweeper is None or self._pid != os.getpid() or not self._sweeper.is_alive():
+                self._pid = os.getpid()
+                self._sweeper = threading.Thread(target=self._sweep_loop, name='tts-cache-sweeper', daemon=True)
+                self._sweeper.start()
+
+    def lookup(self, directory, key):
+        """未配置本地目录时不缓存，总是返回 None"""
+        if not directory:
+            return None
+        self._ensure_sweeper()
+        filename = self._index.get(key)
+        if not filename:
+            return None
+        path = os.path.join(directory, filename)
+        try:
+            os.utime(path)
+        except OSError:
+            self._index.pop(key, None)
+            return None
+        return filename
+
+    def store(self, directory, key, produced_name):
+        """把 TTS 服务生成的文件改名为内容寻址的文件名；源文件不在本机或未配置本地目录时原样返回"""
+        if not directory:
+            return produced_name
+        ext = os.path.splitext(produced_name)[1] or '.mp3'
+        filename = f'{TTS_CACHE_PREFIX}{key}{ext}'
+        try:
+            os.replace(os.path.join(directory, produced_name), os.path.join(directory, filename))
+        except OSError as e:
+            print(f"[TTS CACHE] Could not adopt {produced_name}: {e}")
+            return produced_name
+        self._index[key] = filename
+        return filename
+
+    def _sweep_loop(self):
+        while True:
+            try:
+                snapshot = config_cache.get()
+                directory = snapshot.get('tts_audio_local_path')
+                if directory and os.path.isdir(directory):
+                    self.sweep(directory, snapshot.get_float('tts_cache_max_mb', 200) * 1024 * 1024,
+                               snapshot.get_float('tts_cache_max_age_hours', 72) * 3600)
+            except Exception as e:
+                print(f"[TTS CACHE] ERROR during sweep: {e}")
+            time.sleep(TTS_CACHE_SWEEP_INTERVAL)
+
+    def sweep(self, directory, max_bytes, max_age):
+        """删除超龄文件，再按 mtime 从旧到新淘汰直到总大小不超过上限，并重建索引。
+        只处理本缓存命名的文件 (TTS_CACHE_PREFIX 开头)，目录中的其他文件不动"""
+        now = time.time()
+        entries = []
+        for entry in os.scandir(directory):
+            if not entry.name.startswith(TTS_CACHE_PREFIX) or not entry.is_file():
+                continue
+            st = entry.stat()
+            if now - st.st_mtime > max_age:
+                try:
+                    os.unlink(entry.path)
+                except OSError:
+                    pass
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.name))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        while entries and total > max_bytes:
+            _, size, name = entries.pop(0)
+            try:
+                os.unlink(os.path.join(directory, name))
+            except OSError:
+                pass
+            total -= size
+        self._index = {os.path.splitext(name)[0][len(TTS_CACHE_PREFIX):]: name for _, _, name in entries}
+
+
+tts_audio_cache = TtsAudioCache()
+
+
+def get_tts_audio(configs, text, log_tag='[AI VOICE]'):
+    """返回合成好的音频文件名：先查内容寻址缓存，未命中再调用 TTS 并写入缓存"""
+    directory = configs.get('tts_audio_local_path')
+    key = tts_cache_key(text, configs.get('tts_voice_name'), TTS_VOICE_PARAMS)
+    cached = tts_audio_cache.lookup(directory, key)
+    if cached:
+        print(f"{log_tag} TTS cache hit: {cached}")
+        return cached
+    produced = request_tts_audio(configs, text, log_tag)
+    if not produced:
+        return None
+    return tts_audio_cache.store(directory, key, produced)
+
+
+# --- 弹珠精灵评论缓存 ---
+
+class ProcessLocalExecutor:
+    """按进程懒创建的线程池；线程池不会跨 fork 存活"""
+
+    def __init__(self, max_workers, name):
+        self.max_workers = max_workers
+        self.name = name
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def get(self):
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                        thread_name_prefix=self.name)
+                    self._pid = os.getpid()
+        return self._executor
+
+
+AI_LINE_CACHE_MAX_SIGNATURES = 512
+AI_LINE_REFILL_WORKERS = 2
+AI_BALANCE_BUCKETS = (0, 50, 200, 1000, 5000)
+
+
+def commentary_signature(data):
+    """把一局的请求归一化为事件签名：地图、输赢、关键事件、奖金档位、余额档位"""
+    messages = history_messages(parse_history(data.get('history')))
+    flags = round_flags(messages)
+    win_coins = round_win_coins(messages)
+    try:
+        coins = int(data.get('coins') or 0)
+    except (TypeError, ValueError):
+        coins = 0
+    return (
+        str(data.get('map') or ''),
+        bool(data.get('win')),
+        flags['bomb'],
+        flags['wheel'],
+        flags['egg'],
+        'big' if win_coins >= AI_BIG_WIN_COINS else ('small' if win_coins > 0 else 'none'),
+        bisect.bisect_right(AI_BALANCE_BUCKETS, coins),
+    )
+
+
+class CommentaryCache:
+    """按事件签名缓存一小池 LLM 评论（TTL + LRU），命中时随机取一句，池子不满时后台异步补充"""
+
+    def __init__(self, max_signatures=AI_LINE_CACHE_MAX_SIGNATURES):
+        self.max_signatures = max_signatures
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # signature -> {'lines', 'expires_at', 'refilling'}
+        self._executor = ProcessLocalExecutor(AI_LINE_REFILL_WORKERS, 'ai-refill')
+
+    def get(self, signature):
+        with self._lock:
+            entry = self._entries.get(signature)
+            if entry is None:
+                return None
+            if time.monotonic() > entry['expires_at']:
+                del self._entries[signature]
+                return None
+            self._entries.move_to_end(signature)
+            return random.choice(entry['lines'])
+
+    def add(self, signature, line, ttl, pool_size):
+        with self._lock:
+            entry = self._entries.get(signature)
+            if entry is None or time.monotonic() > entry['expires_at']:
+                entry = {'lines': [], 'expires_at': time.monotonic() + ttl, 'refilling': False}
+                self._entries[signature] = entry
+            if line not in entry['lines']:
+                entry['lines'].append(line)
+                del entry['lines'][:-pool_size]
+            self._entries.move_to_end(signature)
+            while len(self._entries) > self.max_signatures:
+                self._entries.popitem(last=False)
+
+    def refill_async(self, signature, configs, user_prompt, ttl, pool_size):
+        """池子未满且没有在补充时，提交一次后台 LLM 调用"""
+        with self._lock:
+            entry = self._entries.get(signature)
+            if entry is None or entry['refilling'] or len(entry['lines']) >= pool_size:
+                return
+            entry['refilling'] = True
+        self._executor.get().submit(self._refill, signature, configs, user_prompt, ttl, pool_size)
+
+    def _refill(self, signature, configs, user_prompt, ttl, pool_size):
+        try:
+            line = request_ai_text(configs, user_prompt, '[AI REFILL]')
+            if line:
+                self.add(signature, line, ttl, pool_size)
+        except Exception as e:
+            print(f"[AI REFILL] ERROR: {e}")
+        finally:
+            with self._lock:
+                entry = self._entries.get(signature)
+                if entry is not None:
+                    entry['refilling'] = False
+
+
+commentary_cache = CommentaryCache()
+
+
+def commentary_cache_settings():
+    """返回 (每个签名的评论池大小, TTL 秒)，任一为 0 表示关闭缓存"""
+    snapshot = config_cache.get()
+    return snapshot.get_int('ai_line_pool_size', 5), snapshot.get_int('ai_line_cache_ttl', 600)
+
+
+# --- 本地评论引擎 (LLM 超时兜底) ---
+
+AI_HEDGE_WORKERS = 4
+AI_HEDGE_MAX_INFLIGHT = 16      # 后台仍在等待的 LLM 调用超过该数时直接用本地评论，不再排队
+
+LOCAL_LINES = {
+    'bomb': ['砰！炸弹可不是金币哦，下局绕着走！', '哎呀踩雷了，{map}的炸弹太阴险了！', '炸弹一响，金币泡汤，再来一局！'],
+    'big_win': ['哇！一口气{win_coins}金币，今天手气爆棚！', '大奖到手！{win_coins}金币，快去换奖票吧！', '这一局赚翻了，弹珠之神附体！'],
+    'wheel': ['转盘转呀转，好运跟着转！', '中了转盘，看来今天运气不赖！', '转盘都被你转到了，厉害！'],
+    'egg': ['金蛋砸开啦，里面藏着惊喜！', '砸金蛋成功，手感正热！', '一锤下去金蛋开花，漂亮！'],
+    'win_streak': ['已经连赢{streak}局了，势不可挡！', '连胜{streak}局，{map}已经被你摸透了！', '{streak}连胜！见好就收还是乘胜追击？'],
+    'lose_streak': ['连输{streak}局别灰心，下一颗弹珠就是转机！', '{streak}局没中了，换个地图转转运？', '低谷过后就是高潮，坚持住！'],
+    'win': ['中了！这颗弹珠走位真漂亮！', '赢啦，{coins}个金币在向你招手！', '不错不错，这局稳稳拿下！'],
+    'lose': ['差一点点，下局一定行！', '弹珠不听话，再来一颗试试！', '这局运气欠佳，手感马上回来！'],
+}
+
+
+def local_commentary(data, rounds=None):
+    """按本局关键事件挑一句模板评论：炸弹 > 大奖 > 转盘 > 金蛋 > 连胜/连败 > 普通输赢"""
+    messages = history_messages(parse_history(data.get('history')))
+    flags = round_flags(messages)
+    win_coins = round_win_coins(messages)
+    last_win, streak = current_streak(rounds) if rounds else (bool(data.get('win')), 1)
+    if flags['bomb']:
+        key = 'bomb'
+    elif win_coins >= AI_BIG_WIN_COINS:
+        key = 'big_win'
+    elif flags['wheel']:
+        key = 'wheel'
+    elif flags['egg']:
+        key = 'egg'
+    elif streak >= 3:
+        key = 'win_streak' if last_win else 'lose_streak'
+    else:
+        key = 'win' if data.get('win') else 'lose'
+    return random.choice(LOCAL_LINES[key]).format(map=data.get('map') or '这张图', coins=data.get('coins'),
+                                                  win_coins=win_coins, streak=streak)
+
+
+class HedgedLlm:
+    """在截止时间内等待 LLM；超时先返回 None 让调用方用本地评论，LLM 的结果晚到时写入评论缓存"""
+
+    def __init__(self):
+        self._executor = ProcessLocalExecutor(AI_HEDGE_WORKERS, 'ai-hedge')
+        self._lock = threading.Lock()
+        self._inflight = 0
+
+    def request(self, configs, user_prompt, deadline, log_tag, on_late=None):
+        with self._lock:
+            if self._inflight >= AI_HEDGE_MAX_INFLIGHT:
+                print(f"{log_tag} Hedge saturated ({self._inflight} in flight), using local line")
+                return None
+            self._inflight += 1
+        future = self._executor.get().submit(request_ai_text, configs, user_prompt, log_tag)
+        future.add_done_callback(self._finished)
+        try:
+            return future.result(timeout=deadline)
+        except FutureTimeoutError:
+            print(f"{log_tag} LLM missed the {deadline:.2f}s deadline, using local line")
+            if on_late is not None:
+                future.add_done_callback(lambda f: self._deliver_late(f, on_late))
+            return None
+
+    @staticmethod
+    def _deliver_late(future, on_late):
+        if future.exception() is None and future.result():
+            on_late(future.result())
+
+    def _finished(self, future):
+        with self._lock:
+            self._inflight -= 1
+
+
+hedged_llm = HedgedLlm()
+
+
+def get_commentary(configs, data, user_prompt, log_tag, rounds=None):
+    """返回一句评论：优先用同签名的缓存池；未命中时在 ai_llm_deadline_ms 内等待 LLM，
+    超时或出错时返回本地模板评论，LLM 晚到的结果写入缓存供下次使用"""
+    pool_size, ttl = commentary_cache_settings()
+    caching = pool_size > 0 and ttl > 0
+    signature = commentary_signature(data)
+    if caching:
+        line = commentary_cache.get(signature)
+        if line:
+            print(f"{log_tag} Commentary cache hit: {signature}")
+            commentary_cache.refill_async(signature, configs, user_prompt, ttl, pool_size)
+            return line
+
+    deadline = config_cache.get().get_int('ai_llm_deadline_ms', 1500) / 1000
+    if deadline <= 0:
+        line = request_ai_text(configs, user_prompt, log_tag)
+    else:
+        def warm(late_line):
+            if caching:
+                commentary_cache.add(signature, late_line, ttl, pool_size)
+                commentary_cache.refill_async(signature, configs, user_prompt, ttl, pool_size)
+
+        try:
+            line = hedged_llm.request(configs, user_prompt, deadline, log_tag, on_late=warm)
+        except Exception as e:
+            print(f"{log_tag} ERROR calling AI API, using local line: {e}")
+            line = None
+        if not line:
+            return local_commentary(data, rounds)
+    if line and caching:
+        commentary_cache.add(signature, line, ttl, pool_size)
+        commentary_cache.refill_async(signature, configs, user_prompt, ttl, pool_size)
+    return line
+
+
+# --- AI 接口限流与请求合并 ---
+
+AI_RATE_MAX_USERS = 10000       # 最多跟踪的用户令牌桶数，超出按 LRU 淘汰
+
+
+class RateLimitedError(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f'rate limited, retry after {retry_after:.1f}s')
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, burst):
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+
+    def refill(self, now, rate, burst):
+        self.tokens = min(float(burst), self.tokens + (now - self.updated_at) * rate)
+        self.updated_at = now
+
+    def wait_time(self, rate):
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / rate
+
+
+class AiRateLimiter:
+    """每用户 + 全局两级令牌桶，速率和突发量从 game_config 读取，任一速率为 0 表示不限"""
+
+    def __init__(self, max_users=AI_RATE_MAX_USERS):
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._users = collections.OrderedDict()
+        self._global = None
+
+    def acquire(self, user):
+        """两个桶都有令牌时各扣一个，否则抛出 RateLimitedError（不扣令牌）"""
+        snapshot = config_cache.get()
+        user_rate = snapshot.get_float('ai_rate_user_per_min', 6) / 60
+        user_burst = max(snapshot.get_int('ai_rate_user_burst', 3), 1)
+        global_rate = snapshot.get_float('ai_rate_global_per_sec', 5)
+        global_burst = max(snapshot.get_int('ai_rate_global_burst', 20), 1)
+        now = time.monotonic()
+        with self._lock:
+            buckets = []
+            if user_rate > 0:
+                bucket = self._users.get(user)
+                if bucket is None:
+                    bucket = self._users[user] = TokenBucket(user_burst)
+                    while len(self._users) > self.max_users:
+                        self._users.popitem(last=False)
+                self._users.move_to_end(user)
+                buckets.append((bucket, user_rate, user_burst))
+            if global_rate > 0:
+                if self._global is None:
+                    self._global = TokenBucket(global_burst)
+                buckets.append((self._global, global_rate, global_burst))
+            retry_after = 0
+            for bucket, rate, burst in buckets:
+                bucket.refill(now, rate, burst)
+                retry_after = max(retry_after, bucket.wait_time(rate))
+            if retry_after > 0:
+                raise RateLimitedError(retry_after)
+            for bucket, _, _ in buckets:
+                bucket.tokens -= 1
+
+
+class SingleFlight:
+    """相同 key 的并发调用只执行一次，其余调用等待并共享同一结果或异常"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+        try:
+            call['result'] = fn(*args)
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call['done'].set()
+
+
+ai_rate_limiter = AiRateLimiter()
+ai_text_flights = SingleFlight()
+
+
+def ai_client_id(data):
+    """限流/合并所用的用户标识：优先用请求体里的 username，旧客户端退回客户端 IP"""
+    return str(data.get('username') or request.remote_addr or 'anonymous')
+
+
+def ai_request_key(client_id, data):
+    body = json.dumps(data, ensure_ascii=False, sort_keys=True, default=str)
+    return f"{client_id}:{hashlib.sha1(body.encode('utf-8')).hexdigest()}"
+
+
+def rate_limited_response(e):
+    response = jsonify({'success': False, 'message': 'Too many AI requests, please slow down.'})
+    response.headers['Retry-After'] = str(max(1, int(e.retry_after + 0.999)))
+    return response, 429
+
+
+def compute_ai_text_line(configs, data, client_id):
+    ai_rate_limiter.acquire(client_id)
+    user_prompt, rounds = prepare_ai_prompt(data)
+    return get_commentary(configs, data, user_prompt, '[AI TEXT]', rounds)
+
+
+@app.route('/api/ai_text_line', methods=['POST'])
+def get_ai_text_line():
+    print("\n--- [AI TEXT] Request Initiated ---")
+    configs = config_cache.get().raw
+
+    ai_enabled_str = configs.get('ai_voice_enabled', 'false')
+    if ai_enabled_str.lower() != 'true':
+        return jsonify({'success': False, 'message': 'AI feature is disabled.'})
+
+    data = request.json
+    if not all([configs.get('openai_api_endpoint'), configs.get('openai_api_key')]):
+        return jsonify({'success': False, 'message': 'AI service is not configured.'}), 500
+
+    client_id = ai_client_id(data)
+    try:
+        ai_text = ai_text_flights.do(ai_request_key(client_id, data), compute_ai_text_line, configs, data, client_id)
         if not ai_text:
             return jsonify({'success': False, 'message': 'AI returned no content.'})
         return jsonify({'success': True, 'text': ai_text})
+    except RateLimitedError as e:
+        print(f"[AI TEXT] REJECTED for {client_id}: {e}")
+        return rate_limited_response(e)
     except Exception as e:
         print(f"[AI TEXT] ERROR calling AI API: {e}")
         return jsonify({'success': False, 'message': 'Failed to get AI response.'})
 
 
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+@app.route('/api/ai_text_line/stream', methods=['POST'])
+def stream_ai_text_line():
+    """与 /api/ai_text_line 相同的请求体，以 SSE 推送评论：若干 token 事件，最后是 done 或 error 事件"""
+    print("\n--- [AI STREAM] Request Initiated ---")
+    configs = config_cache.get().raw
+
+    ai_enabled_str = configs.get('ai_voice_enabled', 'false')
+    if ai_enabled_str.lower() != 'true':
+        return jsonify({'success': False, 'message': 'AI feature is disabled.'})
+
+    data = request.json
+    if not all([configs.get('openai_api_endpoint'), configs.get('openai_api_key')]):
+        return jsonify({'success': False, 'message': 'AI service is not configured.'}), 500
+
+    try:
+        ai_rate_limiter.acquire(ai_client_id(data))
+    except RateLimitedError as e:
+        print(f"[AI STREAM] REJECTED: {e}")
+        return rate_limited_response(e)
+    user_prompt, _ = prepare_ai_prompt(data)
+    pool_size, ttl = commentary_cache_settings()
+    signature = commentary_signature(data)
+    cached = commentary_cache.get(signature) if pool_size > 0 and ttl > 0 else None
+
+    def generate():
+        if cached:
+            yield sse_event('token', {'text': cached})
+            yield sse_event('done', {'text': cached})
+            commentary_cache.refill_async(signature, configs, user_prompt, ttl, pool_size)
+            return
+        parts = []
+        tokens = None
+        try:
+            tokens = stream_ai_text(configs, user_prompt)
+            for piece in tokens:
+                parts.append(piece)
+                yield sse_event('token', {'text': piece})
+        except Exception as e:
+            print(f"[AI STREAM] ERROR calling AI API: {e}")
+            yield sse_event('error', {'message': 'Failed to get AI response.'})
+            return
+        finally:
+            # 客户端断开时生成器在 yield 处被关闭，这里连带关闭上游流
+            if tokens is not None:
+                tokens.close()
+        ai_text = ''.join(parts).strip()
+        if not ai_text:
+            yield sse_event('error', {'message': 'AI returned no content.'})
+            return
+        if pool_size > 0 and ttl > 0:
+            commentary_cache.add(signature, ai_text, ttl, pool_size)
+            commentary_cache.refill_async(signature, configs, user_prompt, ttl, pool_size)
+        yield sse_event('done', {'text': ai_text})
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# --- AI 语音后台任务 ---
+
+AI_VOICE_WORKERS = int(os.environ.get('AI_VOICE_WORKERS', 4))
+AI_VOICE_MAX_PENDING = int(os.environ.get('AI_VOICE_MAX_PENDING', 32))  # 排队+执行中的任务上限
+JOB_RESULT_TTL = 300           # 秒，已结束任务的结果保留时间
+AI_VOICE_MAX_WAIT = 20         # 秒，长轮询单次最长等待
+JOB_FINAL_STATES = ('done', 'error')
+
+
+class BackgroundJobs:
+    """有界线程池执行耗时任务 (LLM→TTS 链路、地图模拟)；接口立即返回 job_id，客户端长轮询拿结果。
+    fields 为任务结果字段名，初始为 None，由任务函数通过 update() 填入"""
+
+    def __init__(self, name, max_workers, max_pending, fields=(), log_tag='[JOBS]', failure_message='Job failed.'):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.fields = fields
+        self.log_tag = log_tag
+        self.failure_message = failure_message
+        self._cond = threading.Condition()
+        self._jobs = {}
+        self._keys = {}  # 合并 key -> 进行中的 job_id
+        self._pending = 0
+        self._executor = ProcessLocalExecutor(max_workers, name)
+
+    def _prune(self):
+        now = time.monotonic()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job['status'] in JOB_FINAL_STATES and now - job['updated_at'] > JOB_RESULT_TTL]
+        for job_id in expired:
+            del self._jobs[job_id]
+        self._keys = {key: job_id for key, job_id in self._keys.items()
+                      if job_id in self._jobs and self._jobs[job_id]['status'] not in JOB_FINAL_STATES}
+
+    def submit(self, fn, *args, key=None, admit=None):
+        """提交任务，队列已满时返回 None（由调用方返回 503 做背压）。
+        同一 key 已有进行中的任务时直接返回它的 job_id；否则先调用 admit（可抛出 RateLimitedError）再入队"""
+        with self._cond:
+            existing = self._keys.get(key) if key is not None else None
+            if existing in self._jobs and self._jobs[existing]['status'] not in JOB_FINAL_STATES:
+                print(f"{self.log_tag} Coalesced duplicate request into job {existing}")
+                return existing
+            if self._pending >= self.max_pending:
+                return None
+            if admit is not None:
+                admit()
+            self._prune()
+            job_id = os.urandom(8).hex()
+            self._jobs[job_id] = {'status': 'queued', **dict.fromkeys(self.fields), 'message': None,
+                                  'updated_at': time.monotonic()}
+            if key is not None:
+                self._keys[key] = job_id
+            self._pending += 1
+        self._executor.get().submit(self._run, job_id, fn, *args)
+        return job_id
+
+    def _run(self, job_id, fn, *args):
+        try:
+            self.update(job_id, status='running')
+            fn(job_id, *args)
+        except Exception as e:
+            print(f"{self.log_tag} ERROR in job {job_id}: {e}")
+            self.update(job_id, status='error', message=str(e))
+        finally:
+            with self._cond:
+                self._pending -= 1
+                job = self._jobs.get(job_id)
+                if job and job['status'] not in JOB_FINAL_STATES:
+                    job.update(status='error', message=self.failure_message, updated_at=time.monotonic())
+                self._cond.notify_all()
+
+    def update(self, job_id, **fields):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields, updated_at=time.monotonic())
+                self._cond.notify_all()
+
+    def wait(self, job_id, since=None, timeout=0):
+        """长轮询：等到任务状态不同于 since（或已结束）再返回快照，超时返回当前快照"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                job = self._jobs.get(job_id)
+                if job is None:
+                    return None
+                if job['status'] != since or job['status'] in JOB_FINAL_STATES:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return {k: v for k, v in job.items() if k != 'updated_at'}
+
+    def queue_depth(self):
+        with self._cond:
+            return self._pending
+
+
+ai_voice_jobs = BackgroundJobs('ai-voice', AI_VOICE_WORKERS, AI_VOICE_MAX_PENDING, fields=('text', 'audio_url'),
+                               log_tag='[AI VOICE]', failure_message='Failed to generate audio.')
+
+
+def run_ai_voice_job(job_id, configs, data):
+    # 1. Call OpenAI-compatible API
+    try:
+        user_prompt, rounds = prepare_ai_prompt(data)
+        ai_text = get_commentary(configs, data, user_prompt, '[AI VOICE]', rounds)
+    except Exception as e:
+        print(f"[AI VOICE] ERROR calling AI API: {e}")
+        ai_voice_jobs.update(job_id, status='error', message=str(e))
+        return
+    if not ai_text:
+        print("[AI VOICE] WARNING: AI returned an empty string. Skipping TTS call.")
+        ai_voice_jobs.update(job_id, status='error', message='AI returned no content.')
+        return
+    ai_voice_jobs.update(job_id, status='text', text=ai_text)
+
+    # 2. Call TTS API
+    try:
+        audio_file = get_tts_audio(configs, ai_text)
+    except Exception as e:
+        print(f"[AI VOICE] ERROR calling TTS API: {e}")
+        ai_voice_jobs.update(job_id, status='error', message='TTS service failed.')
+        return
+    if not audio_file:
+        print("[AI VOICE] ERROR: Failed to generate audio.")
+        ai_voice_jobs.update(job_id, status='error', message='Failed to generate audio.')
+        return
+    ai_voice_jobs.update(job_id, status='done', audio_url=f"/api/audio/{audio_file}")
+    print(f"[AI VOICE] Job {job_id} finished: {ai_text}")
+
+
 @app.route('/api/ai_voice_line', methods=['POST'])
 def get_ai_voice_line():
-    print("\n--- [AI VOICE] Request Initiated ---")
-
-    # Load config from DB
-    conn = get_db_connection()
-    configs = {row['key']: row['value'] for row in conn.execute('SELECT key, value FROM game_config').fetchall()}
-    conn.close()
+    """提交 AI 语音任务，立即返回 job_id；结果通过 /api/ai_voice_line/<job_id> 获取"""
+    configs = config_cache.get().raw
 
     # Check if the feature is enabled
     ai_enabled_str = configs.get('ai_voice_enabled', 'false')
     if ai_enabled_str.lower() != 'true':
         print("[AI VOICE] SKIPPED: AI voice feature is disabled in config.")
-        print("--- [AI VOICE] Request Finished ---")
         return jsonify({'success': False, 'message': 'AI voice feature is disabled.'})
 
-    # Audio Path and Cleanup
     tts_audio_path = configs.get('tts_audio_local_path')
     if not tts_audio_path or 'audio' not in tts_audio_path:
         print(f"[AI VOICE] ERROR: Invalid 'tts_audio_local_path' configured: {tts_audio_path}")
         return jsonify({'success': False, 'message': 'TTS audio path is not configured correctly.'}), 500
 
-    try:
-        if os.path.exists(tts_audio_path):
-            for filename in os.listdir(tts_audio_path):
-                file_path = os.path.join(tts_audio_path, filename)
-                if os.path.isfile(file_path):
-                    os.unlink(file_path)
-            print(f"[AI VOICE] Cleared audio cache directory: {tts_audio_path}")
-    except Exception as e:
-        print(f"[AI VOICE] ERROR clearing audio cache: {e}")
-
-    data = request.json
-    print(f"[AI VOICE] Request Data: {data}")
-
-    OPENAI_API_ENDPOINT = configs.get('openai_api_endpoint')
-    OPENAI_API_KEY = configs.get('openai_api_key')
-    TTS_API_ENDPOINT = configs.get('tts_api_endpoint')
-    TTS_VOICE_NAME = configs.get('tts_voice_name')
-    AI_MAX_TOKENS = int(configs.get('ai_max_tokens', 60))
-
-    if not all([OPENAI_API_ENDPOINT, OPENAI_API_KEY, TTS_API_ENDPOINT, TTS_VOICE_NAME]):
+    if not all([configs.get('openai_api_endpoint'), configs.get('openai_api_key'),
+                configs.get('tts_api_endpoint'), configs.get('tts_voice_name')]):
         print("[AI VOICE] ERROR: AI or TTS service is not configured in the database.")
         return jsonify({'success': False, 'message': 'AI or TTS service is not configured.'}), 500
 
-    coins = data.get('coins')
-    tickets = data.get('tickets')
-    current_map = data.get('map')
-    win = data.get('win')
-    history_str = data.get('history', '[]')
-    full_history_str = data.get('full_history', '[]')
-
-    try:
-        current_game_history = json.loads(history_str)
-    except:
-        current_game_history = []
-
-    try:
-        full_history = json.loads(full_history_str)
-    except:
-        full_history = []
-
-    # 1. Construct prompt for AI
-    system_prompt = f"""
-你是一个轻松幽默的游戏搭子，你的名字叫“弹珠精灵”。你正在和一个玩家互动，他刚刚玩完一局“七彩弹珠”游戏。
-你的任务是根据玩家当前的游戏状态、本局游戏事件，并结合最近的整体游戏历史，给出一句简短的、口语化的互动评论。
-请优先分析“本局事件”，如果本局事件足够精彩（汇总这一局的信息，比如中大奖、踩炸弹、中转盘、损失大量金币、赢大量金币、遇到特殊事件），就优先评论本局。
-如果本局很平淡，可以回顾“历史事件”来进行吐槽或鼓励（比如总是差一点中奖，或者运气一直很好/很差，或者连续失败，连续胜利，连续踩炸弹等，该引导下注时就引导，该劝玩家收手时就收手）。
-事件说明：
-
-- **风格**：俏皮、可爱、幽默、吐槽、鼓励，随机应变。
-- **长度**：严格控制在30个汉字以内，1-2句话。
-- **禁止**：不要说教，不要提出具体游戏建议，不要暴露你是AI，不要包含任何表情符号或特殊符号。
-- **输出**：直接输出评论文本。
-"""
-
-    user_prompt = f"""
-    - 我的状态：{coins}个金币，{tickets}张奖票。
-    - 本局地图：{current_map}。
-    - 本局结果：{'赢了' if win else '输了'}。
-    - 本局事件: {', '.join([f"{h.get('timestamp', '')}:{h.get('message', '')}" for h in current_game_history])}
-    - 历史事件: {', '.join([f"{h.get('timestamp', '')}:{h.get('message', '')}" for h in full_history])}
-    快，说点什么！
-    """
-    print(f"[AI VOICE] Constructed User Prompt:\n{user_prompt}")
-
-    # 2. Call OpenAI-compatible API
-    ai_text = ""
+    data = request.json
+    client_id = ai_client_id(data)
     try:
-        ai_payload = {
-            "model": "gemini-2.5-flash-nothinking",
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            "max_tokens": AI_MAX_TOKENS,
-            "temperature": 0.8,
-        }
-        headers = {
-            "Authorization": f"Bearer {OPENAI_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        print(f"[AI VOICE] Calling AI API at {OPENAI_API_ENDPOINT}")
-        print(f"[AI VOICE] requestbody：\n{ai_payload}")
-
-        ai_response = requests.post(OPENAI_API_ENDPOINT, json=ai_payload, headers=headers, timeout=20)
-        ai_response.raise_for_status()
-        ai_result = ai_response.json()
-        ai_text = ai_result['choices'][0]['message']['content'].strip()
-        print(f"[AI VOICE] AI API Response Text: '{ai_result}'")
-
-        # Handle case where AI returns an empty string
-        if not ai_text:
-            print("[AI VOICE] WARNING: AI returned an empty string. Skipping TTS call.")
-            print("--- [AI VOICE] Request Finished (No Content) ---")
-            return jsonify({'success': False, 'message': 'AI returned no content.'})
-
-    except Exception as e:
-        print(f"[AI VOICE] ERROR calling AI API: {e}")
-        ai_text = "哎呀，网络好像有点卡顿！"
-        return jsonify({'success': False, 'message': str(e)})
-
-    # 3. Call TTS API
+        job_id = ai_voice_jobs.submit(run_ai_voice_job, configs, data, key=ai_request_key(client_id, data),
+                                      admit=lambda: ai_rate_limiter.acquire(client_id))
+    except RateLimitedError as e:
+        print(f"[AI VOICE] REJECTED for {client_id}: {e}")
+        return rate_limited_response(e)
+    if job_id is None:
+        print(f"[AI VOICE] REJECTED: queue full ({ai_voice_jobs.queue_depth()} pending)")
+        response = jsonify({'success': False, 'message': 'AI voice service is busy.'})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    return jsonify({'success': True, 'job_id': job_id, 'status': 'queued'}), 202
+
+
+@app.route('/api/ai_voice_line/<job_id>', methods=['GET'])
+def get_ai_voice_job(job_id):
+    """查询语音任务；wait=N 秒长轮询，since=上次看到的状态（queued/running/text）"""
     try:
-        tts_payload = {
-            "text": ai_text,
-            "voice": TTS_VOICE_NAME,
-            "rate": "0%",
-            "pitch": "0Hz",
-            "volume": "0%"
-        }
-        print(f"[AI VOICE] Calling TTS API at {TTS_API_ENDPOINT} with payload: {tts_payload}")
-        tts_response = requests.post(TTS_API_ENDPOINT, json=tts_payload, timeout=10)
-        tts_response.raise_for_status()
-        tts_result = tts_response.json()
-        print(f"[AI VOICE] TTS API Response: {tts_result}")
-
-        if tts_result.get("success"):
-            relative_audio_path = tts_result.get("data", {}).get("file")
-            if relative_audio_path:
-                # Ensure we only have the filename, not a full path
-                safe_relative_path = os.path.basename(relative_audio_path)
-                proxied_audio_url = f"/api/audio/{safe_relative_path}"
-                response_payload = {'success': True, 'audio_url': proxied_audio_url, 'text': ai_text}
-                print(f"[AI VOICE] Success! Sending final response to client: {response_payload}")
-                print("--- [AI VOICE] Request Finished ---")
-                return jsonify(response_payload)
+        wait = min(max(float(request.args.get('wait', 0)), 0), AI_VOICE_MAX_WAIT)
+    except ValueError:
+        wait = 0
+    job = ai_voice_jobs.wait(job_id, request.args.get('since'), wait)
+    if job is None:
+        return jsonify({'success': False, 'message': 'Job not found.'}), 404
+    job['success'] = job['status'] != 'error'
+    job['job_id'] = job_id
+    return jsonify(job)
+
+
+# --- 地图物理模拟 ---
+# 服务器端的无界面弹珠模拟，物理参数与 mobile.html 的 update() 一致，用来在调整地图权重/槽位前估算落点分布。
+# 所有弹珠作为 NumPy 数组并行推进；静态钉子用均匀网格做粗筛，每颗弹珠只和所在格子登记的钉子做精确检测。
+# 需要安装 numpy；运行 `python server.py simulate <地图key> [弹珠数] [进程数]` 或调用 /api/admin/simulate_map。
+
+SIM_GRAVITY, SIM_FRICTION, SIM_BOUNCE = 0.04, 0.995, 0.6
+SIM_BALL_R = 6
+SIM_CORNER_RADIUS = 90
+SIM_PLUNGER_W, SIM_PLUNGER_H = 45, 140
+SIM_MATERIAL_POWER = {'wood': 0.6, 'rubber': 1.5, 'metal': 1.0, 'gold': 1.6, 'temp_coin': 1.2,
+                      'fixed_coin': 1.1, 'bomb': 0.5, 'gold_egg': 0.8}
+SIM_WIDTH, SIM_HEIGHT = 360, 640        # 默认按常见手机竖屏的游戏区域尺寸模拟
+SIM_MAX_FRAMES = 6000                   # 60fps 下 100 秒仍未落槽的弹珠记为超时
+SIM_MAX_LAUNCH_DELAY = 600              # 发射前随机等待的帧数，让弹珠遇到移动钉子的不同相位
+SIM_EGG_PAUSE = (240, 480)              # 砸金蛋期间弹珠暂停的帧数范围
+SIM_CHUNK_BALLS = 2000                  # 每块弹珠共用一份随机生成的布局 (与每局重新生成布局一致)
+SIM_MAX_BALLS = 200000
+SIM_MAX_WORKERS = 8
+SIM_JOB_WORKERS = 1                     # 同时运行的模拟任务数 (每个任务自己还可以开 workers 个进程)
+SIM_JOB_MAX_PENDING = 4
+SIM_JOB_MAX_WAIT = 20                   # 秒，长轮询单次最长等待
+SIM_LOST, SIM_BOMB, SIM_TIMEOUT = -1, -2, -3
+SIM_EXTRA_CONFIGS = ('coin_config', 'bomb_config', 'egg_config')
+
+
+def sim_geometry(width, height, slot_count):
+    """与 initLevel() 相同的槽位/发射通道布局"""
+    margin, lane_w = 10, SIM_PLUNGER_W + 12
+    play_w = width - lane_w - margin
+    slot_w = (play_w - margin) / slot_count
+    slot_h = 35
+    return {'width': width, 'height': height, 'slot_count': slot_count, 'margin': margin, 'play_w': play_w,
+            'slot_w': slot_w, 'slot_h': slot_h, 'slot_y': height - slot_h - 10,
+            'center_x': play_w / 2 + margin, 'center_y': height * 0.35, 'peg_r': 8}
+
+
+def sim_peg(x, y, r, mat='metal', **extra):
+    peg = {'x': x, 'y': y, 'r': r, 'mat': mat, 'type': 'normal'}
+    peg.update(extra)
+    return peg
+
+
+def sim_mover(x, y, r, mat, vx, min_x, max_x, **extra):
+    return sim_peg(x, y, r, mat, type='mover', isMover=True, vx=vx, vy=0, minX=min_x, maxX=max_x, **extra)
+
+
+def add_random_sim_peg(pegs, rng, min_x, max_x, min_y, max_y, r, mat):
+    """addSingleRandomPeg()：随机落点，与已有钉子间距不足时重试，最多 20 次"""
+    for _ in range(20):
+        px = min_x + r + rng.random() * (max_x - min_x - r * 2)
+        py = min_y + rng.random() * (max_y - min_y)
+        if all(math.hypot(px - p['x'], py - p['y']) >= r + p['r'] + 10 for p in pegs):
+            pegs.append(sim_peg(px, py, r, mat))
+            return
+
+
+def add_random_sim_pegs(pegs, rng, min_x, max_x, min_y, max_y, count, r, mat='metal'):
+    for _ in range(count):
+        add_random_sim_peg(pegs, rng, min_x, max_x, min_y, max_y, r, mat)
+
+
+def default_map_layout(key, g, rng):
+    """内置地图的钉子布局，逐个对应 mobile.html initLevel() 中的生成代码 (只保留影响物理的字段)"""
+    pegs = []
+    m, pw, h, sy, r = g['margin'], g['play_w'], g['height'], g['slot_y'], g['peg_r']
+    cx, cy = g['center_x'], g['center_y']
+    rand = add_random_sim_pegs
+    if key == 'BONUS_COIN_FIELD':
+        rows, cols, start_y = 12, 8, h * 0.15
+        gap_x, gap_y = pw / cols, (sy - start_y - 50) / rows
+        for i in range(rows):
+            for j in range(cols):
+                x = m + gap_x / 2 + j * gap_x + (0 if i % 2 == 0 else gap_x / 2)
+                pegs.append(sim_peg(x, start_y + i * gap_y, r, 'temp_coin' if rng.random() > 0.15 else 'rubber'))
+        rand(pegs, rng, m, pw, sy - 60, sy - 20, 10, r, 'rubber')
+    elif key == 'GALTON_BOARD':
+        rows, start_y = 8, h * 0.2
+        gap_y = (sy - start_y - 120) / rows
+        for i in range(rows):
+            cols = i + 3
+            start_x = cx - (cols * (r * 4.2)) / 2
+            for j in range(cols):
+                pegs.append(sim_peg(start_x + j * r * 4.2, start_y + i * gap_y, r, 'metal' if i % 2 == 0 else 'rubber'))
+        rand(pegs, rng, m, pw, sy - 80, sy - 40, 8, r)
+    elif key == 'MOVING_GUARDS':
+        rand(pegs, rng, m, pw, h * 0.2, h * 0.6, 25, r)
+        for i in range(4):
+            pegs.append(sim_mover(cx, h * 0.4 + i * 60, r * 1.5, 'rubber',
+                                  (1 if rng.random() > 0.5 else -1) * (1.2 + rng.random()), m + 20, pw - 20))
+    elif key == 'BUMPER_CITY':
+        for i in range(4):
+            for j in range(2):
+                px, py = cx - pw * 0.25 + j * pw * 0.5, h * 0.25 + i * h * 0.14
+                offset = 0 if i % 2 == 0 else (rng.random() - 0.5) * 40
+                mat = 'gold' if rng.random() > 0.5 else 'rubber'
+                pegs.append(sim_peg(px + offset, py, r * 2.2, mat, type='bumper'))
+        rand(pegs, rng, m, pw, h * 0.2, sy - 50, 30, r, 'rubber')
+    elif key == 'LUCKY_FUNNEL':
+        for i in range(10):
+            pegs.append(sim_peg(m + 30 + i * 15, h * 0.3 + i * 25, r))
+            pegs.append(sim_peg(pw - 30 - i * 15, h * 0.3 + i * 25, r))
+        pegs.append(sim_mover(cx, h * 0.3 + 290, r * 1.8, 'gold', 3, cx - 60, cx + 60))
+        rand(pegs, rng, m, pw, h * 0.7, sy - 40, 12, r)
+    elif key == 'HEART_MAZE':
+        t = 0.0
+        while t <= math.pi * 2:
+            x = 16 * math.sin(t) ** 3
+            y = -(13 * math.cos(t) - 5 * math.cos(2 * t) - 2 * math.cos(3 * t) - math.cos(4 * t))
+            pegs.append(sim_peg(cx + x * 12, cy + y * 12, r, 'rubber'))
+            t += 0.2
+        pegs.append(sim_peg(cx, cy, r * 2, 'gold', type='bumper'))
+        rand(pegs, rng, m, pw, h * 0.55, sy - 50, 20, r)
+    elif key == 'RAINBOW_STAIRS':
+        for i in range(6):
+            is_left = i % 2 == 0
+            start_x, py = (m + 20 if is_left else pw - 120), h * 0.2 + i * 70
+            for j in range(6):
+                pegs.append(sim_peg(start_x + j * 18, py + j * 5 * (1 if is_left else -1), r, 'wood'))
+        rand(pegs, rng, m, pw, h * 0.65, sy - 40, 15, r, 'metal')
+    elif key == 'SMILEY_FACE':
+        pegs.append(sim_mover(cx - 60, cy - 50, r * 1.5, 'gold', 2, cx - 90, cx - 30))
+        pegs.append(sim_mover(cx + 60, cy - 50, r * 1.5, 'gold', -2, cx + 30, cx + 90))
+        for i in range(10):
+            pegs.append(sim_peg(cx - 80 + i * 18, cy + 50 + (i - 4.5) ** 2 * 3, r, 'rubber', type='bumper'))
+        rand(pegs, rng, m, pw, h * 0.1, h * 0.2, 15, r)
+        rand(pegs, rng, m, pw, h * 0.65, sy - 50, 15, r)
+    elif key == 'SPIRAL_GALAXY':
+        for i in range(40):
+            angle, dist = i * 0.3, 20 + i * 4
+            pegs.append(sim_peg(cx + math.cos(angle) * dist, cy + math.sin(angle) * dist, r, 'rubber'))
+        pegs.append(sim_peg(cx, cy, r * 3, 'gold', type='bumper'))
+        rand(pegs, rng, m, pw, h * 0.1, h * 0.2, 15, r)
+        rand(pegs, rng, m, pw, h * 0.7, sy - 30, 15, r)
+    elif key == 'DIAMOND_MINE':
+        for i in range(4):
+            for j in range(3):
+                px, py = cx - 100 + j * 100, h * 0.25 + i * 120
+                pegs += [sim_peg(px, py - 30, r, 'wood'), sim_peg(px - 30, py, r, 'wood'),
+                         sim_peg(px + 30, py, r, 'wood'), sim_peg(px, py + 30, r, 'wood'),
+                         sim_peg(px, py, r * 1.5, 'gold', type='bumper')]
+    elif key == 'PACHINKO_FOREST':
+        for i in range(15):
+            cols = 9 if i % 2 == 0 else 8
+            start_x = cx - (cols - 1) * 18
+            for j in range(cols):
+                if i > 5 and abs(j - cols / 2) < 1.5:
+                    continue
+                pegs.append(sim_peg(start_x + j * 36, h * 0.15 + i * 30, r * 0.8))
+        pegs.append(sim_mover(cx, h * 0.7, r * 2, 'gold', 4, cx - 80, cx + 80))
+    elif key == 'BINARY_TREE':
+        for i in range(6):
+            nodes, y = i + 1, h * 0.2 + i * 80
+            step_x = pw / (nodes + 1)
+            for j in range(1, nodes + 1):
+                x = step_x * j
+                pegs.append(sim_peg(m + x, y, r * 1.2, 'rubber', type='bumper'))
+                if i < 5:
+                    pegs += [sim_peg(m + x - 15, y + 30, r * 0.8), sim_peg(m + x + 15, y + 30, r * 0.8)]
+    elif key == 'METEOR_SHOWER':
+        for i in range(12):
+            speed, direction = 1 + rng.random() * 3, 1 if i % 2 == 0 else -1
+            pegs.append(sim_mover(cx, h * 0.2 + i * 50, r * 1.5, 'wood', speed * direction, m + 20, pw - 20))
+        rand(pegs, rng, m, pw, h * 0.1, h * 0.8, 20, r)
+    elif key == 'DOUBLE_CROSS':
+        for px, py in ((pw * 0.3 + m, h * 0.3), (pw * 0.7 + m, h * 0.5)):
+            pegs += [sim_peg(px, py + k * 20, r) for k in range(-3, 4)]
+            pegs += [sim_peg(px + k * 20, py, r) for k in range(-3, 4)]
+            pegs.append(sim_peg(px, py, r * 2, 'gold', type='bumper'))
+        rand(pegs, rng, m, pw, h * 0.6, sy - 30, 30, r, 'rubber')
+    elif key == 'THE_CAGE':
+        cage_y, rad, a = cy + 50, 80, 0.5
+        while a < math.pi * 2 - 0.5:
+            pegs.append(sim_peg(cx + math.cos(a) * rad, cage_y + math.sin(a) * rad, r))
+            a += 0.3
+        pegs.append(sim_peg(cx, cage_y, r * 3, 'rubber', type='bumper'))
+        rand(pegs, rng, m, pw, h * 0.1, h * 0.4, 20, r)
+    elif key == 'SLALOM_RUN':
+        for i in range(8):
+            x, y = (pw - 60 if i % 2 else m + 60), h * 0.15 + i * 70
+            pegs += [sim_peg(x, y, r * 2.5, 'wood'), sim_peg(cx, y + 35, r, 'rubber')]
+    elif key == 'CHAOS_VORTEX':
+        for i in range(3):
+            rad, count = 40 + i * 40, 8 + i * 6
+            for j in range(count):
+                ang = (math.pi * 2 / count) * j + i * 0.5
+                pegs.append(sim_peg(cx + math.cos(ang) * rad, cy + math.sin(ang) * rad, r, 'rubber'))
+        pegs.append(sim_peg(cx, cy, r * 2, 'gold', type='bumper'))
+    elif key == 'SPACE_INVADERS':
+        for i in range(3):
+            y, count, direction = h * 0.2 + i * 80, 5, 1 if i % 2 == 0 else -1
+            spacing = pw / (count + 1)
+            for j in range(1, count + 1):
+                pegs.append(sim_mover(m + j * spacing, y, r * 1.5, 'rubber', direction * 1.5, m + 20, pw - 20))
+        for j in range(1, 5):
+            x = m + j * (pw / 5)
+            pegs += [sim_peg(x - 15, h * 0.6, r), sim_peg(x, h * 0.6 - 15, r), sim_peg(x + 15, h * 0.6, r)]
+    elif key == 'PINBALL_WIZARD':
+        pegs += [sim_peg(cx, h * 0.2, r * 3, 'gold', type='bumper'),
+                 sim_peg(cx - 80, h * 0.25, r * 2.5, 'rubber', type='bumper'),
+                 sim_peg(cx + 80, h * 0.25, r * 2.5, 'rubber', type='bumper')]
+        for i in range(10):
+            pegs += [sim_peg(m + 20 + i * 10, h * 0.5 + i * 10, r * 0.8, 'wood'),
+                     sim_peg(pw - 20 - i * 10, h * 0.5 + i * 10, r * 0.8, 'wood')]
+        pegs += [sim_peg(m + 40, h * 0.75, r * 2, 'rubber', type='bumper'),
+                 sim_peg(pw - 40, h * 0.75, r * 2, 'rubber', type='bumper')]
+    elif key == 'DNA_HELIX':
+        for i in range(15):
+            y = h * 0.15 + i * 40
+            pegs += [sim_peg(cx + math.sin(i * 0.6) * 70, y, r, 'rubber'),
+                     sim_peg(cx + math.sin(i * 0.6 + math.pi) * 70, y, r, 'rubber')]
+            if i % 2 == 0:
+                pegs.append(sim_peg(cx, y, r * 0.8))
+    elif key == 'PLINKO_PYRAMID':
+        for i in range(10):
+            cols = i + 1
+            start_x = cx - (cols * r * 5) / 2
+            pegs += [sim_peg(start_x + j * r * 5 + r * 2.5, h * 0.2 + i * 45, r) for j in range(cols)]
+        pegs += [sim_peg(m + 30, h * 0.8, r * 2, 'gold', type='bumper'),
+                 sim_peg(pw - 30, h * 0.8, r * 2, 'gold', type='bumper')]
+    elif key == 'BLACK_HOLE':
+        for i in range(20):
+            a = (math.pi * 2 / 20) * i
+            pegs.append(sim_peg(cx + math.cos(a) * 120, cy + 50 + math.sin(a) * 120, r))
+            if math.sin(a) > -0.5:
+                pegs.append(sim_peg(cx + math.cos(a) * 100, cy + 50 + math.sin(a) * 100, r, 'rubber'))
+        rand(pegs, rng, m, pw, h * 0.1, h * 0.3, 2, r)
+        pegs.append(sim_peg(cx, cy + 50, r * 1.5, 'gold', type='bumper'))
+    elif key == 'TIMELINE_RIVER':
+        for i in range(12):
+            y, x_base = h * 0.15 + i * 50, cx + math.sin(i * 0.8) * 80
+            pegs += [sim_peg(x_base - 50, y, r, 'wood'), sim_peg(x_base + 50, y, r, 'wood')]
+            if i % 3 == 0:
+                pegs.append(sim_peg(x_base, y, r * 1.2))
+            elif i % 3 == 1:
+                pegs.append(sim_peg(x_base + 20, y, r * 1.5, 'rubber', type='bumper'))
+    else:  # CLASSIC_CHAOS 以及未知的 key，与前端的兜底分支一致
+        pegs.append(sim_peg(cx, cy + 50, r * 2.5, 'gold', type='bumper'))
+        rand(pegs, rng, m, pw, h * 0.15, sy - 50, 45, r)
+    return pegs
+
+
+def custom_map_layout(data):
+    """自定义地图的钉子，移动钉子按 initLevel() 换算成速度和往返范围 (type 仍为 normal，碰撞时不额外加速)"""
+    pegs = []
+    for p in data.get('pegs') or []:
+        peg = sim_peg(float(p.get('x') or 0), float(p.get('y') or 0), float(p.get('r') or 0), p.get('mat') or 'metal')
+        if p.get('isMover'):
+            speed, span = p.get('moveSpeed') or 1, p.get('moveRange') or 50
+            move_type = p.get('moveType') or 'horizontal'
+            peg.update(isMover=True, vx=0, vy=0)
+            if move_type in ('horizontal', 'diagonal'):
+                peg.update(vx=speed, minX=peg['x'] - span, maxX=peg['x'] + span)
+            if move_type in ('vertical', 'diagonal'):
+                peg.update(vy=speed, minY=peg['y'] - span, maxY=peg['y'] + span)
+        pegs.append(peg)
+    return pegs
+
+
+def add_sim_extras(pegs, g, rng, configs):
+    """每局随机追加的金币/炸弹/金蛋 (addCoinPegs/addBombPegs/addEggPegs)，概率取自当前游戏配置"""
+    m, pw, r = g['margin'], g['play_w'], g['peg_r']
+    min_y, max_y = g['height'] * 0.2, g['slot_y'] - 50
+
+    def add_count(prob, low, high, size, mat):
+        if rng.random() < prob:
+            for _ in range(rng.randint(int(low), int(high))):
+                add_random_sim_peg(pegs, rng, m, pw, min_y, max_y, size, mat)
+
+    coin, bomb, egg = configs.get('coin_config') or {}, configs.get('bomb_config') or {}, configs.get('egg_config')
+    add_count(coin.get('fixed_prob', 0), coin.get('fixed_min', 0), coin.get('fixed_max', 0), r, 'fixed_coin')
+    add_count(coin.get('temp_prob', 0), coin.get('temp_min', 0), coin.get('temp_max', 0), r, 'temp_coin')
+    add_count(bomb.get('prob', 0), bomb.get('count_min', 0), bomb.get('count_max', 0), r, 'bomb')
+    if egg:
+        add_count(egg.get('appear_prob') or 0.2, egg.get('count_min') or 1, egg.get('count_max') or 1, r * 1.5,
+                  'gold_egg')
+
+
+class PegGrid:
+    """静态钉子的均匀网格：每个格子登记与之相交的钉子 (半径已加上弹珠半径)，查表即得候选，无需遍历所有钉子"""
+
+    def __init__(self, pegs, ball_r):
+        self.count = len(pegs)
+        if not pegs:
+            self.table = np.full((1, 1), -1, dtype=np.int64)
+            self.cols = self.rows = 1
+            self.x0 = self.y0 = 0.0
+            self.cell = 1.0
+            return
+        reach = [p['r'] + ball_r for p in pegs]
+        self.cell = max(2 * max(reach), 16.0)
+        self.x0 = min(p['x'] - rr for p, rr in zip(pegs, reach))
+        self.y0 = min(p['y'] - rr for p, rr in zip(pegs, reach))
+        self.cols = int((max(p['x'] + rr for p, rr in zip(pegs, reach)) - self.x0) // self.cell) + 1
+        self.rows = int((max(p['y'] + rr for p, rr in zip(pegs, reach)) - self.y0) // self.cell) + 1
+        cells = collections.defaultdict(list)
+        for index, (p, rr) in enumerate(zip(pegs, reach)):
+            for cy in range(int((p['y'] - rr - self.y0) // self.cell), int((p['y'] + rr - self.y0) // self.cell) + 1):
+                for cx in range(int((p['x'] - rr - self.x0) // self.cell),
+                                int((p['x'] + rr - self.x0) // self.cell) + 1):
+                    cells[cy * self.cols + cx].append(index)
+        width = max(len(v) for v in cells.values())
+        self.table = np.full((self.rows * self.cols + 1, width), -1, dtype=np.int64)  # 最后一行给网格外的弹珠
+        for cell, members in cells.items():
+            self.table[cell, :len(members)] = members
+
+    def candidates(self, x, y):
+        cx = np.floor((x - self.x0) / self.cell).astype(np.int64)
+        cy = np.floor((y - self.y0) / self.cell).astype(np.int64)
+        inside = (cx >= 0) & (cx < self.cols) & (cy >= 0) & (cy < self.rows)
+        return self.table[np.where(inside, cy * self.cols + cx, self.rows * self.cols)]
+
+
+def simulate_balls(pegs, g, balls, rng):
+    """按 update() 的逐帧规则推进 balls 颗弹珠，返回每颗的结果：槽位编号或 SIM_LOST/SIM_BOMB/SIM_TIMEOUT"""
+    width, height, r = g['width'], g['height'], SIM_BALL_R
+    lane_x = width - SIM_PLUNGER_W - 10
+    fillet_x, fillet_y = width - SIM_CORNER_RADIUS, SIM_CORNER_RADIUS
+    divider_y, divider_h = g['slot_y'] - 20, g['slot_h'] + 20
+
+    static = [p for p in pegs if not p.get('isMover')]
+    movers = [p for p in pegs if p.get('isMover')]
+    grid = PegGrid(static, r)
+    px = np.array([p['x'] for p in static] + [0.0])
+    py = np.array([p['y'] for p in static] + [0.0])
+    reach = np.array([p['r'] + r for p in static] + [0.0])
+    power = np.array([SIM_MATERIAL_POWER.get(p['mat'], 1.0) for p in static] + [1.0])
+    is_bomb = np.array([p['mat'] == 'bomb' for p in static] + [False])
+    is_egg = np.array([p['mat'] == 'gold_egg' for p in static] + [False])
+    # 临时金币和金蛋被碰到后只对这颗弹珠消失，用 (弹珠, 可消失钉子) 的布尔表记录
+    removable = [i for i, p in enumerate(static) if p['mat'] in ('temp_coin', 'gold_egg')]
+    removable_col = np.full(len(static) + 1, -1, dtype=np.int64)
+    removable_col[removable] = np.arange(len(removable))
+    alive = np.ones((balls, max(len(removable), 1)), dtype=bool)
+
+    mx = np.array([p['x'] for p in movers])
+    my = np.array([p['y'] for p in movers])
+    mvx = np.array([float(p.get('vx') or 0) for p in movers])
+    mvy = np.array([float(p.get('vy') or 0) for p in movers])
+    min_x = np.array([p.get('minX', -np.inf) for p in movers])
+    max_x = np.array([p.get('maxX', np.inf) for p in movers])
+    min_y = np.array([p.get('minY', -np.inf) for p in movers])
+    max_y = np.array([p.get('maxY', np.inf) for p in movers])
+    m_reach = np.array([p['r'] + r for p in movers])
+    m_power = np.array([SIM_MATERIAL_POWER.get(p['mat'], 1.0) for p in movers])
+    m_boost = np.array([p['type'] == 'mover' for p in movers])
+
+    x = np.full(balls, width - 15.0)
+    y = np.full(balls, height - SIM_PLUNGER_H - 20.0)
+    vx = np.zeros(balls)
+    vy = -(5 + rng.uniform(0.2, 1.0, balls) * 15)  # touchEnd(): 拉杆力度 > 0.2 才会发射
+    wait = rng.integers(0, SIM_MAX_LAUNCH_DELAY, balls)
+    outcome = np.full(balls, SIM_TIMEOUT, dtype=np.int64)
+    done = np.zeros(balls, dtype=bool)
+
+    for _ in range(SIM_MAX_FRAMES):
+        # 移动钉子的往返运动对所有弹珠共用一条时间线
+        if len(movers):
+            mx += mvx
+            flip = (mx < min_x) | (mx > max_x)
+            mvx[flip] *= -1
+            mx = np.clip(mx, min_x, max_x)
+            my += mvy
+            flip = (my < min_y) | (my > max_y)
+            mvy[flip] *= -1
+            my = np.clip(my, min_y, max_y)
+
+        waiting = ~done & (wait > 0)
+        wait[waiting] -= 1
+        idx = np.flatnonzero(~done & ~waiting)
+        if not len(idx):
+            if done.all():
+                break
+            continue
+        bx, by, bvx, bvy = x[idx], y[idx], vx[idx], vy[idx]
+        live = np.ones(len(idx), dtype=bool)
+
+        stuck = (by > 100) & (by < height - 60) & (np.abs(bvx) < 0.05) & (np.abs(bvy) < 0.05)
+        bvx[stuck] += rng.uniform(-0.75, 0.75, stuck.sum())
+        bvy[stuck] += 1.0
+        bvy += SIM_GRAVITY
+        bvx *= SIM_FRICTION
+        bvy *= SIM_FRICTION
+        bx += bvx
+        by += bvy
+
+        hit = bx < r
+        bx[hit], bvx[hit] = r, bvx[hit] * -SIM_BOUNCE
+        hit = bx > width - r
+        bx[hit], bvx[hit] = width - r, bvx[hit] * -SIM_BOUNCE
+        band = (by > 120) & (by < height - 50)
+        left = band & (bx + r > lane_x) & (bx < lane_x)
+        right = band & ~left & (bx - r < lane_x + 8) & (bx > lane_x + 8)
+        bx[left], bvx[left] = lane_x - r, bvx[left] * -SIM_BOUNCE
+        bx[right], bvx[right] = lane_x + 8 + r, bvx[right] * -SIM_BOUNCE
+
+        corner = (bx > fillet_x) & (by < fillet_y)
+        dx, dy = bx - fillet_x, by - fillet_y
+        dist = np.hypot(dx, dy)
+        dist[dist == 0] = 0.01
+        hit = corner & (dist > SIM_CORNER_RADIUS - r)
+        if hit.any():
+            overlap = dist[hit] - (SIM_CORNER_RADIUS - r)
+            nx, ny = -dx[hit] / dist[hit], -dy[hit] / dist[hit]
+            bx[hit] += overlap * nx
+            by[hit] += overlap * ny
+            dot = bvx[hit] * nx + bvy[hit] * ny
+            bounce = dot < 0
+            hvx, hvy = bvx[hit], bvy[hit]
+            hvx[bounce] = (hvx[bounce] - 1.6 * dot[bounce] * nx[bounce]) * 0.98
+            hvy[bounce] = (hvy[bounce] - 1.6 * dot[bounce] * ny[bounce]) * 0.98
+            bvx[hit], bvy[hit] = hvx, hvy
+        top = ~corner & (by < r)
+        by[top], bvy[top], bvx[top] = r, np.abs(bvy[top]) * SIM_BOUNCE, bvx[top] * 0.9
+
+        def collide(cx_, cy_, reach_, power_, boost_vx, peg_index):
+            """与一列候选钉子做精确检测和反弹；peg_index 为静态钉子编号 (移动钉子传 None)"""
+            dx = bx - cx_
+            dy = by - cy_
+            dist = np.hypot(dx, dy)
+            dist[dist == 0] = 0.01
+            hit = live & (dist < reach_)
+            if peg_index is not None:
+                col = removable_col[peg_index]
+                has_col = col >= 0
+                hit[has_col] &= alive[idx[has_col], col[has_col]]
+            if not hit.any():
+                return
+            nx, ny = dx / dist, dy / dist
+            bx[hit] = (cx_ + nx * reach_)[hit]
+            by[hit] = (cy_ + ny * reach_)[hit]
+            v = bvx * nx + bvy * ny
+            hit &= v < 0
+            if peg_index is not None:
+                bomb = hit & is_bomb[peg_index]
+                outcome[idx[bomb]] = SIM_BOMB
+                done[idx[bomb]] = True
+                live[bomb] = False
+                egg = hit & is_egg[peg_index]
+                if egg.any():
+                    alive[idx[egg], removable_col[peg_index][egg]] = False
+                    wait[idx[egg]] = rng.integers(*SIM_EGG_PAUSE, egg.sum())
+                    bvy[egg] = -5
+                    bvx[egg] = rng.uniform(-2, 2, egg.sum())
+                hit &= ~bomb & ~egg
+                coin = hit & (removable_col[peg_index] >= 0)
+                alive[idx[coin], removable_col[peg_index][coin]] = False
+            if not hit.any():
+                return
+            j = -(1 + power_) * v
+            bvx[hit] += (j * nx)[hit] + (boost_vx * 0.6)[hit] + rng.uniform(-0.25, 0.25, hit.sum())
+            bvy[hit] += (j * ny)[hit]
+
+        if grid.count:
+            candidates = grid.candidates(bx, by)
+            for k in range(candidates.shape[1]):
+                peg_index = candidates[:, k]
+                if (peg_index < 0).all():
+                    break
+                peg_index = np.where(peg_index < 0, len(static), peg_index)
+                collide(px[peg_index], py[peg_index], reach[peg_index], power[peg_index], np.zeros(len(idx)),
+                        peg_index)
+        for k in range(len(movers)):
+            collide(mx[k], my[k], m_reach[k], m_power[k], np.full(len(idx), mvx[k] if m_boost[k] else 0.0), None)
+
+        # 槽位隔板：弹珠横向只可能挨着最近的一块，按 x 直接算出隔板编号
+        near = live & (by + r > divider_y - 5)
+        if near.any():
+            k = np.clip(np.round((bx - g['margin']) / g['slot_w']) - 1, 0, g['slot_count'] - 1)
+            dx0 = g['margin'] + (k + 1) * g['slot_w'] - 3
+            side = near & (by + r > divider_y) & (by - r < divider_y + divider_h) & (bx + r > dx0) & (bx - r < dx0 + 6)
+            bvx[side] = -bvx[side] * 0.5
+            bx[side] = np.where(bx[side] < dx0[side] + 3, dx0[side] - r, dx0[side] + 6 + r)
+            cap = near & (bx > dx0) & (bx < dx0 + 6) & (np.abs(by + r - divider_y) < 5)
+            bvy[cap] = -bvy[cap] * 1.5
+            by[cap] = divider_y - r
+
+        x[idx], y[idx], vx[idx], vy[idx] = bx, by, bvx, bvy
+        bottom = live & (by > height - r - 5)
+        slot = np.floor((bx - g['margin']) / g['slot_w']).astype(np.int64)
+        landed = bottom & (bx > g['margin']) & (slot >= 0) & (slot < g['slot_count'])
+        outcome[idx[landed]] = slot[landed]
+        lost = bottom & ~landed & (by > height + 20)
+        outcome[idx[lost]] = SIM_LOST
+        done[idx[landed | lost]] = True
+    return outcome
+
+
+def simulate_map_chunk(spec, balls, seed):
+    """进程池里执行的一块：生成一份布局 (内置地图的随机部分每块不同) 并模拟 balls 颗弹珠"""
+    layout_rng = random.Random(seed)
+    g = sim_geometry(spec['width'], spec['height'], spec['slot_count'])
+    # 与 mobile.html 的 initLevel() 一致：data.pegs 存在 (哪怕是空数组) 就是自定义布局
+    data = spec.get('data')
+    if data is not None and data.get('pegs') is not None:
+        pegs = custom_map_layout(data)
+    else:
+        pegs = default_map_layout(spec['key'], g, layout_rng)
+    if spec.get('extras') and spec['key'] != 'BONUS_COIN_FIELD':
+        add_sim_extras(pegs, g, layout_rng, spec['extras'])
+    outcome = simulate_balls(pegs, g, balls, np.random.default_rng(seed))
+    return np.bincount(outcome - SIM_TIMEOUT, minlength=spec['slot_count'] - SIM_TIMEOUT).tolist()
+
+
+def load_sim_spec(key, width=SIM_WIDTH, height=SIM_HEIGHT, extras=True):
+    """按地图 key 读取模拟所需的数据：自定义地图取库中的钉子，内置地图用生成规则；地图不存在时返回 None"""
+    snapshot = config_cache.get()
+    with get_db_connection() as conn:
+        row = conn.execute(MAP_BY_KEY_SQL, (key,)).fetchone()
+    if row is None and key not in dict(DEFAULT_MAPS):
+        return None
+    return {'key': key, 'data': map_row_data(row) if row is not None else None, 'width': width, 'height': height,
+            'slot_count': max(snapshot.get_int('slot_count', 14), 1),
+            'extras': {k: snapshot.get_json(k) for k in SIM_EXTRA_CONFIGS} if extras else None}
+
+
+def simulate_map_cli(args):
+    """命令行入口：python server.py simulate <地图key> [弹珠数] [进程数]"""
+    if np is None:
+        print("[SIM] numpy is required: pip install numpy")
+        return 1
+    if not args:
+        print("usage: python server.py simulate <map_key> [balls] [workers]")
+        return 2
+    init_db()
+    spec = load_sim_spec(args[0])
+    if spec is None:
+        print(f"[SIM] Map {args[0]} not found")
+        return 1
+    balls = min(int(args[1]) if len(args) > 1 else 10000, SIM_MAX_BALLS)
+    workers = int(args[2]) if len(args) > 2 else os.cpu_count() or 1
+    result = run_map_simulation(spec, balls, workers=workers)
+    for index, (count, share) in enumerate(zip(result['slots'], result['slot_share'])):
+        print(f"[SIM] slot {index:2d}: {count:7d} {share:7.2%} {'#' * round(share * 200)}")
+    print(f"[SIM] {result['key']}: {balls} balls, playable {result['playable_share']:.2%}, dead slots "
+          f"{result['dead_slots']}, lost {result['lost']}, bomb {result['bomb']}, timeout {result['timeout']}, "
+          f"{result['elapsed_ms']} ms")
+    return 0
+
+
+def run_map_simulation(spec, balls, seed=None, workers=1):
+    """把弹珠按 SIM_CHUNK_BALLS 分块，workers > 1 时用进程池并行，汇总成落点直方图"""
+    seeds = np.random.SeedSequence(seed).generate_state(max(1, -(-balls // SIM_CHUNK_BALLS))).tolist()
+    sizes = [min(SIM_CHUNK_BALLS, balls - i * SIM_CHUNK_BALLS) for i in range(len(seeds))]
+    started = time.perf_counter()
+    if workers > 1 and len(seeds) > 1:
+        # spawn 而不是 fork：服务进程里有数据库连接池和后台线程，fork 出的子进程可能继承到被占用的锁
+        with ProcessPoolExecutor(max_workers=min(workers, len(seeds)),
+                                 mp_context=multiprocessing.get_context('spawn')) as pool:
+            counts = list(pool.map(simulate_map_chunk, [spec] * len(seeds), sizes, seeds))
+    else:
+        counts = [simulate_map_chunk(spec, size, s) for size, s in zip(sizes, seeds)]
+    total = np.sum(counts, axis=0)
+    slots = total[-SIM_TIMEOUT:].tolist()
+    slot_count = spec['slot_count']
+    playable = sum(slots[1:slot_count - 1])
+    return {
+        'key': spec['key'], 'balls': balls, 'slot_count': slot_count, 'slots': slots,
+        'slot_share': [round(c / balls, 4) for c in slots],
+        'dead_slots': slots[0] + slots[slot_count - 1], 'playable_share': round(playable / balls, 4),
+        'lost': int(total[SIM_LOST - SIM_TIMEOUT]), 'bomb': int(total[SIM_BOMB - SIM_TIMEOUT]),
+        'timeout': int(total[0]), 'elapsed_ms': round((time.perf_counter() - started) * 1000),
+    }
 
-    except Exception as e:
-        print(f"[AI VOICE] ERROR calling TTS API: {e}")
-        print("--- [AI VOICE] Request Finished with Error ---")
-        return jsonify({'success': False, 'message': 'TTS service failed.'}), 500
 
-    print("[AI VOICE] ERROR: Failed to generate audio, falling through.")
-    print("--- [AI VOICE] Request Finished with Error ---")
-    return jsonify({'success': False, 'message': 'Failed to generate audio.'}), 500
+# --- 经济模拟 ---
+# 按 mobile.html 的一局流程 (投币下注 → 亮灯/倍率 → 随机金币/炸弹/金蛋 → 落槽/转盘) 做向量化蒙特卡洛，
+# 估算每局金币、积分的期望、方差和尾部风险，供运营在 update_config 之前试算新配置。
+# 弹珠会碰到哪些钉子取决于物理过程，这里用 ECON_BALL_MODEL 里的命中率近似；
+# 落槽分布和掉回发射通道的比例可以填 /api/admin/simulate_map 任务的 result (slot_share / lost_rate)。
+
+ECON_TICKET_COIN_RATE = 30      # 与 mobile.html 的 TICKET_EXCHANGE_RATE 一致：每 30 金币奖金附赠 1 积分
+ECON_BATCH_ROUNDS = 1000000
+ECON_DEFAULT_ROUNDS = 1000000
+ECON_MAX_ROUNDS = 20000000
+ECON_CONFIG_KEYS = ('slot_count', 'light_rules', 'multiplier_rules', 'lucky_wheel', 'bomb_config', 'coin_config',
+                    'egg_config', 'exchange_rate')
+ECON_BALL_MODEL = {
+    'lost_rate': 0.0,           # 没有落进任何槽 (掉回发射通道) 的比例
+    'bomb_hit': 0.1,            # 每个炸弹被碰到的概率
+    'temp_coin_hit': 0.15,      # 每个临时金币被碰到的概率 (只能拿一次)
+    'fixed_coin_hits': 0.2,     # 每个固定金币平均被碰到的次数
+    'egg_hit': 0.1,             # 每个金蛋被碰到的概率
+    'slot_share': None,         # 各槽位的落点概率，None 表示均匀
+}
+ECON_PERCENTILES = (1, 5, 50, 95, 99)
+
+
+def econ_config(values, overrides=None):
+    """当前配置 (ConfigSnapshot.values) 叠加提议的修改；修改值可以是对象或 update_config 存的 JSON 文本"""
+    cfg = {key: values.get(key) for key in ECON_CONFIG_KEYS}
+    for key, value in (overrides or {}).items():
+        if key not in ECON_CONFIG_KEYS:
+            continue
+        if isinstance(value, str):
+            try:
+                value = json.loads(value)
+            except json.JSONDecodeError:
+                pass
+        cfg[key] = value
+    return cfg
+
+
+def econ_count(rng, n, prob, low, high):
+    """每局按概率出现 [low, high] 个随机钉子 (addCoinPegs/addBombPegs/addEggPegs)"""
+    low, high = int(low), int(high)
+    return np.where(rng.random(n) < float(prob), rng.integers(low, max(high, low) + 1, n), 0)
+
+
+def simulate_economy_batch(cfg, model, n, bet, rng):
+    """模拟 n 局，返回 (每局金币净变化, 每局积分变化, 事件计数)"""
+    slot_count = max(int(cfg['slot_count'] or 14), 3)
+    coins = np.full(n, -bet, dtype=np.int64)
+    tickets = np.zeros(n, dtype=np.int64)
+
+    # 亮灯数按 light_rules 的百分比累计抽取，超出合计的部分为 1 盏 (与 insertCoin() 相同)
+    rules = sorted((int(k), float(v)) for k, v in (cfg['light_rules'] or {}).items())
+    multipliers = {str(k): v for k, v in (cfg['multiplier_rules'] or {}).items()}
+    light_table = np.array([min(k, slot_count) for k, _ in rules] + [1])
+    mult_table = np.array([float(multipliers.get(str(k)) or 2) for k, _ in rules] + [float(multipliers.get('1') or 2)])
+    pick = np.searchsorted(np.cumsum([w for _, w in rules]), rng.random(n) * 100, side='right')
+    lights, mult = light_table[pick], mult_table[pick]
+
+    coin, bomb, egg = cfg['coin_config'] or {}, cfg['bomb_config'] or {}, cfg['egg_config'] or {}
+    fixed = econ_count(rng, n, coin.get('fixed_prob', 0), coin.get('fixed_min', 0), coin.get('fixed_max', 0))
+    coins += rng.poisson(fixed * model['fixed_coin_hits']) * int(coin.get('fixed_val', 0))
+    temp = econ_count(rng, n, coin.get('temp_prob', 0), coin.get('temp_min', 0), coin.get('temp_max', 0))
+    coins += rng.binomial(temp, model['temp_coin_hit']) * int(coin.get('temp_val', 0))
+    bombs = econ_count(rng, n, bomb.get('prob', 0), bomb.get('count_min', 0), bomb.get('count_max', 0))
+    bombed = rng.random(n) < 1 - (1 - model['bomb_hit']) ** bombs
+
+    egg_games = np.zeros(n, dtype=np.int64)
+    if cfg['egg_config']:
+        eggs = econ_count(rng, n, egg.get('appear_prob') or 0.2, egg.get('count_min') or 1, egg.get('count_max') or 1)
+        egg_games = rng.binomial(eggs, model['egg_hit'])
+        probs, rewards, penalties = egg.get('probs') or {}, egg.get('rewards') or {}, egg.get('penalties') or {}
+        p_coin, p_ticket = float(probs.get('coin', 0.4)), float(probs.get('ticket', 0.4))
+        for game in range(int(egg_games.max(initial=0))):
+            played = egg_games > game
+            roll = rng.random(n)
+            won_coin = played & (roll < p_coin)
+            won_ticket = played & ~won_coin & (roll < p_coin + p_ticket)
+            mouse = played & ~won_coin & ~won_ticket
+            coins += won_coin * int(rewards.get('coin') or 100)
+            tickets += won_ticket * int(rewards.get('ticket') or 50)
+            # 老鼠优先扣金币 (假设余额足够)，没有配置金币惩罚时才扣积分
+            if int(penalties.get('coin') or 0) > 0:
+                coins -= mouse * int(penalties['coin'])
+            else:
+                tickets -= mouse * int(penalties.get('ticket') or 0)
+
+    share = model.get('slot_share')
+    landing = rng.choice(slot_count, n, p=share) if share is not None else rng.integers(0, slot_count, n)
+    landed = ~bombed & (rng.random(n) >= model['lost_rate'])
+
+    wheel_cfg = cfg['lucky_wheel'] or {}
+    wheel_prob = float(wheel_cfg.get('prob', 0)) if wheel_cfg.get('enabled') else 0.0
+    wheel = landed & (rng.random(n) < wheel_prob) & (landing == rng.integers(0, slot_count, n))
+    low, high = int(wheel_cfg.get('min', 0)), int(wheel_cfg.get('max', 0))
+    coins += np.where(wheel, rng.integers(low, max(high, low) + 1, n), 0)
+
+    # 亮灯槽位是打乱后取前 lights 个，落点槽位被点亮的概率为 lights / slot_count；两侧的边槽永不中奖
+    edge = (landing == 0) | (landing == slot_count - 1)
+    win = landed & ~wheel & ~edge & (rng.random(n) < lights / slot_count)
+    gain = np.where(win, np.floor(bet * mult), 0).astype(np.int64)
+    coins += gain
+    tickets += gain // ECON_TICKET_COIN_RATE
+    events = {'win': int(win.sum()), 'wheel': int(wheel.sum()), 'bomb': int(bombed.sum()),
+              'egg': int((egg_games > 0).sum()), 'lost': int((~bombed & ~landed).sum())}
+    return coins, tickets, events
+
+
+def distribution_stats(counter, total, total_sq, n):
+    """由取值计数算均值、标准差、分位数和最差 5% 的平均值 (CVaR)"""
+    mean = total / n
+    std = math.sqrt(max(total_sq / n - mean * mean, 0.0))
+    values = sorted(counter)
+    stats = {'mean': round(mean, 4), 'std': round(std, 4), 'stderr': round(std / math.sqrt(n), 5),
+             'min': values[0], 'max': values[-1]}
+    seen, targets = 0, list(ECON_PERCENTILES)
+    tail, tail_left = 0.0, n * 0.05
+    for value in values:
+        count = counter[value]
+        if tail_left > 0:
+            used = min(count, tail_left)
+            tail += used * value
+            tail_left -= used
+        seen += count
+        while targets and seen >= n * targets[0] / 100:
+            stats[f'p{targets.pop(0)}'] = value
+    stats['cvar5'] = round(tail / (n * 0.05), 4)
+    return stats
+
+
+def run_economy_simulation(cfg, rounds, bet=1, seed=None, ball_model=None):
+    """分批模拟 rounds 局并汇总；同一个 seed 下当前配置和提议配置使用相同的随机数，差值更稳定"""
+    model = dict(ECON_BALL_MODEL, **(ball_model or {}))
+    slot_count = max(int(cfg['slot_count'] or 14), 3)
+    if model.get('slot_share') is not None:
+        share = np.asarray(model['slot_share'], dtype=float)
+        if share.shape != (slot_count,) or (share < 0).any() or share.sum() <= 0:
+            raise ValueError(f'slot_share 需要 {slot_count} 个非负数')
+        model['slot_share'] = share / share.sum()
+    rng = np.random.default_rng(seed)
+    started = time.perf_counter()
+    acc = {name: [collections.Counter(), 0, 0] for name in ('coins', 'tickets')}
+    value_sum = value_sq = 0.0
+    rate = float(cfg['exchange_rate'] or 0)
+    events = collections.Counter()
+    done = 0
+    while done < rounds:
+        n = min(ECON_BATCH_ROUNDS, rounds - done)
+        coins, tickets, batch_events = simulate_economy_batch(cfg, model, n, bet, rng)
+        for name, values in (('coins', coins), ('tickets', tickets)):
+            unique, counts = np.unique(values, return_counts=True)
+            acc[name][0].update(dict(zip(unique.tolist(), counts.tolist())))
+            acc[name][1] += int(values.sum())
+            acc[name][2] += float(np.square(values, dtype=np.float64).sum())
+        value = coins + tickets * rate
+        value_sum += float(value.sum())
+        value_sq += float(np.square(value).sum())
+        events.update(batch_events)
+        done += n
+    elapsed = time.perf_counter() - started
+    value_mean = value_sum / rounds
+    return {
+        'rounds': rounds, 'bet': bet,
+        'coins': distribution_stats(acc['coins'][0], acc['coins'][1], acc['coins'][2], rounds),
+        'tickets': distribution_stats(acc['tickets'][0], acc['tickets'][1], acc['tickets'][2], rounds),
+        'value': {'mean': round(value_mean, 4), 'exchange_rate': rate,
+                  'std': round(math.sqrt(max(value_sq / rounds - value_mean ** 2, 0.0)), 4)},
+        'rtp': round(1 + value_mean / bet, 4),  # 按 exchange_rate 把积分折成金币后的返奖率
+        'rates': {name: round(events[name] / rounds, 5) for name in ('win', 'wheel', 'bomb', 'egg', 'lost')},
+        'elapsed_ms': round(elapsed * 1000), 'rounds_per_sec': round(rounds / elapsed) if elapsed > 0 else None,
+    }
 
 
 # --- 管理员 API ---
@@ -837,24 +3941,46 @@ def get_ai_voice_line():
 @app.route('/api/admin/update_config', methods=['POST'])
 def update_game_config():
     data = request.json
-    conn = get_db_connection()
-    try:
-        for key, value in data.items():
-            # Don't save empty API keys unless they are explicitly cleared
-            if key == 'openai_api_key' and not value:
-                # Check if a key already exists, if so, don't overwrite with empty
-                existing = conn.execute('SELECT value FROM game_config WHERE key = ?', (key,)).fetchone()
-                if existing and existing['value'] and 'YOUR_API_KEY_HERE' not in existing['value']:
-                    continue
+    with get_db_connection() as conn:
+        try:
+            for key, value in data.items():
+                # Don't save empty API keys unless they are explicitly cleared
+                if key == 'openai_api_key' and not value:
+                    # Check if a key already exists, if so, don't overwrite with empty
+                    existing = conn.execute('SELECT value FROM game_config WHERE key = ?', (key,)).fetchone()
+                    if existing and existing['value'] and 'YOUR_API_KEY_HERE' not in existing['value']:
+                        continue
+
+                str_val = json.dumps(value) if isinstance(value, (dict, list, bool)) else str(value)
+                conn.execute('INSERT OR REPLACE INTO game_config (key, value) VALUES (?, ?)', (key, str_val))
+            bump_data_version(conn, 'game_config')
+            conn.commit()
+            config_cache.invalidate()
+            return jsonify({'success': True})
+        except Exception as e:
+            return jsonify({'success': False, 'message': str(e)})
 
-            str_val = json.dumps(value) if isinstance(value, (dict, list, bool)) else str(value)
-            conn.execute('INSERT OR REPLACE INTO game_config (key, value) VALUES (?, ?)', (key, str_val))
-        conn.commit()
-        return jsonify({'success': True})
-    except Exception as e:
-        return jsonify({'success': False, 'message': str(e)})
-    finally:
-        conn.close()
+
+@app.route('/api/admin/simulate_config', methods=['POST'])
+def admin_simulate_config():
+    """试算配置的每局收益：config 为提议的修改 (格式同 update_config)，同时返回当前配置的结果用于对比"""
+    if np is None:
+        return jsonify({'success': False, 'message': '服务器未安装 numpy，无法运行模拟'}), 503
+    data = request.json or {}
+    overrides = data.get('config') or {}
+    try:
+        rounds = min(max(int(data.get('rounds', ECON_DEFAULT_ROUNDS)), 1), ECON_MAX_ROUNDS)
+        bet = max(int(data.get('bet', 1)), 1)
+        seed = int(data['seed']) if data.get('seed') is not None else secrets.randbits(32)
+        values = config_cache.get().values
+        result = {'success': True, 'seed': seed,
+                  'proposed': run_economy_simulation(econ_config(values, overrides), rounds, bet, seed,
+                                                     data.get('ball_model'))}
+        if any(key in ECON_CONFIG_KEYS for key in overrides):
+            result['current'] = run_economy_simulation(econ_config(values), rounds, bet, seed, data.get('ball_model'))
+    except (TypeError, ValueError, AttributeError, KeyError) as e:
+        return jsonify({'success': False, 'message': f'参数错误: {e}'}), 400
+    return jsonify(result)
 
 
 @app.route('/api/admin/toggle_map', methods=['POST'])
@@ -862,10 +3988,9 @@ def toggle_map():
     data = request.json
     key = data.get('key')
     active = 1 if data.get('active') else 0
-    conn = get_db_connection()
-    conn.execute('UPDATE maps SET is_active = ? WHERE key = ?', (active, key))
-    conn.commit()
-    conn.close()
+    with get_db_connection() as conn:
+        conn.execute('UPDATE maps SET is_active = ? WHERE key = ?', (active, key))
+        commit_map_change(conn)
     return jsonify({'success': True})
 
 
@@ -876,10 +4001,13 @@ def delete_map():
     is_default = any(def_key == key for def_key, _ in DEFAULT_MAPS)
     if is_default:
         return jsonify({'success': False, 'message': '系统预置地图不可删除'})
-    conn = get_db_connection()
-    conn.execute('DELETE FROM maps WHERE key = ?', (key,))
-    conn.commit()
-    conn.close()
+    with get_db_connection() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute('SELECT data_hash FROM maps WHERE key = ?', (key,)).fetchone()
+        conn.execute('DELETE FROM maps WHERE key = ?', (key,))
+        if row is not None:
+            release_map_blob(conn, row['data_hash'])
+        commit_map_change(conn)
     return jsonify({'success': True})
 
 
@@ -889,13 +4017,63 @@ def update_map_weight():
     key = data.get('key')
     weight = int(data.get('weight', 10))
     if weight < 0: weight = 0
-    conn = get_db_connection()
-    conn.execute('UPDATE maps SET weight = ? WHERE key = ?', (weight, key))
-    conn.commit()
-    conn.close()
+    with get_db_connection() as conn:
+        conn.execute('UPDATE maps SET weight = ? WHERE key = ?', (weight, key))
+        commit_map_change(conn)
     return jsonify({'success': True})
 
 
+sim_jobs = BackgroundJobs('map-sim', SIM_JOB_WORKERS, SIM_JOB_MAX_PENDING, fields=('result',), log_tag='[SIM]',
+                          failure_message='Simulation failed.')
+
+
+def run_map_simulation_job(job_id, spec, balls, seed, workers):
+    result = run_map_simulation(spec, balls, seed, workers)
+    print(f"[SIM] Job {job_id} finished: {spec['key']} x {balls} in {result['elapsed_ms']} ms")
+    sim_jobs.update(job_id, status='done', result=result)
+
+
+@app.route('/api/admin/simulate_map', methods=['POST'])
+def admin_simulate_map():
+    """提交地图落点模拟任务：balls 颗弹珠，workers 个进程并行；extras=false 时不加随机金币/炸弹/金蛋。
+    几万颗弹珠要跑几十秒，因此在后台执行，立即返回 job_id，结果通过 /api/admin/simulate_map/<job_id> 获取"""
+    if np is None:
+        return jsonify({'success': False, 'message': '服务器未安装 numpy，无法运行模拟'}), 503
+    data = request.json or {}
+    try:
+        balls = min(max(int(data.get('balls', 10000)), 1), SIM_MAX_BALLS)
+        workers = min(max(int(data.get('workers', 1)), 1), SIM_MAX_WORKERS)
+        width = float(data.get('width', SIM_WIDTH))
+        height = float(data.get('height', SIM_HEIGHT))
+        seed = int(data['seed']) if data.get('seed') is not None else None
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': '参数错误'}), 400
+    spec = load_sim_spec(data.get('key'), width, height, extras=bool(data.get('extras', True)))
+    if spec is None:
+        return jsonify({'success': False, 'message': '地图不存在'}), 404
+    job_id = sim_jobs.submit(run_map_simulation_job, spec, balls, seed, workers)
+    if job_id is None:
+        response = jsonify({'success': False, 'message': '模拟任务过多，请稍后重试'})
+        response.headers['Retry-After'] = '10'
+        return response, 503
+    return jsonify({'success': True, 'job_id': job_id, 'status': 'queued'}), 202
+
+
+@app.route('/api/admin/simulate_map/<job_id>', methods=['GET'])
+def admin_simulate_map_job(job_id):
+    """查询模拟任务；wait=N 秒长轮询，since=上次看到的状态 (queued/running)，完成后 result 为落点统计"""
+    try:
+        wait = min(max(float(request.args.get('wait', 0)), 0), SIM_JOB_MAX_WAIT)
+    except ValueError:
+        wait = 0
+    job = sim_jobs.wait(job_id, request.args.get('since'), wait)
+    if job is None:
+        return jsonify({'success': False, 'message': '任务不存在'}), 404
+    job['success'] = job['status'] != 'error'
+    job['job_id'] = job_id
+    return jsonify(job)
+
+
 @app.route('/api/admin/add_skin', methods=['POST'])
 def add_skin():
     try:
@@ -906,10 +4084,9 @@ def add_skin():
             filename = secure_filename(f"skin_{int(time.time())}_{file.filename}")
             file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
             image_url = f"/static/uploads/{filename}"
-            conn = get_db_connection()
-            conn.execute('INSERT INTO skins (name, image_url) VALUES (?, ?)', (name, image_url))
-            conn.commit()
-            conn.close()
+            with get_db_connection() as conn:
+                conn.execute('INSERT INTO skins (name, image_url) VALUES (?, ?)', (name, image_url))
+                conn.commit()
             return jsonify({'success': True})
         return jsonify({'success': False, 'message': '图片格式不支持'})
     except Exception as e:
@@ -919,20 +4096,18 @@ def add_skin():
 @app.route('/api/admin/toggle_skin', methods=['POST'])
 def toggle_skin():
     data = request.json
-    conn = get_db_connection()
-    conn.execute('UPDATE skins SET is_active = ? WHERE id = ?', (data.get('is_active'), data.get('id')))
-    conn.commit()
-    conn.close()
+    with get_db_connection() as conn:
+        conn.execute('UPDATE skins SET is_active = ? WHERE id = ?', (data.get('is_active'), data.get('id')))
+        conn.commit()
     return jsonify({'success': True})
 
 
 @app.route('/api/admin/delete_skin', methods=['POST'])
 def delete_skin():
     data = request.json
-    conn = get_db_connection()
-    conn.execute('DELETE FROM skins WHERE id = ?', (data.get('id'),))
-    conn.commit()
-    conn.close()
+    with get_db_connection() as conn:
+        conn.execute('DELETE FROM skins WHERE id = ?', (data.get('id'),))
+        conn.commit()
     return jsonify({'success': True})
 
 
@@ -949,11 +4124,10 @@ def add_gift():
                 filename = secure_filename(f"{int(datetime.datetime.now().timestamp())}_{file.filename}")
                 file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
                 image_url = f"/static/uploads/{filename}"
-        conn = get_db_connection()
-        conn.execute('INSERT INTO gifts (name, image_url, price, stock) VALUES (?, ?, ?, ?)',
-                     (name, image_url, price, stock))
-        conn.commit()
-        conn.close()
+        with get_db_connection() as conn:
+            conn.execute('INSERT INTO gifts (name, image_url, price, stock) VALUES (?, ?, ?, ?)',
+                         (name, image_url, price, stock))
+            conn.commit()
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
@@ -966,19 +4140,19 @@ def update_gift():
         name = request.form.get('name')
         price = request.form.get('price')
         stock = request.form.get('stock')
-        conn = get_db_connection()
-        if 'image' in request.files and request.files['image'].filename != '':
-            file = request.files['image']
-            if file and allowed_file(file.filename):
-                filename = secure_filename(f"{int(datetime.datetime.now().timestamp())}_{file.filename}")
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-                image_url = f"/static/uploads/{filename}"
-                conn.execute('UPDATE gifts SET name=?, price=?, stock=?, image_url=? WHERE id=?',
-                             (name, price, stock, image_url, gift_id))
-        else:
-            conn.execute('UPDATE gifts SET name=?, price=?, stock=? WHERE id=?', (name, price, stock, gift_id))
-        conn.commit()
-        conn.close()
+        with get_db_connection() as conn:
+            if 'image' in request.files and request.files['image'].filename != '':
+                file = request.files['image']
+                if file and allowed_file(file.filename):
+                    filename = secure_filename(f"{int(datetime.datetime.now().timestamp())}_{file.filename}")
+                    file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+                    image_url = f"/static/uploads/{filename}"
+                    conn.execute('UPDATE gifts SET name=?, price=?, stock=?, image_url=? WHERE id=?',
+                                 (name, price, stock, image_url, gift_id))
+            else:
+                conn.execute('UPDATE gifts SET name=?, price=?, stock=? WHERE id=?', (name, price, stock, gift_id))
+            conn.commit()
+        gift_flash_sale.reset(int(gift_id))
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
@@ -986,79 +4160,186 @@ def update_gift():
 
 @app.route('/api/admin/gifts', methods=['GET'])
 def admin_get_gifts():
-    conn = get_db_connection()
-    gifts = conn.execute('SELECT * FROM gifts ORDER BY id DESC').fetchall()
-    conn.close()
+    with get_db_connection() as conn:
+        gifts = conn.execute('SELECT * FROM gifts /* full-scan */ ORDER BY id DESC').fetchall()
     return jsonify([dict(g) for g in gifts])
 
 
 @app.route('/api/admin/redemptions', methods=['GET'])
 def admin_redemptions():
-    conn = get_db_connection()
-    logs = conn.execute('SELECT * FROM gift_redemptions ORDER BY redeem_time DESC LIMIT 100').fetchall()
-    conn.close()
+    with get_db_connection() as conn:
+        logs = conn.execute('SELECT * FROM gift_redemptions /* full-scan */ '
+                            'ORDER BY redeem_time DESC LIMIT 100').fetchall()
     return jsonify([dict(l) for l in logs])
 
 
+@app.route('/api/admin/audio_stats', methods=['GET'])
+def admin_audio_stats():
+    return jsonify(audio_stats.snapshot())
+
+
+ADMIN_USERS_PAGE_SIZE = 50
+ADMIN_USERS_MAX_LIMIT = 200
+ADMIN_USER_COLUMNS = 'u.username, u.email, u.coins, u.tickets, u.current_skin'  # 不返回密码
+ADMIN_USERS_SEARCH_SQL = (f'SELECT {ADMIN_USER_COLUMNS} FROM users_fts f JOIN users u ON u.rowid = f.rowid '
+                          'WHERE users_fts MATCH ? ORDER BY f.rank LIMIT ?')
+# 三元组至少 3 个字符；更短的搜索词 (或未编译 FTS5 时) 只做前缀匹配，走用户名/邮箱索引的范围查找
+ADMIN_USERS_FTS_MIN_CHARS = 3
+ADMIN_USERS_PREFIX_SQL = (f'SELECT {ADMIN_USER_COLUMNS} FROM users u '
+                          'WHERE (u.username >= ? AND u.username < ?) OR (u.email >= ? AND u.email < ?) '
+                          'ORDER BY u.username LIMIT ?')
+ADMIN_USERS_PAGE_SQL = f'SELECT {ADMIN_USER_COLUMNS} FROM users u WHERE u.username > ? ORDER BY u.username LIMIT ?'
+
+
+def users_fts_available(conn):
+    row = conn.execute("SELECT 1 FROM sqlite_master /* full-scan */ "
+                       "WHERE type = 'table' AND name = 'users_fts'").fetchone()
+    return row is not None
+
+
 @app.route('/api/admin/users', methods=['GET'])
 def admin_get_users():
-    search = request.args.get('search', '')
-    conn = get_db_connection()
-    if search:
-        users = conn.execute("SELECT * FROM users WHERE username LIKE ? OR email LIKE ?",
-                             (f'%{search}%', f'%{search}%')).fetchall()
-    else:
-        users = conn.execute("SELECT * FROM users").fetchall()
-    conn.close()
-    return jsonify([dict(u) for u in users])
+    """用户列表：search 走三元组全文索引按相关度返回前 limit 条 (不足 3 个字符时按用户名/邮箱前缀匹配)；
+    无 search 时按用户名 keyset 分页 (cursor)"""
+    search = request.args.get('search', '').strip()
+    cursor = request.args.get('cursor', '')
+    try:
+        limit = min(max(int(request.args.get('limit', ADMIN_USERS_PAGE_SIZE)), 1), ADMIN_USERS_MAX_LIMIT)
+    except ValueError:
+        return jsonify({'success': False, 'message': '参数错误'}), 400
+    next_cursor = None
+    with get_db_connection() as conn:
+        if search and len(search) >= ADMIN_USERS_FTS_MIN_CHARS and users_fts_available(conn):
+            # 整体作为短语匹配，避免用户输入被当作 FTS 语法
+            phrase = '"' + search.replace('"', '""') + '"'
+            users = conn.execute(ADMIN_USERS_SEARCH_SQL, (phrase, limit)).fetchall()
+        elif search:
+            # 不退回 LIKE '%x%'：那是对 users 的全表扫描
+            upper = search + '\U0010ffff'
+            users = conn.execute(ADMIN_USERS_PREFIX_SQL, (search, upper, search, upper, limit)).fetchall()
+        else:
+            users = conn.execute(ADMIN_USERS_PAGE_SQL, (cursor, limit)).fetchall()
+            if len(users) == limit:
+                next_cursor = users[-1]['username']
+    return jsonify({'users': [dict(u) for u in users], 'next_cursor': next_cursor})
 
 
 @app.route('/api/admin/update_user', methods=['POST'])
 def admin_update_user():
     data = request.json
-    conn = get_db_connection()
-    conn.execute('UPDATE users SET coins=?, tickets=? WHERE username=?',
-                 (data.get('coins'), data.get('tickets'), data.get('username')))
-    conn.commit()
-    conn.close()
+    with get_db_connection() as conn:
+        conn.execute('UPDATE users SET coins=?, tickets=? WHERE username=?',
+                     (data.get('coins'), data.get('tickets'), data.get('username')))
+        version = bump_data_version(conn, 'tickets')
+        conn.commit()
+    rank_index.update(data.get('username'), data.get('tickets'), version)
     return jsonify({'success': True})
 
 
 @app.route('/api/admin/codes', methods=['GET', 'POST'])
 def admin_codes():
-    conn = get_db_connection()
-    if request.method == 'GET':
-        codes = conn.execute("SELECT * FROM redeem_codes ORDER BY last_used_time DESC").fetchall()
-        conn.close()
-        return jsonify([dict(c) for c in codes])
-    else:
-        data = request.json
+    with get_db_connection() as conn:
+        if request.method == 'GET':
+            # 只返回最近创建的一页 (rowid 倒序，从 B-tree 末尾读 limit 行即停)；完整列表请用 /api/admin/codes/export
+            batch_id = request.args.get('batch')
+            try:
+                limit = min(max(int(request.args.get('limit', CODE_LIST_LIMIT)), 1), CODE_LIST_LIMIT)
+            except ValueError:
+                return jsonify({'success': False, 'message': '参数错误'}), 400
+            if batch_id:
+                codes = conn.execute('SELECT * FROM redeem_codes WHERE batch_id = ? ORDER BY code LIMIT ?',
+                                     (batch_id, limit)).fetchall()
+            else:
+                codes = conn.execute('SELECT * FROM redeem_codes /* full-scan */ ORDER BY rowid DESC LIMIT ?',
+                                     (limit,)).fetchall()
+            return jsonify([dict(c) for c in codes])
+        else:
+            data = request.json
+            try:
+                conn.execute('INSERT INTO redeem_codes (code, max_uses, target_user, reward_amount) VALUES (?, ?, ?, ?)',
+                             (data.get('code'), data.get('max_uses', 1), data.get('target_user', ''),
+                              data.get('reward_amount', 100)))
+                conn.commit()
+                return jsonify({'success': True})
+            except Exception as e:
+                return jsonify({'success': False, 'message': str(e)})
+
+
+@app.route('/api/admin/codes/generate', methods=['POST'])
+def admin_generate_codes():
+    """批量生成随机兑换码 {prefix, count, reward_amount, max_uses, target_user, expires_at}，一个事务内分块插入"""
+    data = request.json or {}
+    prefix = re.sub(r'[^A-Za-z0-9_-]', '', str(data.get('prefix') or ''))[:16].upper()
+    try:
+        count = int(data.get('count', 0))
+        reward_amount = int(data.get('reward_amount', 100))
+        max_uses = int(data.get('max_uses', 1))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': '参数错误'}), 400
+    if not 0 < count <= CODE_MAX_BULK or max_uses <= 0:
+        return jsonify({'success': False, 'message': f'数量需在 1~{CODE_MAX_BULK} 之间'}), 400
+    expires_at = data.get('expires_at') or None
+    if expires_at:
         try:
-            conn.execute('INSERT INTO redeem_codes (code, max_uses, target_user, reward_amount) VALUES (?, ?, ?, ?)',
-                         (data.get('code'), data.get('max_uses', 1), data.get('target_user', ''),
-                          data.get('reward_amount', 100)))
-            conn.commit()
-            conn.close()
-            return jsonify({'success': True})
-        except Exception as e:
-            return jsonify({'success': False, 'message': str(e)})
+            expires_at = datetime.datetime.fromisoformat(expires_at).strftime("%Y-%m-%d %H:%M:%S")
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'message': '过期时间格式错误'}), 400
+    batch_id = f"{prefix or 'CODE'}-{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}-{secrets.token_hex(2)}"
+    with get_db_connection() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        created = insert_code_batch(conn, prefix, count, reward_amount, max_uses,
+                                    data.get('target_user') or '', expires_at, batch_id)
+        conn.commit()
+    return jsonify({'success': True, 'batch_id': batch_id, 'count': created})
+
+
+@app.route('/api/admin/codes/export', methods=['GET'])
+def admin_export_codes():
+    """以 CSV 流式导出兑换码 (可按 batch 过滤)；按 code 分块 keyset 查询，每块单独借还连接，内存占用与总数无关"""
+    batch_id = request.args.get('batch')
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(CODE_EXPORT_COLUMNS)
+        last_code = ''
+        while True:
+            with get_db_connection() as conn:
+                if batch_id:
+                    rows = conn.execute(CODE_EXPORT_BATCH_SQL, (batch_id, last_code, CODE_EXPORT_CHUNK)).fetchall()
+                else:
+                    rows = conn.execute(CODE_EXPORT_ALL_SQL, (last_code, CODE_EXPORT_CHUNK)).fetchall()
+            writer.writerows(tuple(row) for row in rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            if len(rows) < CODE_EXPORT_CHUNK:
+                return
+            last_code = rows[-1]['code']
+
+    filename = secure_filename(f"codes-{batch_id or 'all'}.csv")
+    return Response(generate(), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
 
 
 @app.route('/api/admin/update_code', methods=['POST'])
 def update_code():
     data = request.json
-    conn = get_db_connection()
-    try:
-        conn.execute('UPDATE redeem_codes SET max_uses=?, target_user=?, reward_amount=? WHERE code=?',
-                     (data.get('max_uses'), data.get('target_user'), data.get('reward_amount'), data.get('code')))
-        conn.commit()
-        conn.close()
-        return jsonify({'success': True})
-    except Exception as e:
-        return jsonify({'success': False, 'message': str(e)})
+    with get_db_connection() as conn:
+        try:
+            conn.execute('UPDATE redeem_codes SET max_uses=?, target_user=?, reward_amount=? WHERE code=?',
+                         (data.get('max_uses'), data.get('target_user'), data.get('reward_amount'), data.get('code')))
+            conn.commit()
+            return jsonify({'success': True})
+        except Exception as e:
+            return jsonify({'success': False, 'message': str(e)})
 
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ['check-plans']:
+        sys.exit(check_query_plans())
+    if sys.argv[1:2] == ['simulate']:
+        sys.exit(simulate_map_cli(sys.argv[2:]))
     init_db()
     print("Server running on http://0.0.0.0:5000")
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+# 进程内的缓存、索引和后台写入器，每个测试换一份新的，避免串用上一个测试数据库的数据
+PROCESS_STATE = ('config_cache', 'active_maps_cache', 'rank_index', 'username_index', 'balance_committer',
+                 'gift_flash_sale')
+
+
+@pytest.fixture
+def migrated_db(tmp_path, monkeypatch):
+    """迁移到最新结构的临时数据库，替换模块级连接池"""
+    pool = server.ConnectionPool(str(tmp_path / 'test.db'), 4)
+    monkeypatch.setattr(server, 'db_pool', pool)
+    for name in PROCESS_STATE:
+        monkeypatch.setattr(server, name, type(getattr(server, name))())
+    server.init_db()
+    yield pool
+    pool.close_all()
+
+
+@pytest.fixture
+def client(migrated_db):
+    return server.app.test_client()
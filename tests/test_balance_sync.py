@@ -0,0 +1,79 @@
+"""/api/balance/sync：按序号幂等、重放、参数校验，以及写入线程超时时的取消语义"""
+import time
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def player(client):
+    client.post('/api/register', json={'username': 'ann', 'password': 'p', 'email': 'ann@e'})
+    return 'ann'
+
+
+def sync(client, deltas, client_id='tab-1', username='ann'):
+    response = client.post('/api/balance/sync', json={'username': username, 'client_id': client_id,
+                                                      'deltas': deltas})
+    return response.status_code, response.get_json()
+
+
+def balance(pool, username='ann'):
+    with pool.connection() as conn:
+        return tuple(conn.execute('SELECT coins, tickets FROM users WHERE username = ?', (username,)).fetchone())
+
+
+def test_replayed_deltas_apply_once(client, migrated_db, player):
+    status, result = sync(client, [{'seq': 1, 'coins': 10}, {'seq': 2, 'coins': -3, 'tickets': 2}])
+    assert status == 200 and result['applied'] == 2 and result['last_seq'] == 2
+    # 客户端没收到响应后整批重发，并带上新的增量：只有 seq 3 生效
+    status, result = sync(client, [{'seq': 1, 'coins': 10}, {'seq': 2, 'coins': -3, 'tickets': 2},
+                                   {'seq': 3, 'coins': 1}])
+    assert result['applied'] == 1 and (result['coins'], result['tickets']) == (108, 2)
+    # 同一请求里重复的序号只算一次
+    status, result = sync(client, [{'seq': 4, 'coins': 5}, {'seq': 4, 'coins': 5}])
+    assert result['applied'] == 1
+    assert balance(migrated_db) == (113, 2)
+
+
+def test_client_ids_have_independent_sequences(client, migrated_db, player):
+    sync(client, [{'seq': 1, 'coins': 10}], client_id='tab-1')
+    sync(client, [{'seq': 1, 'coins': 20}], client_id='tab-2')
+    assert balance(migrated_db) == (130, 0)
+
+
+@pytest.mark.parametrize('deltas', [
+    [{'seq': 1, 'coins': 2 ** 70}],
+    [{'seq': 1, 'coins': 1e400}],
+    [{'seq': 0, 'coins': 1}],
+    [{'coins': 1}],
+    [{'seq': 'x'}],
+    [{'seq': i + 1, 'coins': 1} for i in range(server.BALANCE_MAX_DELTAS + 1)],
+])
+def test_invalid_deltas_are_rejected(client, migrated_db, player, deltas):
+    status, _ = sync(client, deltas)
+    assert status == 400
+    assert balance(migrated_db) == (100, 0)
+
+
+def test_timed_out_job_is_cancelled_before_commit(migrated_db, player, monkeypatch):
+    committer = server.BalanceCommitter()
+    start_worker = committer._ensure_worker
+    monkeypatch.setattr(server, 'BALANCE_SUBMIT_TIMEOUT', 0.05)
+    monkeypatch.setattr(committer, '_ensure_worker', lambda: None)  # 写入线程还没取走任务
+    result = committer.submit('ann', 'tab-1', [(1, 50, 0)])
+    assert result['success'] is False
+    start_worker()
+    marker = committer.submit('ann', 'tab-2', [(1, 1, 0)])  # 同一队列中排在被取消任务之后
+    assert marker['success']
+    assert balance(migrated_db) == (101, 0)
+
+
+def test_claimed_job_reports_its_real_result(migrated_db, player, monkeypatch):
+    committer = server.BalanceCommitter()
+    commit_batch = committer._commit_batch
+    monkeypatch.setattr(server, 'BALANCE_SUBMIT_TIMEOUT', 0.05)
+    monkeypatch.setattr(committer, '_commit_batch', lambda batch: time.sleep(0.2) or commit_batch(batch))
+    result = committer.submit('ann', 'tab-1', [(1, 50, 0)])
+    assert result['success'] and result['coins'] == 150
+    assert balance(migrated_db) == (150, 0)
@@ -0,0 +1,61 @@
+"""兑换码：批量生成的参数校验，以及并发领取不超过 max_uses"""
+import threading
+
+import pytest
+
+import server
+
+PLAYERS = 10
+MAX_USES = 3
+REWARD = 50
+
+
+@pytest.fixture
+def players(client):
+    names = [f'p{i}' for i in range(PLAYERS)]
+    for name in names:
+        client.post('/api/register', json={'username': name, 'password': 'p', 'email': f'{name}@e'})
+    return names
+
+
+def generate(client, **fields):
+    response = client.post('/api/admin/codes/generate', json={'count': 1, **fields})
+    return response.status_code, response.get_json()
+
+
+@pytest.mark.parametrize('expires_at', [20260101, {'at': '2026-01-01'}, ['2026-01-01'], 'tomorrow'])
+def test_invalid_expiry_is_rejected(client, migrated_db, expires_at):
+    status, result = generate(client, expires_at=expires_at)
+    assert status == 400 and not result['success']
+    with migrated_db.connection() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM redeem_codes').fetchone()[0] == 0
+
+
+def test_expiry_is_normalised(client, migrated_db):
+    status, result = generate(client, expires_at='2099-01-02T03:04:05')
+    assert status == 200 and result['count'] == 1
+    with migrated_db.connection() as conn:
+        assert conn.execute('SELECT expires_at FROM redeem_codes').fetchone()[0] == '2099-01-02 03:04:05'
+
+
+def test_concurrent_claims_respect_max_uses(client, migrated_db, players):
+    generate(client, prefix='T', max_uses=MAX_USES, reward_amount=REWARD)
+    with migrated_db.connection() as conn:
+        code = conn.execute('SELECT code FROM redeem_codes').fetchone()[0]
+    results = {}
+
+    def worker(username):
+        response = server.app.test_client().post('/api/redeem', json={'username': username, 'code': code})
+        results[username] = response.get_json()['success']
+
+    threads = [threading.Thread(target=worker, args=(name,)) for name in players]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    winners = {name for name, success in results.items() if success}
+    assert len(winners) == MAX_USES
+    with migrated_db.connection() as conn:
+        assert conn.execute('SELECT current_uses FROM redeem_codes').fetchone()[0] == MAX_USES
+        coins = dict(conn.execute('SELECT username, coins FROM users').fetchall())
+    assert all(coins[name] == (100 + REWARD if name in winners else 100) for name in players)
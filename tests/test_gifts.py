@@ -0,0 +1,75 @@
+"""礼物兑换：秒杀模式下并发兑换不超卖、积分扣减正确，预留库存时不在锁内查库"""
+import threading
+
+import pytest
+
+import server
+
+PRICE = 10
+STOCK = 5
+PLAYERS = 12
+
+
+@pytest.fixture
+def flash_gift(client, migrated_db):
+    with migrated_db.connection() as conn:
+        gift_id = conn.execute('INSERT INTO gifts (name, price, stock) VALUES (?, ?, ?)',
+                               ('hot', PRICE, STOCK)).lastrowid
+        conn.execute('INSERT OR REPLACE INTO game_config (key, value) VALUES (?, ?)',
+                     ('flash_sale_gift_ids', f'[{gift_id}]'))
+        server.bump_data_version(conn, 'game_config')
+        conn.commit()
+    for i in range(PLAYERS):
+        client.post('/api/register', json={'username': f'p{i}', 'password': 'p', 'email': f'p{i}@e'})
+    with migrated_db.connection() as conn:
+        conn.execute('UPDATE users SET tickets = ?', (PRICE * 2,))
+        server.bump_data_version(conn, 'tickets')
+        conn.commit()
+    return gift_id
+
+
+def redeem_all(gift_id, usernames):
+    results = {}
+
+    def worker(username):
+        response = server.app.test_client().post('/api/exchange_gift', json={'username': username,
+                                                                            'gift_id': gift_id})
+        results[username] = response.get_json()
+
+    threads = [threading.Thread(target=worker, args=(name,)) for name in usernames]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_flash_sale_never_oversells(migrated_db, flash_gift):
+    assert server.gift_flash_sale.enabled_for(flash_gift)
+    results = redeem_all(flash_gift, [f'p{i}' for i in range(PLAYERS)])
+    winners = {name for name, result in results.items() if result['success']}
+    assert len(winners) == STOCK
+    assert all(result['message'] == '已售罄' for name, result in results.items() if name not in winners)
+    with migrated_db.connection() as conn:
+        assert conn.execute('SELECT stock FROM gifts WHERE id = ?', (flash_gift,)).fetchone()[0] == 0
+        redeemed = {r[0] for r in conn.execute('SELECT user_id FROM gift_redemptions WHERE gift_id = ?',
+                                               (flash_gift,))}
+        tickets = dict(conn.execute('SELECT username, tickets FROM users').fetchall())
+    assert redeemed == winners
+    assert all(tickets[name] == (PRICE if name in winners else PRICE * 2) for name in tickets)
+
+
+def test_reserve_does_not_query_under_stock_lock(migrated_db, flash_gift, monkeypatch):
+    sale = server.GiftFlashSale()
+    connect = server.get_db_connection
+    held = []
+
+    def checked_connection():
+        held.append(sale._stock_lock.locked())
+        return connect()
+
+    monkeypatch.setattr(server, 'get_db_connection', checked_connection)
+    assert all(sale._reserve(flash_gift) for _ in range(STOCK))
+    assert not sale._reserve(flash_gift)
+    # 库存只在首次预留时加载一次，之后都在内存里扣减
+    assert held == [False]
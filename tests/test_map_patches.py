@@ -0,0 +1,62 @@
+"""/api/maps/update：增量操作、修订号冲突、不存在的地图和内置地图"""
+import json
+
+import server
+
+
+def save(client, data):
+    return client.post('/api/maps/save', json={'name': 'P', 'author': 'pat', 'data': data}).get_json()['key']
+
+
+def fetch(client, key):
+    row = client.get(f'/api/map/{key}').get_json()
+    return row['revision'], json.loads(row['data'])
+
+
+def maps_version(pool):
+    with pool.connection() as conn:
+        return conn.execute("SELECT version FROM data_versions WHERE name = 'maps'").fetchone()[0]
+
+
+def test_patch_ops_and_stale_revision(client):
+    key = save(client, {'pegs': [{'x': 1, 'y': 1}, {'x': 2, 'y': 2}], 'walls': []})
+    revision, data = fetch(client, key)
+    peg = next(p for p in data['pegs'] if p['x'] == 1)
+    ops = [{'op': 'move', 'kind': 'peg', 'id': peg['id'], 'x': 50, 'y': 60},
+           {'op': 'add', 'kind': 'wall', 'ref': 0, 'item': {'x': 0, 'y': 0, 'w': 10, 'h': 2}}]
+    response = client.post('/api/maps/update', json={'key': key, 'ops': ops, 'base_revision': revision})
+    result = response.get_json()
+    assert response.status_code == 200 and result['revision'] == revision + 1
+    assert result['added'] == [{'kind': 'wall', 'ref': 0, 'id': 1}]
+    _, data = fetch(client, key)
+    assert {(p['id'], p['x'], p['y']) for p in data['pegs']} == {(peg['id'], 50, 60), (2, 2, 2)}
+
+    # 基于旧修订号的补丁被拒绝，数据不变
+    stale = client.post('/api/maps/update', json={'key': key, 'base_revision': revision,
+                                                  'ops': [{'op': 'delete', 'kind': 'peg', 'id': peg['id']}]})
+    assert stale.status_code == 409 and stale.get_json()['revision'] == revision + 1
+    assert fetch(client, key) == (revision + 1, data)
+
+
+def test_invalid_op_changes_nothing(client):
+    key = save(client, {'pegs': [{'x': 1, 'y': 1}], 'walls': []})
+    before = fetch(client, key)
+    response = client.post('/api/maps/update', json={'key': key, 'base_revision': before[0],
+                                                     'ops': [{'op': 'delete', 'kind': 'peg', 'id': 99}]})
+    assert response.status_code == 400
+    assert fetch(client, key) == before
+
+
+def test_update_unknown_key_is_404_without_version_bump(client, migrated_db):
+    version = maps_version(migrated_db)
+    response = client.post('/api/maps/update', json={'key': 'NOPE', 'name': 'x', 'author': 'y', 'data': {}})
+    assert response.status_code == 404
+    assert maps_version(migrated_db) == version
+
+
+def test_patch_rejected_on_builtin_map(client):
+    key = server.DEFAULT_MAPS[0][0]
+    response = client.post('/api/maps/update', json={'key': key, 'base_revision': 0,
+                                                     'ops': [{'op': 'add', 'kind': 'peg', 'item': {'x': 1, 'y': 1}}]})
+    assert response.status_code == 400
+    assert client.get(f'/api/map/{key}').get_json()['data'] is None
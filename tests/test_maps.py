@@ -0,0 +1,78 @@
+"""地图紧凑编码的往返、按内容哈希去重的 blob 存储与引用计数，以及模拟时自定义布局的判定"""
+import json
+
+import server
+
+MAP = {'pegs': [{'x': 10.04, 'y': 20, 'mat': 'gold'}, {'x': 5, 'y': 6, 'r': 10}],
+       'walls': [{'x': 0, 'y': 0, 'w': 30, 'h': 4}], 'bg': 'night'}
+
+
+def blob_refs(pool):
+    with pool.connection() as conn:
+        return {r['hash']: r['refs'] for r in conn.execute('SELECT hash, refs FROM map_blobs')}
+
+
+def save(client, name, author, data=MAP):
+    result = client.post('/api/maps/save', json={'name': name, 'author': author, 'data': data}).get_json()
+    assert result['success'], result
+    return result['key']
+
+
+def load(client, key):
+    return json.loads(client.get(f'/api/map/{key}').get_json()['data'])
+
+
+def test_encode_round_trip_quantizes_and_keeps_ids():
+    blob, data_hash, item_ids = server.encode_map_data(MAP)
+    data = server.decode_map_data(blob, item_ids)
+    assert data['bg'] == 'night'
+    gold = next(p for p in data['pegs'] if p['mat'] == 'gold')
+    assert (gold['x'], gold['y'], gold['r']) == (10, 20, 10)
+    assert sorted(p['id'] for p in data['pegs']) == [1, 2] and data['walls'][0]['id'] == 1
+    # 再编码一次：内容、哈希、id 都不变
+    assert server.encode_map_data(data) == (blob, data_hash, item_ids)
+
+
+def test_hash_ignores_ids_and_order():
+    reordered = dict(MAP, pegs=[dict(p, id=i + 7) for i, p in enumerate(reversed(MAP['pegs']))])
+    blob, data_hash, item_ids = server.encode_map_data(MAP)
+    blob2, data_hash2, item_ids2 = server.encode_map_data(reordered)
+    assert (blob2, data_hash2) == (blob, data_hash)
+    assert item_ids2 != item_ids
+
+
+def test_identical_content_shares_one_blob(client, migrated_db):
+    alice = save(client, 'A', 'alice')
+    bob = save(client, 'B', 'bob')
+    assert alice != bob
+    assert list(blob_refs(migrated_db).values()) == [2]
+    assert load(client, alice) == load(client, bob)
+    # 同一作者同名同内容的重复提交返回已有的地图
+    assert save(client, 'A', 'alice') == alice
+    assert list(blob_refs(migrated_db).values()) == [2]
+
+
+def test_update_and_delete_release_blobs(client, migrated_db):
+    alice = save(client, 'A', 'alice')
+    bob = save(client, 'B', 'bob')
+    changed = dict(MAP, walls=[])
+    result = client.post('/api/maps/update', json={'key': bob, 'name': 'B', 'author': 'bob', 'data': changed})
+    assert result.get_json()['success']
+    assert sorted(blob_refs(migrated_db).values()) == [1, 1]
+    assert load(client, bob)['walls'] == []
+
+    client.post('/api/admin/delete_map', json={'key': bob})
+    assert list(blob_refs(migrated_db).values()) == [1]
+    client.post('/api/admin/delete_map', json={'key': alice})
+    assert blob_refs(migrated_db) == {}
+
+
+def test_empty_peg_list_is_a_custom_layout(monkeypatch):
+    def builtin_layout(*args):
+        raise AssertionError('pegs: [] 不应回退到内置布局')
+
+    monkeypatch.setattr(server, 'default_map_layout', builtin_layout)
+    spec = {'key': server.DEFAULT_MAPS[0][0], 'data': {'pegs': []}, 'width': server.SIM_WIDTH,
+            'height': server.SIM_HEIGHT, 'slot_count': 14, 'extras': None}
+    counts = server.simulate_map_chunk(spec, 20, 1)
+    assert len(counts) == 14 - server.SIM_TIMEOUT and sum(counts) == 20
@@ -0,0 +1,38 @@
+"""对 server.py 中的每一条 SQL 在迁移后的数据库上执行 EXPLAIN QUERY PLAN，出现未使用索引的全表扫描即失败"""
+
+import server
+
+
+def test_every_execute_is_checkable():
+    _, unresolved = server.collect_sql_statements()
+    assert unresolved == [], f'server.py 这些行的 SQL 不是字面量或模块级常量: {unresolved}'
+
+
+def test_collects_route_queries():
+    statements, _ = server.collect_sql_statements()
+    sqls = {sql for _, sql in statements}
+    for sql in (server.ADMIN_USERS_SEARCH_SQL, server.ADMIN_USERS_PAGE_SQL,
+                server.CODE_EXPORT_BATCH_SQL, server.CODE_EXPORT_ALL_SQL):
+        assert sql in sqls
+
+
+def test_no_unindexed_table_scans(migrated_db):
+    statements, _ = server.collect_sql_statements()
+    with migrated_db.connection() as conn:
+        problems = server.find_table_scans(conn, statements)
+    assert problems == []
+
+
+def test_detects_table_scan(migrated_db):
+    with migrated_db.connection() as conn:
+        problems = server.find_table_scans(conn, [(1, 'SELECT * FROM users WHERE coins = ?')])
+    assert problems == [(1, 'SCAN users')]
+
+
+def test_index_order_walk_is_a_scan(migrated_db):
+    # 按索引顺序遍历整表同样读全表，不能因为计划里有 USING INDEX 就放过
+    sql = 'SELECT username FROM users ORDER BY username'
+    with migrated_db.connection() as conn:
+        problems = server.find_table_scans(conn, [(1, sql)])
+        assert problems and problems[0][1].startswith('SCAN users USING')
+        assert server.find_table_scans(conn, [(1, sql.replace('users', f'users {server.SQL_FULL_SCAN_MARK}'))]) == []
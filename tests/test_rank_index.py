@@ -0,0 +1,88 @@
+"""SortedKeyList 与朴素有序 list 对拍，RankIndex 的名次/分页/邻居"""
+import bisect
+import random
+
+import pytest
+
+import server
+
+
+def small_buckets(keys):
+    # 小桶，让拆分/删空桶的路径被频繁覆盖
+    return server.SortedKeyList(keys, load=4)
+
+
+def test_sorted_key_list_matches_plain_list():
+    rng = random.Random(7)
+    keys = small_buckets([(rng.randint(-50, 0), f'u{i}') for i in range(300)])
+    plain = sorted(keys.slice(0, len(keys)))
+    for _ in range(3000):
+        key = (rng.randint(-50, 0), f'u{rng.randint(0, 400)}')
+        if rng.random() < 0.5:
+            keys.add(key)
+            bisect.insort(plain, key)
+        else:
+            keys.discard(key)
+            if key in plain:
+                plain.remove(key)
+        probe = (rng.randint(-50, 0), f'u{rng.randint(0, 400)}')
+        assert len(keys) == len(plain)
+        assert keys.bisect_left(probe) == bisect.bisect_left(plain, probe)
+        assert keys.bisect_right(probe) == bisect.bisect_right(plain, probe)
+        start = rng.randint(0, len(plain))
+        assert keys.slice(start, start + 25) == plain[start:start + 25]
+    assert keys.slice(0, len(keys)) == plain
+
+
+@pytest.fixture
+def ranked_db(migrated_db):
+    with migrated_db.connection() as conn:
+        conn.executemany('INSERT INTO users (username, password, email, coins, tickets) VALUES (?, ?, ?, 0, ?)',
+                         [(f'p{i}', 'x', f'p{i}@e', i % 7) for i in range(50)])
+        conn.commit()
+    return migrated_db
+
+
+def set_tickets(pool, username, tickets):
+    """模拟一次积分写入：修改并在同一事务中递增 tickets 版本号"""
+    with pool.connection() as conn:
+        conn.execute('UPDATE users SET tickets = ? WHERE username = ?', (tickets, username))
+        version = server.bump_data_version(conn, 'tickets')
+        conn.commit()
+    return version
+
+
+def test_rank_index_pages_and_updates(ranked_db):
+    index = server.RankIndex()
+    rows, cursor = index.page(10)
+    assert [r['rank'] for r in rows] == list(range(1, 11))
+    assert rows == sorted(rows, key=lambda r: (-r['tickets'], r['username']))
+    rest, _ = index.page(100, server.decode_rank_cursor(cursor))
+    assert rest[0]['rank'] == 11
+
+    index.update('p0', 1000, set_tickets(ranked_db, 'p0', 1000))
+    assert index.rank_of('p0') == (1, 1000)
+    neighbors = index.around('p0', 2)
+    assert [r['username'] for r in neighbors][0] == 'p0'
+    assert len(neighbors) == 3
+
+
+def test_own_writes_do_not_reload(ranked_db, monkeypatch):
+    index = server.RankIndex(check_interval=0)
+    index.page(1)
+    loads, build = [], server.SortedKeyList
+    monkeypatch.setattr(server, 'SortedKeyList', lambda keys: loads.append(1) or build(keys))
+    # 本进程的写入乱序到达：版本号连续后不需要重载，同一用户不会被旧值覆盖
+    v1 = set_tickets(ranked_db, 'p1', 500)
+    v2 = set_tickets(ranked_db, 'p1', 600)
+    index.update('p1', 600, v2)
+    index.update('p1', 500, v1)
+    assert index.rank_of('p1') == (1, 600)
+    assert loads == []
+
+
+def test_other_process_write_triggers_reload(ranked_db):
+    index = server.RankIndex(check_interval=0)
+    index.page(1)
+    set_tickets(ranked_db, 'p2', 900)  # 没有调用 index.update，相当于其他进程的写入
+    assert index.rank_of('p2') == (1, 900)